@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# End to end benchmark of a NetCheck.py run against the local stand-in in
+# StandInServer.py. Reports wall time, CPU time and peak RSS for every
+# phase so a change can be judged on more than the measured Mbps
+#   get_servers, get_best_servers, warm_up, measure_download,
+#   measure_upload
+#   export - register the exporter, push the metrics and flush them
+# The export phase needs azure-monitor-opentelemetry and runs once
+# because the OpenTelemetry providers can only be registered once.
+#
+# Run from the repository root
+#   python3 benchmarks/EndToEnd.py
+#   python3 benchmarks/EndToEnd.py --repeat 3 --rate-mbps 200 --latency-ms 5
+#   python3 benchmarks/EndToEnd.py --latency-ms 40 --pooled
+import argparse
+import logging
+import os
+import statistics
+import sys
+import tempfile
+
+from StandInServer import start_stand_in
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+from ResourceUsage import PhaseTracer, measure_usage  # noqa: E402
+from SpeedTest import Merge, run_test  # noqa: E402
+
+PHASES = [
+    "get_servers",
+    "get_best_servers",
+    "warm_up",
+    "measure_download",
+    "measure_upload",
+    "export",
+]
+# Breeze accepts any key, the stand-in doesn't check it
+STAND_IN_INSTRUMENTATION_KEY = "00000000-0000-0000-0000-000000000000"
+
+
+def stand_in_connection_string(base_url: str) -> str:
+    return (
+        f"InstrumentationKey={STAND_IN_INSTRUMENTATION_KEY};"
+        f"IngestionEndpoint={base_url}/"
+    )
+
+
+# config.ini in a scratch directory so the real one and its caches are safe
+def write_config(directory: str, base_url: str, pooled: bool) -> None:
+    with open(os.path.join(directory, "config.ini"), "w") as config_file:
+        config_file.write(
+            "[azure]\n"
+            "azure_instrumentation_key = "
+            f"{stand_in_connection_string(base_url)}\n"
+            "[speedtest]\n"
+            "secure = false\n"
+            f"base_url = {base_url}\n"
+            "[server_cache]\n"
+            "ttl_seconds = 0\n"
+            "[results_store]\n"
+            "path =\n"
+            "[transport]\n"
+            f"pooled = {pooled}\n"
+            f"warm_up = {pooled}\n"
+        )
+
+
+# register, push and flush against the stand-in ingestion endpoint
+def run_export(results_combined: dict, base_url: str) -> None:
+    from AppInsights import (
+        push_azure_speedtest_metrics,
+        register_azure_monitor,
+        shutdown_azure_monitor,
+    )
+
+    connection_string = stand_in_connection_string(base_url)
+    register_azure_monitor(connection_string, cloud_role_name="EndToEnd.py")
+    push_azure_speedtest_metrics(results_combined, connection_string)
+    shutdown_azure_monitor()
+
+
+def print_report(phases: dict) -> None:
+    print(
+        f"{'phase':<20} {'runs':>4} {'wall ms':>10} {'cpu ms':>10} "
+        f"{'peak rss MB':>12}"
+    )
+    for name in PHASES:
+        runs = phases.get(name)
+        if not runs:
+            print(f"{name:<20} {0:>4} {'skipped':>10}")
+            continue
+        wall = statistics.median(run["wall_ms"] for run in runs)
+        cpu = statistics.median(run["cpu_ms"] for run in runs)
+        peak = max(run.get("rss_peak_kb", 0) for run in runs) / 1024.0
+        print(
+            f"{name:<20} {len(runs):>4} {wall:>10.1f} {cpu:>10.1f} "
+            f"{peak:>12.1f}"
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="EndToEnd",
+        description="Benchmark NetCheck phases against a local stand-in.",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=1, help="speed test runs"
+    )
+    parser.add_argument(
+        "--rate-mbps",
+        type=float,
+        default=0,
+        help="stand-in link speed, 0 is unlimited",
+    )
+    parser.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="stand-in delay added to every request",
+    )
+    parser.add_argument(
+        "--test-length",
+        type=int,
+        default=3,
+        help="seconds per download and upload test",
+    )
+    parser.add_argument(
+        "--pooled",
+        action="store_true",
+        help="keep-alive connections and a warm up before the transfers",
+    )
+    parser.add_argument(
+        "--no-export", action="store_true", help="skip the export phase"
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    server = start_stand_in(
+        port=0,
+        rate_mbps=args.rate_mbps,
+        latency_ms=args.latency_ms,
+        test_length_seconds=args.test_length,
+    )
+    tracer = PhaseTracer()
+    original_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as work_directory:
+        os.chdir(work_directory)
+        try:
+            write_config(work_directory, server.base_url, args.pooled)
+            for _ in range(args.repeat):
+                results_speed, results_setup = run_test(
+                    should_download=True,
+                    should_upload=True,
+                    should_share=False,
+                    tracer=tracer,
+                )
+            results_combined = Merge(results_speed.dict(), results_setup)
+            if not args.no_export:
+                try:
+                    with measure_usage() as usage:
+                        run_export(results_combined, server.base_url)
+                    tracer.phases["export"] = [usage]
+                except ImportError as e:
+                    print(f"export skipped: {e}")
+        finally:
+            os.chdir(original_directory)
+            server.shutdown()
+
+    print(
+        f"download {results_combined['download'] / 1e6:.1f} Mbps  "
+        f"upload {results_combined['upload'] / 1e6:.1f} Mbps  "
+        f"ping {results_combined['ping']:.1f} ms"
+    )
+    print_report(tracer.phases)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Cold start benchmark. Reports the import time of each of our modules
+# and their heaviest dependencies using python -X importtime
+# so regressions in startup latency are visible.
+#
+# Run from the repository root
+#   python3 benchmarks/ImportTime.py
+#   python3 benchmarks/ImportTime.py --repeat 5 --top 10
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Our modules first then the heavy dependencies they used to import eagerly
+DEFAULT_MODULES = [
+    "AppInsights",
+    "SpeedTest",
+    "DnsCheck",
+    "speedtest",
+    "opentelemetry.sdk.metrics",
+    "azure.monitor.opentelemetry",
+]
+
+
+# Each import runs in a fresh interpreter so nothing is already cached.
+# Returns a list of (self_us, cumulative_us, depth, module) or None
+def import_times(module: str):
+    env = dict(os.environ, PYTHONPATH=SRC_DIR)
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=SRC_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        return None
+    rows = []
+    # import time: self [us] | cumulative | imported package
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        fields = line.removeprefix("import time:").split("|")
+        self_us, cumulative_us, name = fields
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, name.strip()))
+    return rows
+
+
+# wall time of a whole script start. --help exits right after the imports
+def script_start_ms(script: str) -> float:
+    tic = time.perf_counter()
+    subprocess.run(
+        [sys.executable, os.path.join(SRC_DIR, script), "--help"],
+        cwd=SRC_DIR,
+        capture_output=True,
+    )
+    return (time.perf_counter() - tic) * 1000.0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="ImportTime",
+        description="Report cold start import time per module.",
+    )
+    parser.add_argument(
+        "modules",
+        nargs="*",
+        default=DEFAULT_MODULES,
+        help="modules to import, defaults to our modules and their heavy "
+        "dependencies",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        type=int,
+        default=3,
+        help="runs per module, the fastest is reported",
+    )
+    parser.add_argument(
+        "-t",
+        "--top",
+        type=int,
+        default=5,
+        help="heaviest nested imports to list under each module",
+    )
+    args = parser.parse_args()
+
+    print(f"{'module':<32} {'cumulative ms':>14} {'self ms':>9}")
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.repeat)]
+        runs = [rows for rows in runs if rows]
+        if not runs:
+            print(f"{module:<32} {'not importable':>14}")
+            continue
+        # the requested module is the last top level line
+        fastest = min(runs, key=lambda rows: rows[-1][1])
+        self_us, cumulative_us, _, _ = fastest[-1]
+        print(
+            f"{module:<32} {cumulative_us / 1000:>14.1f} "
+            f"{self_us / 1000:>9.1f}"
+        )
+        nested = sorted(
+            (row for row in fastest[:-1] if row[2] == 1),
+            key=lambda row: row[1],
+            reverse=True,
+        )
+        for _, nested_us, _, name in nested[: args.top]:
+            print(f"    {name:<28} {nested_us / 1000:>14.1f}")
+
+    print()
+    print(f"{'script --help':<32} {'wall ms':>14}")
+    for script in ("NetCheck.py", "DnsCheck.py"):
+        fastest_ms = min(script_start_ms(script) for _ in range(args.repeat))
+        print(f"{script:<32} {fastest_ms:>14.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Local stand-in resolver so DnsCheck.py --transports can be run without
+# the internet. Answers every A query with 127.0.0.1, and names starting
+# with _, dnsdiag's forced cache misses, with NXDOMAIN over
+#   UDP and TCP                 --port
+#   DNS over TLS                --dot-port
+#   DNS over HTTPS /dns-query   --doh-port
+# TLS needs a certificate, a self-signed one is fine
+#   openssl req -x509 -newkey rsa:2048 -nodes -days 30 -subj /CN=127.0.0.1
+#     -keyout resolver.key -out resolver.pem
+# --latency-ms is added to every answer and --handshake-ms to every TLS
+# handshake, DoT and DoH.
+#
+# Point DnsCheck.py at it with config.ini
+#   [dns]
+#   servers = 127.0.0.1
+#   udp_port = 5353
+#   tcp_port = 5353
+#   dot_port = 8853
+#   doh_port = 8443
+#   tls_verify = false
+#
+# Run from the repository root
+#   python3 benchmarks/StandInResolver.py --certfile resolver.pem
+#     --keyfile resolver.key
+import argparse
+import socket
+import socketserver
+import ssl
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 5353
+DEFAULT_DOT_PORT = 8853
+DEFAULT_DOH_PORT = 8443
+DNS_MESSAGE = "application/dns-message"
+# response, recursion desired and available
+FLAGS_ANSWER = 0x8180
+RCODE_NXDOMAIN = 3
+ANSWER_TTL = 60
+LOCALHOST = bytes([127, 0, 0, 1])
+
+
+# The answer to a query or None when it can't be parsed
+def answer(query: bytes):
+    if len(query) < 12:
+        return None
+    (query_id,) = struct.unpack_from("!H", query)
+    # walk the question name
+    offset = 12
+    first_label = b""
+    while offset < len(query) and query[offset]:
+        start = offset + 1
+        end = start + query[offset]
+        if not first_label:
+            first_label = query[start:end]
+        offset = end
+    offset += 5
+    if offset > len(query):
+        return None
+    question = query[12:offset]
+    if first_label.startswith(b"_"):
+        header = struct.pack(
+            "!HHHHHH", query_id, FLAGS_ANSWER | RCODE_NXDOMAIN, 1, 0, 0, 0
+        )
+        return header + question
+    header = struct.pack("!HHHHHH", query_id, FLAGS_ANSWER, 1, 1, 0, 0)
+    # name is a pointer back to the question
+    record = struct.pack("!HHHIH", 0xC00C, 1, 1, ANSWER_TTL, 4) + LOCALHOST
+    return header + question + record
+
+
+def _recv_exact(sock, size: int):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+class _UdpHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        data, sock = self.request
+        reply = answer(data)
+        if reply is not None:
+            self.server.delay()
+            sock.sendto(reply, self.client_address)
+
+
+# length prefixed messages until the client closes, TCP and DoT
+class _StreamHandler(socketserver.BaseRequestHandler):
+    def handle(self) -> None:
+        while True:
+            prefix = _recv_exact(self.request, 2)
+            if prefix is None:
+                return
+            query = _recv_exact(self.request, struct.unpack("!H", prefix)[0])
+            reply = answer(query or b"")
+            if reply is None:
+                return
+            self.server.delay()
+            self.request.sendall(struct.pack("!H", len(reply)) + reply)
+
+
+class _DohHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # the headers and the answer are separate writes
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get("Content-Length", 0))
+        reply = answer(self.rfile.read(length))
+        if self.path != "/dns-query" or reply is None:
+            self.send_error(400)
+            return
+        self.server.delay()
+        self.send_response(200)
+        self.send_header("Content-Type", DNS_MESSAGE)
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+class _Delays:
+    def delay(self, ms=None) -> None:
+        ms = self.latency_ms if ms is None else ms
+        if ms:
+            time.sleep(ms / 1000.0)
+
+    # handshakes happen on the handler thread so a slow one doesn't block
+    # the accept loop
+    def _wrap(self, request):
+        self.delay(self.handshake_ms)
+        try:
+            return self.context.wrap_socket(request, server_side=True)
+        except (OSError, ssl.SSLError):
+            request.close()
+            return None
+
+
+class _UdpServer(_Delays, socketserver.ThreadingUDPServer):
+    daemon_threads = True
+
+
+class _TcpServer(_Delays, socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    # like _DohHandler, otherwise the first DoT answer waits for the
+    # delayed ACK of the TLS session tickets and adds 40ms to the query
+    def get_request(self):
+        request, client_address = super().get_request()
+        request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return request, client_address
+
+
+class _TlsServer(_TcpServer):
+    def __init__(self, address, handler, context) -> None:
+        super().__init__(address, handler)
+        self.context = context
+
+    def finish_request(self, request, client_address) -> None:
+        request = self._wrap(request)
+        if request is not None:
+            super().finish_request(request, client_address)
+
+
+class _DohServer(_Delays, ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, context) -> None:
+        super().__init__(address, _DohHandler)
+        self.context = context
+
+    def finish_request(self, request, client_address) -> None:
+        request = self._wrap(request)
+        if request is not None:
+            super().finish_request(request, client_address)
+
+
+# Serve every transport on daemon threads. Returns the servers,
+# call shutdown() on each when done. DoT and DoH need a certfile
+def start_resolver(
+    port: int = DEFAULT_PORT,
+    dot_port: int = DEFAULT_DOT_PORT,
+    doh_port: int = DEFAULT_DOH_PORT,
+    certfile: str = "",
+    keyfile: str = "",
+    latency_ms: float = 0,
+    handshake_ms: float = 0,
+) -> list:
+    servers = [
+        _UdpServer(("127.0.0.1", port), _UdpHandler),
+        _TcpServer(("127.0.0.1", port), _StreamHandler),
+    ]
+    if certfile:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile, keyfile or None)
+        servers.append(
+            _TlsServer(("127.0.0.1", dot_port), _StreamHandler, context)
+        )
+        doh_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        doh_context.load_cert_chain(certfile, keyfile or None)
+        doh_context.set_alpn_protocols(["http/1.1"])
+        servers.append(_DohServer(("127.0.0.1", doh_port), doh_context))
+    for server in servers:
+        server.latency_ms = latency_ms
+        server.handshake_ms = handshake_ms
+        threading.Thread(
+            target=server.serve_forever,
+            name=type(server).__name__,
+            daemon=True,
+        ).start()
+    return servers
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="StandInResolver",
+        description="Local stand-in resolver for UDP, TCP, DoT and DoH.",
+    )
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--dot-port", type=int, default=DEFAULT_DOT_PORT)
+    parser.add_argument("--doh-port", type=int, default=DEFAULT_DOH_PORT)
+    parser.add_argument(
+        "--certfile", default="", help="pem certificate, enables DoT and DoH"
+    )
+    parser.add_argument("--keyfile", default="")
+    parser.add_argument(
+        "-l",
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="added to every answer",
+    )
+    parser.add_argument(
+        "--handshake-ms",
+        type=float,
+        default=0,
+        help="added to every TLS handshake",
+    )
+    args = parser.parse_args()
+
+    servers = start_resolver(
+        port=args.port,
+        dot_port=args.dot_port,
+        doh_port=args.doh_port,
+        certfile=args.certfile,
+        keyfile=args.keyfile,
+        latency_ms=args.latency_ms,
+        handshake_ms=args.handshake_ms,
+    )
+    print(
+        f"stand-in resolver on 127.0.0.1:{args.port} udp and tcp"
+        + (
+            f", dot {args.dot_port} and doh {args.doh_port}"
+            if args.certfile
+            else ", no certfile so no dot or doh"
+        )
+    )
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
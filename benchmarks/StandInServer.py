@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Local stand-in for speedtest.net and the Application Insights ingestion
+# endpoint so NetCheck.py can be benchmarked repeatably without the
+# internet. Serves just enough of the speedtest.net protocol for
+# speedtest-cli
+#   /speedtest-config.php             client and test settings
+#   /speedtest-servers*.php           server list, every server is us
+#   /speedtest/latency.txt            get_best_server() ping
+#   /speedtest/randomNxN.jpg          download payloads
+#   /speedtest/upload.php             upload sink
+#   /v2.1/track                       telemetry sink
+# Download and upload share one token bucket so --rate-mbps shapes the
+# link the way a real uplink would. --latency-ms is added to every request
+# and once more to every new connection.
+#
+# Point SpeedTest.py at it with config.ini
+#   [speedtest]
+#   secure = false
+#   base_url = http://127.0.0.1:8080
+#
+# Run from the repository root
+#   python3 benchmarks/StandInServer.py --port 8080 --rate-mbps 100
+import argparse
+import gzip
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_PORT = 8080
+DEFAULT_TEST_LENGTH_SECONDS = 3
+DEFAULT_SERVER_COUNT = 3
+CHUNK_SIZE = 64 * 1024
+
+RANDOM_IMAGE = re.compile(r"/random(\d+)x(\d+)\.jpg$")
+# one shared chunk, download payloads are slices of it
+_PAYLOAD = memoryview(bytes(range(256)) * (CHUNK_SIZE // 256))
+
+
+# Shared bandwidth limit. rate 0 is unlimited
+class _TokenBucket:
+    def __init__(self, rate_mbps: float) -> None:
+        self._rate = rate_mbps * 1_000_000 / 8.0
+        self._lock = threading.Lock()
+        # allow a burst of 50ms of traffic
+        self._capacity = self._rate * 0.05
+        self._tokens = self._capacity
+        self._updated = time.perf_counter()
+
+    def consume(self, size: int) -> None:
+        if self._rate <= 0:
+            return
+        with self._lock:
+            now = time.perf_counter()
+            self._tokens = min(
+                self._capacity,
+                self._tokens + (now - self._updated) * self._rate,
+            )
+            self._updated = now
+            self._tokens -= size
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    # a new connection pays one more round trip for the handshake
+    def setup(self) -> None:
+        super().setup()
+        self._delay()
+
+    def _delay(self) -> None:
+        if self.server.latency_ms:
+            time.sleep(self.server.latency_ms / 1000.0)
+
+    def _reply(self, body: bytes, content_type: str = "text/plain") -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # speedtest-cli hangs up once the test length is reached
+            self.close_connection = True
+
+    def _path(self) -> str:
+        return self.path.split("?", 1)[0]
+
+    def do_HEAD(self) -> None:
+        self.do_GET()
+
+    def do_GET(self) -> None:
+        self._delay()
+        path = self._path()
+        if path.endswith("/speedtest-config.php"):
+            self._reply(self.server.config_xml(), "text/xml")
+        elif "/speedtest-servers" in path:
+            self._reply(self.server.servers_xml(), "text/xml")
+        elif path.endswith("/latency.txt"):
+            self._reply(b"test=test")
+        elif RANDOM_IMAGE.search(path):
+            width, height = RANDOM_IMAGE.search(path).groups()
+            self._send_payload(int(width) * int(height) * 2)
+        else:
+            self.send_error(404)
+
+    # stream size bytes through the token bucket
+    def _send_payload(self, size: int) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        remaining = size
+        try:
+            while remaining > 0:
+                chunk = min(remaining, CHUNK_SIZE)
+                self.server.bucket.consume(chunk)
+                self.wfile.write(_PAYLOAD[:chunk])
+                remaining -= chunk
+        except (BrokenPipeError, ConnectionResetError):
+            # speedtest-cli hangs up once the test length is reached
+            self.close_connection = True
+
+    # read the request body through the token bucket
+    def _receive_body(self) -> bytes:
+        remaining = int(self.headers.get("Content-Length", 0))
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                break
+            self.server.bucket.consume(len(chunk))
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b"".join(chunks)
+
+    def do_POST(self) -> None:
+        self._delay()
+        path = self._path()
+        if path.endswith("/upload.php"):
+            try:
+                body = self._receive_body()
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+                return
+            self._reply(f"size={len(body)}".encode())
+        elif path.endswith("/v2.1/track"):
+            self._track(self.rfile.read(int(self.headers["Content-Length"])))
+        else:
+            self.send_error(404)
+
+    # accept every telemetry item like Breeze does
+    def _track(self, body: bytes) -> None:
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        try:
+            items = json.loads(body)
+        except ValueError:
+            # newline delimited json
+            items = [line for line in body.splitlines() if line.strip()]
+        count = len(items) if isinstance(items, list) else 1
+        self.server.items_received += count
+        self._reply(
+            json.dumps(
+                {"itemsReceived": count, "itemsAccepted": count, "errors": []}
+            ).encode(),
+            "application/json",
+        )
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # speedtest-cli opens every download connection at once
+    request_queue_size = 128
+
+    def __init__(
+        self,
+        port: int = DEFAULT_PORT,
+        rate_mbps: float = 0,
+        latency_ms: float = 0,
+        test_length_seconds: int = DEFAULT_TEST_LENGTH_SECONDS,
+        server_count: int = DEFAULT_SERVER_COUNT,
+        verbose: bool = False,
+    ) -> None:
+        super().__init__(("127.0.0.1", port), _StandInHandler)
+        self.bucket = _TokenBucket(rate_mbps)
+        self.latency_ms = latency_ms
+        self.test_length_seconds = test_length_seconds
+        self.server_count = server_count
+        self.verbose = verbose
+        self.items_received = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def config_xml(self) -> bytes:
+        length = self.test_length_seconds
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n<settings>'
+            '<client ip="127.0.0.1" lat="0" lon="0" isp="Stand-in" '
+            'isprating="3.7" rating="0" ispdlavg="0" ispulavg="0" '
+            'loggedin="0" country="ZZ"/>'
+            '<server-config threadcount="4" ignoreids="" notonmap="" '
+            'forcepingid="" preferredserverid=""/>'
+            f'<download testlength="{length}" initialtest="250K" '
+            'mintestsize="250K" threadsperurl="4"/>'
+            f'<upload testlength="{length}" ratio="5" initialtest="0" '
+            'mintestsize="32K" threads="2" maxchunksize="512K" '
+            'maxchunkcount="50" threadsperurl="4"/>'
+            "</settings>"
+        ).encode()
+
+    def servers_xml(self) -> bytes:
+        port = self.server_address[1]
+        servers = "".join(
+            f'<server url="{self.base_url}/speedtest/upload.php" '
+            f'lat="0.{number}" lon="0" name="Local {number}" country="Local" '
+            f'cc="ZZ" sponsor="Stand-in" id="{number}" '
+            f'host="127.0.0.1:{port}"/>'
+            for number in range(1, self.server_count + 1)
+        )
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f"<settings><servers>{servers}</servers></settings>"
+        ).encode()
+
+
+# Serve on a daemon thread. Returns the server, call shutdown() when done
+def start_stand_in(**kwargs) -> StandInServer:
+    server = StandInServer(**kwargs)
+    threading.Thread(
+        target=server.serve_forever, name="StandInServer", daemon=True
+    ).start()
+    return server
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        prog="StandInServer",
+        description="Local stand-in for speedtest.net and Azure ingestion.",
+    )
+    parser.add_argument("-p", "--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "-r",
+        "--rate-mbps",
+        type=float,
+        default=0,
+        help="shared download and upload limit, 0 is unlimited",
+    )
+    parser.add_argument(
+        "-l",
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="added to every request",
+    )
+    parser.add_argument(
+        "-t",
+        "--test-length",
+        type=int,
+        default=DEFAULT_TEST_LENGTH_SECONDS,
+        help="seconds per download and upload test",
+    )
+    parser.add_argument(
+        "-s",
+        "--servers",
+        type=int,
+        default=DEFAULT_SERVER_COUNT,
+        help="entries in the server list",
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    server = StandInServer(
+        port=args.port,
+        rate_mbps=args.rate_mbps,
+        latency_ms=args.latency_ms,
+        test_length_seconds=args.test_length,
+        server_count=args.servers,
+        verbose=args.verbose,
+    )
+    print(f"stand-in listening on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Adaptive early stop for the speedtest download and upload tests.
+#
+# speedtest-cli always runs each direction for the full configured test
+# length, roughly 117 MB each way on a fast link. On a metered backup
+# link that adds up. ConvergenceCheck is the stop check given to
+# ThroughputSampler.sampled_transfer(). It stops the test once the
+# throughput estimate has settled, or once the test has moved max_mb.
+# The byte cap is enforced by sampled_transfer() on every request.
+#
+# The throughput is sampled every sample_interval_ms. The test is
+# converged when the 95% confidence interval of the mean of the last
+# window_samples interval rates is within confidence_band of that mean.
+import configparser
+import logging
+import math
+import statistics
+import sys
+from collections import deque
+
+from ThroughputSampler import STOP_BYTE_CAP
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py --adaptive")
+    sys.exit(-1)
+
+STOP_CONVERGED = "converged"
+STOP_COMPLETE = "complete"
+
+DEFAULT_SAMPLE_INTERVAL_MS = 250
+DEFAULT_WINDOW_SAMPLES = 8
+DEFAULT_CONFIDENCE_BAND = 0.05
+DEFAULT_MIN_SECONDS = 2.0
+DEFAULT_MAX_MB = 50
+# two sided 95% confidence
+Z_95 = 1.96
+
+
+# Read the optional [adaptive] section of config.ini
+def load_adaptive_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    adaptive_config = {
+        "enabled": config.getboolean("adaptive", "enabled", fallback=False),
+        "sample_interval_ms": config.getfloat(
+            "adaptive",
+            "sample_interval_ms",
+            fallback=DEFAULT_SAMPLE_INTERVAL_MS,
+        ),
+        "window_samples": config.getint(
+            "adaptive", "window_samples", fallback=DEFAULT_WINDOW_SAMPLES
+        ),
+        "confidence_band": config.getfloat(
+            "adaptive", "confidence_band", fallback=DEFAULT_CONFIDENCE_BAND
+        ),
+        "min_seconds": config.getfloat(
+            "adaptive", "min_seconds", fallback=DEFAULT_MIN_SECONDS
+        ),
+        # 0 is no cap
+        "max_mb": config.getfloat(
+            "adaptive", "max_mb", fallback=DEFAULT_MAX_MB
+        ),
+    }
+    logger.debug("adaptive config: %s", adaptive_config)
+    return adaptive_config
+
+
+# True when the mean of the interval rates is known within the band
+def is_converged(rates, confidence_band: float) -> bool:
+    if len(rates) < 2:
+        return False
+    mean = statistics.fmean(rates)
+    if mean <= 0:
+        return False
+    half_width = Z_95 * statistics.stdev(rates) / math.sqrt(len(rates))
+    return half_width <= confidence_band * mean
+
+
+# stop_check for ThroughputSampler. Returns why the test can stop or None
+class ConvergenceCheck:
+    def __init__(self, adaptive_config: dict) -> None:
+        self._band = adaptive_config["confidence_band"]
+        self._min_seconds = adaptive_config["min_seconds"]
+        # the hard cap for sampled_transfer()
+        self.max_bytes = int(adaptive_config["max_mb"] * 1_000_000)
+        self._rates = deque(maxlen=adaptive_config["window_samples"])
+
+    def __call__(self, elapsed: float, total_bytes: int, rate: float):
+        self._rates.append(rate)
+        if self.max_bytes and total_bytes >= self.max_bytes:
+            return STOP_BYTE_CAP
+        if (
+            elapsed >= self._min_seconds
+            and len(self._rates) == self._rates.maxlen
+            and is_converged(self._rates, self._band)
+        ):
+            return STOP_CONVERGED
+        return None
+
+
+# Span attributes for a transfer sampled with a ConvergenceCheck
+#   adaptive_stop_reason - converged, byte_cap or complete
+#   adaptive_convergence_ms - when it stopped, only if it stopped early
+#   adaptive_bytes - payload bytes moved
+#   adaptive_bytes_saved - estimate of what the full length test would
+#     have moved at the measured rate minus what was moved
+def adaptive_summary(sampler, full_length_seconds: float) -> dict:
+    moved = sampler.total_bytes
+    elapsed = sampler.samples[-1][0] / 1000.0
+    summary = {
+        "adaptive_stop_reason": sampler.stop_reason or STOP_COMPLETE,
+        "adaptive_bytes": moved,
+    }
+    saved = 0
+    if sampler.stopped_after is not None:
+        summary["adaptive_convergence_ms"] = sampler.stopped_after * 1000.0
+        if elapsed > 0 and full_length_seconds > elapsed:
+            saved = moved / elapsed * full_length_seconds - moved
+    summary["adaptive_bytes_saved"] = int(saved)
+    return summary
@@ -8,28 +8,38 @@
 # Can also enable a logger to export logs to Application Insights
 #
 #
-# This code is a useful example but is
-# hardcoded to specific fields when called as a function library
+# The exported fields, their gauges and their views all come from the
+# metric_definitions table. Meters and gauges are created once per process
+# by MetricsPublisher and reused for every result
+#
+# Only the lightweight OpenTelemetry API is imported at module load.
+# The Azure exporter and the OpenTelemetry SDK are imported when
+# register_azure_monitor() is called so --no-export runs never load them
+from __future__ import annotations
+
+import atexit
 import configparser
 import json
 
 # OpenCensus Log capture and Application Insights via logger
 import logging
 import os
+from collections import namedtuple
 from datetime import datetime
-
-# Import the `configure_azure_monitor()` function from the
-# `azure.monitor.opentelemetry` package.
-from azure.monitor.opentelemetry import configure_azure_monitor
+from typing import TYPE_CHECKING
 
 # Import the tracing api from the `opentelemetry` package.
 from opentelemetry import environment_variables, metrics, trace
 from opentelemetry.metrics import Meter
-
-# https://opentelemetry-python.readthedocs.io/en/latest/sdk/metrics.view.html
-from opentelemetry.sdk.metrics.view import View as SdkView
 from opentelemetry.trace import Tracer
 
+from MetricSpool import MetricSpool, load_spool_config
+from TailSampling import install_tail_sampler, load_sampling_config
+
+if TYPE_CHECKING:
+    # https://opentelemetry-python.readthedocs.io/en/latest/sdk/metrics.view.html # noqa: E501
+    from opentelemetry.sdk.metrics.view import View as SdkView
+
 # log_prefix = os.path.basename(__file__) + ":"
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -44,6 +54,257 @@ logging.getLogger("azure.core.pipeline.policies.http_logging_policy").setLevel(
 # exposed as customDimensions
 tag_key_isp = "client_isp"
 tag_key_server_host = "server_host"
+tag_key_dns_server = "dns_server"
+tag_key_query_host = "query_host"
+tag_key_dns_proto = "dns_proto"
+# only set when testing from more than one uplink, see SourceInterfaces.py
+tag_key_interface = "interface"
+tag_key_source_ip = "source_ip"
+
+# Set by register_azure_monitor() when the [spool] section is enabled.
+# Metrics then go to the on-disk spool instead of the OpenTelemetry meters
+_metric_spool: MetricSpool | None = None
+
+# Histogram bucket boundaries used when [histograms] is enabled.
+# Speedtest reports rates in bits per second so the Mbps boundaries
+# are scaled to match when the view is built
+DEFAULT_MS_BOUNDARIES = [1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 250, 500, 1000]
+DEFAULT_SETUP_MS_BOUNDARIES = [50, 100, 250, 500, 1000, 2000, 5000, 10000]
+DEFAULT_MBPS_BOUNDARIES = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 10000]
+DEFAULT_PERCENT_BOUNDARIES = [0, 1, 2, 5, 10, 25, 50, 100]
+DEFAULT_RATIO_BOUNDARIES = [1, 1.5, 2, 3, 5, 10, 25, 50, 100]
+DEFAULT_KB_BOUNDARIES = [16384, 32768, 65536, 131072, 262144, 524288, 1048576]
+BITS_PER_MEGABIT = 1_000_000
+
+# Meter per program
+METER_SPEEDTEST = "SpeedTest"
+METER_DNS = "DNSTest"
+
+# One row per exported metric, shared by the gauges, the views and the spool
+#   name - gauge name. OT lower cases it for the view instrument_name
+#   display_name - view name, what shows up in Application Insights
+#   meter - METER_SPEEDTEST or METER_DNS
+#   group - which part of a result the field is in
+#   field - key of the value in that part of the result
+#   boundaries, scale - default histogram buckets and their scale to the
+#     recorded units when [histograms] is enabled
+MetricDefinition = namedtuple(
+    "MetricDefinition",
+    [
+        "name",
+        "display_name",
+        "meter",
+        "group",
+        "field",
+        "unit",
+        "description",
+        "boundaries",
+        "scale",
+    ],
+)
+
+# groups of fields in a result
+GROUP_RUN = "run"
+GROUP_PROBE = "probe"
+GROUP_PARALLEL = "parallel"
+GROUP_DNS = "dns"
+GROUP_DNS_CACHE = "dns_cache"
+GROUP_DNS_SETUP = "dns_setup"
+
+# fmt: off
+metric_definitions = [
+    MetricDefinition(
+        "ST_Servers_Time", "ST Servers Time", METER_SPEEDTEST, GROUP_RUN,
+        "get_servers", "ms", "Amount of time it took to get_servers()",
+        DEFAULT_SETUP_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_Best_Servers_Time", "ST Best Servers Time", METER_SPEEDTEST,
+        GROUP_RUN, "get_best_servers", "ms",
+        "Amount of time it took to get_best_servers()",
+        DEFAULT_SETUP_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_Ping_Time", "ST Ping Time", METER_SPEEDTEST, GROUP_RUN, "ping",
+        "ms", "The latency in milliseconds per ping check",
+        DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_Upload_Rate", "ST Upload Rate", METER_SPEEDTEST, GROUP_RUN,
+        "upload", "Mbps", "Upload speed in megabits per second",
+        DEFAULT_MBPS_BOUNDARIES, BITS_PER_MEGABIT,
+    ),
+    MetricDefinition(
+        "ST_Download_Rate", "ST Download Rate", METER_SPEEDTEST, GROUP_RUN,
+        "download", "Mbps", "Download speed in megabits per second",
+        DEFAULT_MBPS_BOUNDARIES, BITS_PER_MEGABIT,
+    ),
+    MetricDefinition(
+        "ST_Upload_Peak_RSS", "ST Upload Peak RSS", METER_SPEEDTEST,
+        GROUP_RUN, "upload_rss_peak_kb", "KB",
+        "Peak resident memory of the process during the upload test",
+        DEFAULT_KB_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_Server_Upload_Rate", "ST Server Upload Rate", METER_SPEEDTEST,
+        GROUP_PARALLEL, "upload", "Mbps",
+        "Upload speed to one of the parallel servers",
+        DEFAULT_MBPS_BOUNDARIES, BITS_PER_MEGABIT,
+    ),
+    MetricDefinition(
+        "ST_Server_Download_Rate", "ST Server Download Rate",
+        METER_SPEEDTEST, GROUP_PARALLEL, "download", "Mbps",
+        "Download speed from one of the parallel servers",
+        DEFAULT_MBPS_BOUNDARIES, BITS_PER_MEGABIT,
+    ),
+    MetricDefinition(
+        "ST_Probe_Min", "ST Probe Min", METER_SPEEDTEST, GROUP_PROBE,
+        "probe_min", "ms", "Minimum latency probe time",
+        DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_Probe_Median", "ST Probe Median", METER_SPEEDTEST, GROUP_PROBE,
+        "probe_median", "ms", "Median latency probe time",
+        DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_Probe_P95", "ST Probe P95", METER_SPEEDTEST, GROUP_PROBE,
+        "probe_p95", "ms", "95th percentile latency probe time",
+        DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_Probe_P99", "ST Probe P99", METER_SPEEDTEST, GROUP_PROBE,
+        "probe_p99", "ms", "99th percentile latency probe time",
+        DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_Probe_Jitter", "ST Probe Jitter", METER_SPEEDTEST, GROUP_PROBE,
+        "probe_jitter", "ms", "Mean latency probe time variation",
+        DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_Probe_Loss", "ST Probe Loss", METER_SPEEDTEST, GROUP_PROBE,
+        "probe_loss", "%", "Percent of latency probes lost",
+        DEFAULT_PERCENT_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_DNS_Min", "ST DNS Min", METER_DNS, GROUP_DNS, "min", "ms",
+        "Minimum DNS Time", DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_DNS_Avg", "ST DNS Avg", METER_DNS, GROUP_DNS, "avg", "ms",
+        "Average DNS Time", DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_DNS_Max", "ST DNS Max", METER_DNS, GROUP_DNS, "max", "ms",
+        "Maximum DNS Time", DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_DNS_StdDev", "ST DNS StdDev", METER_DNS, GROUP_DNS, "stddev",
+        "ms", "Standard Deviation DNS Time", DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_DNS_P95", "ST DNS P95", METER_DNS, GROUP_DNS, "p95", "ms",
+        "95th Percentile DNS Time", DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_DNS_Cache_Speedup", "ST DNS Cache Speedup", METER_DNS,
+        GROUP_DNS_CACHE, "cache_speedup", "1",
+        "Median cache miss time over median cache hit time",
+        DEFAULT_RATIO_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_DNS_Miss_Penalty_P50", "ST DNS Miss Penalty P50", METER_DNS,
+        GROUP_DNS_CACHE, "miss_penalty_p50", "ms",
+        "Median DNS cache miss time less the median hit time",
+        DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_DNS_Miss_Penalty_P95", "ST DNS Miss Penalty P95", METER_DNS,
+        GROUP_DNS_CACHE, "miss_penalty_p95", "ms",
+        "95th percentile DNS cache miss time less the hit one",
+        DEFAULT_MS_BOUNDARIES, 1,
+    ),
+    MetricDefinition(
+        "ST_DNS_Setup_Time", "ST DNS Setup Time", METER_DNS,
+        GROUP_DNS_SETUP, "setup_ms", "ms",
+        "DNS connection setup time, TCP and TLS handshakes",
+        DEFAULT_MS_BOUNDARIES, 1,
+    ),
+]
+# fmt: on
+
+# Application Insights metric names for the spool
+metric_display_names = {
+    definition.name: definition.display_name
+    for definition in metric_definitions
+}
+
+
+# Read the optional [histograms] section of config.ini
+# Returns instrument name -> bucket boundaries in recorded units
+# or None when the views should keep the default last value aggregation.
+# Each instrument name can be set to a comma separated list of boundaries
+# in ms or Mbps to override the defaults
+def load_histogram_boundaries() -> dict[str, list[float]] | None:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    if not config.getboolean("histograms", "enabled", fallback=False):
+        return None
+    boundaries = {}
+    for definition in metric_definitions:
+        instrument_name = definition.name.lower()
+        configured = config.get("histograms", instrument_name, fallback="")
+        if configured:
+            values = [float(value) for value in configured.split(",")]
+        else:
+            values = definition.boundaries
+        boundaries[instrument_name] = [
+            value * definition.scale for value in values
+        ]
+    logger.debug("histogram boundaries: %s", boundaries)
+    return boundaries
+
+
+# Aggregation for a view. None keeps the SDK default (last value for gauges)
+def _view_aggregation(instrument_name: str, histogram_boundaries):
+    if not histogram_boundaries:
+        return None
+    from opentelemetry.sdk.metrics.view import (
+        ExplicitBucketHistogramAggregation,
+    )
+
+    return ExplicitBucketHistogramAggregation(
+        boundaries=histogram_boundaries[instrument_name]
+    )
+
+
+EXPORTER_AZURE = "azure"
+EXPORTER_PROMETHEUS = "prometheus"
+DEFAULT_PROMETHEUS_HOST = "127.0.0.1"
+DEFAULT_PROMETHEUS_PORT = 9464
+
+# Set by register_azure_monitor() for the prometheus exporter
+_prometheus_server = None
+
+
+# Read the optional [exporter] section of config.ini
+#   type - azure sends to Application Insights, prometheus serves the
+#     metrics locally for scraping
+def load_exporter_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    exporter_config = {
+        "type": config.get("exporter", "type", fallback=EXPORTER_AZURE),
+        "prometheus_host": config.get(
+            "exporter", "prometheus_host", fallback=DEFAULT_PROMETHEUS_HOST
+        ),
+        "prometheus_port": config.getint(
+            "exporter", "prometheus_port", fallback=DEFAULT_PROMETHEUS_PORT
+        ),
+    }
+    logger.debug("exporter config: %s", exporter_config)
+    return exporter_config
 
 
 def load_insights_key() -> str:
@@ -60,11 +321,23 @@ def load_insights_key() -> str:
 # call this if you want to send logs to Azure App Insight
 # after this,
 # every log(warn) will end up in azure as a log event "trace" !"tracing"
+# exporter is EXPORTER_AZURE or EXPORTER_PROMETHEUS, defaults to the
+# [exporter] type in config.ini. The prometheus exporter needs no
+# connection string and never imports the Azure packages
 def register_azure_monitor(
     azure_connection_string: str,
     cloud_role_name: str,
     capture_logs: bool = False,
+    exporter: str = None,
 ) -> None:
+    exporter_config = load_exporter_config()
+    exporter = exporter or exporter_config["type"]
+    if exporter == EXPORTER_PROMETHEUS:
+        _register_prometheus(cloud_role_name, exporter_config)
+        return
+    if exporter != EXPORTER_AZURE:
+        raise ValueError(f"unknown exporter {exporter}")
+
     # From <https://learn.microsoft.com/en-us/azure/azure-monitor/app/opentelemetry-configuration?tabs=python> # noqa: E501
     # Cloud Role Name
     #    uses service.namespace and service.name attributes,
@@ -92,6 +365,23 @@ def register_azure_monitor(
     # Traces can be sampled, We want all our traces.
     # os.environ["OTEL_TRACES_SAMPLER_ARG"]=1.0
 
+    # Metrics are spooled to disk and sent by flush_metric_spool() instead
+    spool_config = load_spool_config()
+    if spool_config["enabled"]:
+        global _metric_spool
+        _metric_spool = MetricSpool(
+            directory=spool_config["directory"],
+            connection_string=azure_connection_string,
+            cloud_role_name=cloud_role_name,
+            max_records=spool_config["max_records"],
+            batch_size=spool_config["batch_size"],
+            timeout_seconds=spool_config["timeout_seconds"],
+            ingestion_endpoint=spool_config["ingestion_endpoint"],
+        )
+        os.environ[environment_variables.OTEL_METRICS_EXPORTER] = "none"
+        # one shot runs drain the spool on their way out
+        atexit.register(flush_metric_spool)
+
     # Upload and download operations involve multiple HTTP packets which
     # are all captured as metrics, traces and logs if we leave
     # the urllib integration enabled
@@ -102,94 +392,128 @@ def register_azure_monitor(
     # not sure what value to put here
     # os.environ[environment_variables.LOGGER_NAME_ARG] = "__name__"
 
+    # instruments created before this belong to the old configuration
+    _publishers.clear()
+
     # coiuld inject the views but this easier for this simple program
-    _views = defineNetCheckViews() + defineDnsCheckViews()
+    histogram_boundaries = load_histogram_boundaries()
+    _views = defineNetCheckViews(histogram_boundaries) + defineDnsCheckViews(
+        histogram_boundaries
+    )
+
+    # Import the `configure_azure_monitor()` function from the
+    # `azure.monitor.opentelemetry` package. Deferred until needed because
+    # it pulls in the OpenTelemetry SDK and most of the azure sdk
+    from azure.monitor.opentelemetry import configure_azure_monitor
 
+    # the tail sampler builds its own trace and log pipelines
+    sampling_config = load_sampling_config()
     configure_azure_monitor(
         connection_string=azure_connection_string,
         disable_offline_storage=True,
         views=_views,
+        disable_tracing=sampling_config["enabled"],
+        disable_logging=sampling_config["enabled"],
     )
+    if sampling_config["enabled"]:
+        install_tail_sampler(
+            azure_connection_string, sampling_config, capture_logs
+        )
 
 
-# Views aligned with NetCheck.py
-def defineNetCheckViews() -> list[SdkView]:
-    # we accept the default aggregator which is last value for gauges
-    # instrument_name are all lower case in OT - mixed case is toLowerCase()
-    # The instrument_name must exactly match the lower case gauge name
-    # name are the view name which can be mixed case with spaces
+# Metrics only, traces and logs stay with the OpenTelemetry API no-ops
+def _register_prometheus(cloud_role_name: str, exporter_config: dict):
+    from PrometheusExporter import start_prometheus_exporter
 
-    _st_servers_time_view = SdkView(
-        instrument_name="st_servers_time",
-        name="ST Servers Time",
-        description="get servers",
-    )
-    _st_best_servers_time_view = SdkView(
-        instrument_name="st_best_servers_time",
-        name="ST Best Servers Time",
-        description="get best servers",
-    )
-    _st_ping_time_view = SdkView(
-        instrument_name="st_ping_time",
-        name="ST Ping Time",
-        description="last ping",
-    )
-    _upload_view = SdkView(
-        instrument_name="st_upload_rate",
-        name="ST Upload Rate",
-        description="last upload",
-    )
-    _download_view = SdkView(
-        instrument_name="st_download_rate",
-        name="ST Download Rate",
-        description="last download",
+    global _prometheus_server
+    _publishers.clear()
+    histogram_boundaries = load_histogram_boundaries()
+    _prometheus_server = start_prometheus_exporter(
+        exporter_config["prometheus_host"],
+        exporter_config["prometheus_port"],
+        defineNetCheckViews(histogram_boundaries)
+        + defineDnsCheckViews(histogram_boundaries),
+        cloud_role_name,
     )
 
-    views = [
-        _st_servers_time_view,
-        _st_best_servers_time_view,
-        _st_ping_time_view,
-        _upload_view,
-        _download_view,
-    ]
-    return views
 
+# Send whatever is in the metric spool. Safe to call when it is disabled
+def flush_metric_spool() -> int:
+    if _metric_spool is None:
+        return 0
+    delivered = _metric_spool.flush()
+    if delivered:
+        logger.info("sent %d spooled metrics", delivered)
+    return delivered
+
+
+# Send anything still buffered in the exporters now instead of at the
+# next export interval. --profile uses this to time the export phase
+def flush_azure_monitor() -> None:
+    flush_metric_spool()
+    # the API no-op providers do not implement flush or shutdown
+    for provider in (
+        metrics.get_meter_provider(),
+        trace.get_tracer_provider(),
+    ):
+        if hasattr(provider, "force_flush"):
+            provider.force_flush()
+
+
+# Flush anything still buffered in the exporters and release them.
+# Long running processes like NetCheck.py --daemon call this once on exit
+def shutdown_azure_monitor() -> None:
+    flush_azure_monitor()
+    for provider in (
+        metrics.get_meter_provider(),
+        trace.get_tracer_provider(),
+    ):
+        if hasattr(provider, "shutdown"):
+            provider.shutdown()
+    global _prometheus_server
+    if _prometheus_server is not None:
+        _prometheus_server.shutdown()
+        _prometheus_server = None
+
+
+# One view per metric_definitions row of the meter
+def _define_views(
+    meter_name: str, histogram_boundaries: dict[str, list[float]] | None
+) -> list[SdkView]:
+    from opentelemetry.sdk.metrics.view import View as SdkView
 
-# Views aligned with DnsCheck.py
-def defineDnsCheckViews() -> list[SdkView]:
     # we accept the default aggregator which is last value for gauges
+    # unless histogram_boundaries asks for explicit bucket histograms
+    # which keep the distribution of every value set in an export interval
     # instrument_name are all lower case in OT - mixed case is toLowerCase()
     # The instrument_name must exactly match the lower case gauge name
     # name are the view name which can be mixed case with spaces
+    return [
+        SdkView(
+            instrument_name=definition.name.lower(),
+            name=definition.display_name,
+            description=definition.description,
+            aggregation=_view_aggregation(
+                definition.name.lower(), histogram_boundaries
+            ),
+        )
+        for definition in metric_definitions
+        if definition.meter == meter_name
+    ]
 
-    _st_dns_min_view = SdkView(
-        instrument_name="st_dns_min",
-        name="ST DNS Min",
-        description="DNS ping min time",
-    )
-    _st_dns_avg_view = SdkView(
-        instrument_name="st_dns_avg",
-        name="ST DNS Avg",
-        description="DNS ping average time",
-    )
-    _st_dns_max_view = SdkView(
-        instrument_name="st_dns_max",
-        name="ST DNS Max",
-        description="DNS ping max time",
-    )
-    _st_dns_stddev_view = SdkView(
-        instrument_name="st_dns_stddev",
-        name="ST DNS StdDev",
-        description="DNS ping standard deviation",
-    )
 
-    views = [
-        _st_dns_min_view,
-        _st_dns_avg_view,
-        _st_dns_max_view,
-        _st_dns_stddev_view,
-    ]
-    return views
+# Views aligned with NetCheck.py
+def defineNetCheckViews(
+    histogram_boundaries: dict[str, list[float]] | None = None,
+) -> list[SdkView]:
+    return _define_views(METER_SPEEDTEST, histogram_boundaries)
+
+
+# Views aligned with DnsCheck.py
+def defineDnsCheckViews(
+    histogram_boundaries: dict[str, list[float]] | None = None,
+) -> list[SdkView]:
+    return _define_views(METER_DNS, histogram_boundaries)
 
 
 # Returns a meter that gauges can be connected to
@@ -205,116 +529,214 @@ def create_ot_tracer() -> Tracer:
     return tracer
 
 
+# Stands in for an OpenTelemetry gauge when metrics are spooled
+class _SpoolGauge:
+    def __init__(self, spool: MetricSpool, name: str) -> None:
+        self._spool = spool
+        self._name = metric_display_names.get(name, name)
+
+    def set(self, amount, attributes=None) -> None:
+        self._spool.add(self._name, amount, attributes or {})
+
+
+# meter.create_gauge() or its spool replacement
+def _create_gauge(meter: Meter, name: str, unit: str, description: str):
+    if _metric_spool is not None:
+        return _SpoolGauge(_metric_spool, name)
+    return meter.create_gauge(name=name, unit=unit, description=description)
+
+
+# Creates each meter and gauge once and keeps them for the life of the
+# process. A long running NetCheck.py --daemon publishes every result
+# through the same instruments instead of creating them per run
+class MetricsPublisher:
+    def __init__(self, meter_name: str) -> None:
+        self._meter = create_ot_meter(
+            meter_name=meter_name, azure_connection_string=None
+        )
+        self._definitions = {}
+        for definition in metric_definitions:
+            if definition.meter == meter_name:
+                self._definitions.setdefault(definition.group, []).append(
+                    definition
+                )
+        self._gauges = {}
+
+    def _gauge(self, definition: MetricDefinition):
+        gauge = self._gauges.get(definition.name)
+        if gauge is None:
+            gauge = _create_gauge(
+                self._meter,
+                name=definition.name,
+                unit=definition.unit,
+                description=definition.description,
+            )
+            self._gauges[definition.name] = gauge
+        return gauge
+
+    # Sets a gauge for every field of the group found in values.
+    # Returns the number of values recorded
+    def publish(self, group: str, values: dict, attributes: dict) -> int:
+        recorded = 0
+        for definition in self._definitions.get(group, []):
+            value = values.get(definition.field)
+            if value is None:
+                continue
+            self._gauge(definition).set(
+                amount=round(number=float(value), ndigits=3),
+                attributes=attributes,
+            )
+            recorded += 1
+        return recorded
+
+
+# meter name -> MetricsPublisher, reset by register_azure_monitor()
+_publishers: dict[str, MetricsPublisher] = {}
+
+
+def get_metrics_publisher(meter_name: str) -> MetricsPublisher:
+    publisher = _publishers.get(meter_name)
+    if publisher is None:
+        publisher = MetricsPublisher(meter_name)
+        _publishers[meter_name] = publisher
+    return publisher
+
+
 # Create dictionary that can be tied to ot metrics
 def _create_ot_attributes(metrics_info):  # -> dict[str, Any]:
     attributes = {
         tag_key_isp: metrics_info["client"]["isp"],
         tag_key_server_host: metrics_info["server"]["host"],
     }
+    for key in (tag_key_interface, tag_key_source_ip):
+        if metrics_info.get(key):
+            attributes[key] = metrics_info[key]
     return attributes
 
 
-# return: measurement map - primarily for testing
-def push_azure_speedtest_metrics(json_data, azure_connection_string):
+# (group, values, attributes) of every metric in a speedtest result,
+# what push_azure_speedtest_metrics() publishes
+def speedtest_metric_groups(json_data) -> list:
+    run_attributes = _create_ot_attributes(json_data)
+    values = dict(json_data)
+    # a skipped test reports 0
+    for key in ("upload", "download"):
+        if values.get(key) == 0:
+            del values[key]
+    groups = [
+        (GROUP_RUN, values, run_attributes),
+        # only present when the latency probe ran.
+        # every probe lost leaves only the loss
+        (GROUP_PROBE, json_data, run_attributes),
+    ]
+    # only present when the throughput ran against several servers.
+    # The combined rate went out as ST Download/Upload Rate,
+    # these are the per server shares tagged with each server's host
+    for server in json_data.get("parallel_servers", []):
+        groups.append(
+            (
+                GROUP_PARALLEL,
+                server,
+                {**run_attributes, tag_key_server_host: server["server_host"]},
+            )
+        )
+    return groups
 
-    meter = create_ot_meter(
-        meter_name="SpeedTest", azure_connection_string=load_insights_key()
-    )
 
-    # names are all tolower() by OT.  Left them multi cased, I don't know why
+# azure_connection_string is unused, the exporter was registered with it
+def push_azure_speedtest_metrics(json_data, azure_connection_string=None):
+    publisher = get_metrics_publisher(METER_SPEEDTEST)
+    for key in ("upload", "download"):
+        if json_data.get(key) == 0:
+            logger.info("no %s stats to report", key)
+    for group, values, attributes in speedtest_metric_groups(json_data):
+        publisher.publish(group, values, attributes)
 
-    # perf data gathered while running the test
-    get_servers_gauge = meter.create_gauge(
-        name="ST_Servers_Time",
-        unit="ms",
-        description="Amount of time it took to get_servers()",
-    )
-    get_best_servers_gauge = meter.create_gauge(
-        name="ST_Best_Servers_Time",
-        unit="ms",
-        description="Amount of time it toook to get_best_servers()",
-    )
-    # metrics always returned from the test
-    ping_gauge = meter.create_gauge(
-        name="ST_Ping_Time",
-        unit="ms",
-        description="The latency in milliseconds per ping check",
-    )
-    upload_gauge = meter.create_gauge(
-        name="ST_Upload_Rate",
-        unit="Mbps",
-        description="Upload speed in megabits per second",
-    )
-    download_gauge = meter.create_gauge(
-        name="ST_Download_Rate",
-        unit="Mbps",
-        description="Download speed in megabits per second",
-    )
 
-    run_attributes = _create_ot_attributes(json_data)
+# one time series per resolver and, in matrix mode, per queried host.
+# Per transport with --transports and per uplink when testing from several
+# sources
+def _create_dns_attributes(
+    dns_server, query_host, interface, source_ip, dns_proto=None
+):
+    attributes = {}
+    for key, value in (
+        (tag_key_dns_server, dns_server),
+        (tag_key_query_host, query_host),
+        (tag_key_dns_proto, dns_proto),
+        (tag_key_interface, interface),
+        (tag_key_source_ip, source_ip),
+    ):
+        if value:
+            attributes[key] = value
+    return attributes
 
-    get_servers_gauge.set(
-        amount=round(number=float(json_data["get_servers"]), ndigits=3),
-        attributes=run_attributes,
-    )
-    get_best_servers_gauge.set(
-        amount=round(number=float(json_data["get_best_servers"]), ndigits=3),
-        attributes=run_attributes,
+
+def push_azure_dns_metrics(
+    ping_min: float,
+    ping_average: float,
+    ping_max: float,
+    ping_stddev: float,
+    dns_server: str = None,
+    query_host: str = None,
+    ping_p95: float = None,
+    interface: str = None,
+    source_ip: str = None,
+    dns_proto: str = None,
+):
+    run_attributes = _create_dns_attributes(
+        dns_server, query_host, interface, source_ip, dns_proto
     )
-    ping_gauge.set(
-        amount=round(number=float(json_data["ping"]), ndigits=3),
-        attributes=run_attributes,
+    get_metrics_publisher(METER_DNS).publish(
+        GROUP_DNS,
+        {
+            "min": ping_min,
+            "avg": ping_average,
+            "max": ping_max,
+            "stddev": ping_stddev,
+            # percentiles need the raw times which only the matrix mode keeps
+            "p95": ping_p95,
+        },
+        run_attributes,
     )
-    if json_data["upload"] != 0:
-        upload_gauge.set(
-            amount=round(number=float(json_data["upload"]), ndigits=3),
-            attributes=run_attributes,
-        )
-    else:
-        logger.info("no upload stats to report")
-    if json_data["download"] != 0:
-        download_gauge.set(
-            amount=round(number=float(json_data["download"]), ndigits=3),
-            attributes=run_attributes,
-        )
-    else:
-        logger.info("no download stats to report")
 
 
-def push_azure_dns_metrics(
-    ping_min: float, ping_average: float, ping_max: float, ping_stddev: float
+# DnsCheck.py --cache-compare results for one resolver.
+# A resolver that only answered cached queries has no miss values
+def push_azure_dns_cache_metrics(
+    cache_speedup: float,
+    miss_penalty_p50: float,
+    miss_penalty_p95: float,
+    dns_server: str = None,
+    interface: str = None,
+    source_ip: str = None,
 ):
-    meter = create_ot_meter(
-        meter_name="DNSTest", azure_connection_string=load_insights_key()
+    get_metrics_publisher(METER_DNS).publish(
+        GROUP_DNS_CACHE,
+        {
+            "cache_speedup": cache_speedup,
+            "miss_penalty_p50": miss_penalty_p50,
+            "miss_penalty_p95": miss_penalty_p95,
+        },
+        _create_dns_attributes(dns_server, None, interface, source_ip),
     )
 
-    # perf data gathered while running the test
-    ping_min_measure = meter.create_gauge(
-        name="ST_DNS_Min",
-        unit="ms",
-        description="Minimum DNS Time",
-    )
-    ping_max_measure = meter.create_gauge(
-        name="ST_DNS_Max",
-        unit="ms",
-        description="Maximum DNS Time",
-    )
-    ping_avg_measure = meter.create_gauge(
-        name="ST_DNS_Avg",
-        unit="ms",
-        description="Average DNS Time",
-    )
-    ping_stddev_measure = meter.create_gauge(
-        name="ST_DNS_StdDev",
-        unit="ms",
-        description="Standard Deviation DNS Time",
-    )
 
-    # could create attributes here
-    ping_min_measure.set(amount=round(number=ping_min, ndigits=3))
-    ping_avg_measure.set(amount=round(number=ping_average, ndigits=3))
-    ping_max_measure.set(amount=round(number=ping_max, ndigits=3))
-    ping_stddev_measure.set(amount=round(number=ping_stddev, ndigits=3))
+# DnsCheck.py --transports connection setup time of one transport
+def push_azure_dns_setup_metrics(
+    setup_ms: float,
+    dns_server: str = None,
+    dns_proto: str = None,
+    interface: str = None,
+    source_ip: str = None,
+):
+    get_metrics_publisher(METER_DNS).publish(
+        GROUP_DNS_SETUP,
+        {"setup_ms": setup_ms},
+        _create_dns_attributes(
+            dns_server, None, interface, source_ip, dns_proto
+        ),
+    )
 
 
 # Used for testing this class - verify by lookin gin App Insights
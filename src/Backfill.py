@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Sends results that never reached Application Insights, from probes that
+# were offline or older -o files, with their original timestamps.
+#
+#   python3 NetCheck.py backfill speedtest-results
+#   python3 NetCheck.py backfill results.json --since 2024-01-01
+#
+# The inputs are json lines files, pretty printed json objects or
+# directories of either. Every stage is a generator, files are read in
+# chunks and decoded one object at a time, so memory stays the same for
+# a day or years of history. The metrics are posted straight to the
+# ingestion endpoint as the same envelopes as the [spool] with the time
+# of the run, so the OpenTelemetry exporter, which always stamps now,
+# is not involved.
+#
+# A record is written to the ledger, an on-disk dbm hash of the records
+# sent, only once every one of its metrics was accepted. A second run over
+# the same files only sends what is new and an interrupted run resumes.
+# Application Insights drops anything older than the workspace retention.
+#
+# NetCheck.py also writes the runs it exports to the ledger, but only
+# when the [spool] is enabled, which delivers them even when the uplink
+# is down. Runs exported live without the spool are not in the ledger
+# and are sent a second time. Leave them out with --since and --until,
+# for example by only backfilling the time the probe was offline.
+import argparse
+import configparser
+import dbm
+import hashlib
+import json
+import logging
+import math
+import os
+import platform
+import re
+import sys
+import time
+from datetime import datetime, timezone
+
+from AppInsights import (
+    METER_SPEEDTEST,
+    load_insights_key,
+    metric_definitions,
+    speedtest_metric_groups,
+)
+from MetricSpool import (
+    create_envelope,
+    load_spool_config,
+    parse_connection_string,
+    post_envelopes,
+    track_url,
+)
+from ResultsStore import parse_timestamp
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py backfill")
+    sys.exit(-1)
+
+DEFAULT_LEDGER_PATH = ".backfill-ledger"
+# envelopes per POST
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_RETRIES = 3
+READ_CHUNK_SIZE = 64 * 1024
+# a buffer this long that still doesn't decode is a corrupt record
+MAX_RECORD_SIZE = 1024 * 1024
+JSON_SUFFIXES = (".json", ".jsonl")
+# the live runs are sent by NetCheck.py
+CLOUD_ROLE_NAME = "NetCheck.py"
+_WHITESPACE = re.compile(r"\s*")
+
+
+# Read the optional [backfill] section of config.ini
+#   ledger - dbm file of the records already sent
+#   batch_size - envelopes per request
+def load_backfill_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    backfill_config = {
+        "ledger": config.get(
+            "backfill", "ledger", fallback=DEFAULT_LEDGER_PATH
+        ),
+        "batch_size": config.getint(
+            "backfill", "batch_size", fallback=DEFAULT_BATCH_SIZE
+        ),
+    }
+    logger.debug("backfill config: %s", backfill_config)
+    return backfill_config
+
+
+# The json files of the inputs, directories are listed one level deep
+def iter_paths(inputs: list):
+    for path in inputs:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(JSON_SUFFIXES):
+                    yield entry.path
+
+
+# Every json object in a file, json lines or pretty printed, read in
+# chunks so only the object being decoded is held in memory
+def iter_json_objects(json_file, chunk_size: int = READ_CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    while True:
+        chunk = json_file.read(chunk_size)
+        buffer += chunk
+        position = 0
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position == len(buffer):
+                break
+            try:
+                value, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # an object split by the chunk, unless it never ends
+                if chunk and len(buffer) - position < MAX_RECORD_SIZE:
+                    break
+                newline = buffer.find("\n", position + 1)
+                logger.warning(
+                    "skipping undecodable json in %s", json_file.name
+                )
+                if newline < 0:
+                    position = len(buffer)
+                    break
+                position = newline
+                continue
+            yield value
+        buffer = buffer[position:]
+        if not chunk:
+            return
+
+
+def iter_records(paths):
+    for path in paths:
+        with open(path, encoding="utf-8") as json_file:
+            yield from iter_json_objects(json_file)
+
+
+# Identifies a run whichever file it came from. The -o json and the
+# record NetCheck.py exports carry different extra fields, the
+# speedtest.net timestamp, server and client are the same in both
+def record_key(record: dict) -> bytes:
+    run = [
+        record.get("timestamp"),
+        (record.get("server") or {}).get("id"),
+        (record.get("client") or {}).get("ip"),
+    ]
+    return hashlib.sha256(
+        json.dumps(run, separators=(",", ":")).encode("utf-8")
+    ).digest()
+
+
+# NetCheck.py records a run it handed to the [spool] so backfill doesn't
+# send it again. A backfill holding the ledger only costs a warning
+def record_exported(record: dict, ledger_path: str) -> None:
+    try:
+        with dbm.open(ledger_path, "c") as ledger:
+            ledger[record_key(record)] = b""
+    except dbm.error as e:
+        logger.warning("could not record the run in %s: %s", ledger_path, e)
+
+
+# (key, envelopes) of every record in the time range that isn't in the
+# ledger. Records without a timestamp or metrics are skipped
+def iter_pending(records, ledger, envelope_args: dict, start, end):
+    definitions = {}
+    for definition in metric_definitions:
+        if definition.meter == METER_SPEEDTEST:
+            definitions.setdefault(definition.group, []).append(definition)
+    for record in records:
+        if not isinstance(record, dict) or "timestamp" not in record:
+            logger.warning("skipping record without a timestamp")
+            continue
+        timestamp = parse_timestamp(record["timestamp"])
+        if not start <= timestamp < end:
+            continue
+        key = record_key(record)
+        if key in ledger:
+            continue
+        iso_timestamp = datetime.fromtimestamp(
+            timestamp, tz=timezone.utc
+        ).isoformat()
+        envelopes = [
+            create_envelope(
+                definition.display_name,
+                round(float(values[definition.field]), 3),
+                attributes,
+                timestamp=iso_timestamp,
+                **envelope_args,
+            )
+            for group, values, attributes in speedtest_metric_groups(record)
+            for definition in definitions.get(group, [])
+            if values.get(definition.field) is not None
+        ]
+        if envelopes:
+            yield key, envelopes
+
+
+# Groups records into batches of about batch_size envelopes. A record is
+# never split so it is either all sent or not at all. The ledger only
+# catches repeats once their batch was sent, repeats within one are
+# dropped here
+def iter_batches(pending, batch_size: int):
+    batch = []
+    keys = set()
+    size = 0
+    for key, envelopes in pending:
+        if key in keys:
+            continue
+        batch.append((key, envelopes))
+        keys.add(key)
+        size += len(envelopes)
+        if size >= batch_size:
+            yield batch
+            batch = []
+            keys = set()
+            size = 0
+    if batch:
+        yield batch
+
+
+# POST a batch, resending the retryable failures with a backoff.
+# Returns the keys of the records that were fully accepted and
+# whether anything still failed after the retries
+def send_batch(url: str, batch: list, timeout_seconds, retries: int):
+    pending = [
+        (key, envelope) for key, envelopes in batch for envelope in envelopes
+    ]
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(2**attempt)
+        keep = post_envelopes(
+            url, [envelope for _, envelope in pending], timeout_seconds
+        )
+        pending = [pending[position] for position in sorted(keep)]
+        if not pending:
+            break
+    failed = {key for key, _ in pending}
+    accepted = [key for key, _ in batch if key not in failed]
+    return accepted, bool(failed)
+
+
+def backfill_main(argv: list) -> int:
+    backfill_config = load_backfill_config()
+    parser = argparse.ArgumentParser(
+        prog="NetCheck backfill",
+        description="Send old json results to Application Insights "
+        "with their original timestamps. Runs NetCheck.py exported "
+        "through the [spool] are in the ledger and skipped, runs it "
+        "exported without the spool are sent again unless --since and "
+        "--until leave them out.",
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="+",
+        help="json lines files, json files or directories of them",
+    )
+    parser.add_argument(
+        "--since", default=None, help="iso timestamp, inclusive"
+    )
+    parser.add_argument(
+        "--until", default=None, help="iso timestamp, exclusive"
+    )
+    parser.add_argument(
+        "--ledger",
+        default=backfill_config["ledger"],
+        help="records already sent, defaults to [backfill] ledger",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=backfill_config["batch_size"],
+        help="metrics per request",
+    )
+    parser.add_argument(
+        "--role-instance",
+        default=platform.node(),
+        help="cloud role instance of the probe the results came from, "
+        "defaults to this host",
+    )
+    parser.add_argument(
+        "--dry-run",
+        default=False,
+        help="count what would be sent without sending or recording it",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
+
+    start = parse_timestamp(args.since) if args.since else -math.inf
+    end = parse_timestamp(args.until) if args.until else math.inf
+    connection_string = load_insights_key()
+    spool_config = load_spool_config()
+    url = track_url(connection_string, spool_config["ingestion_endpoint"])
+    envelope_args = {
+        "instrumentation_key": parse_connection_string(connection_string).get(
+            "instrumentationkey", ""
+        ),
+        "cloud_role_name": CLOUD_ROLE_NAME,
+        "role_instance": args.role_instance,
+    }
+
+    records_sent = 0
+    metrics_sent = 0
+    with dbm.open(args.ledger, "c") as ledger:
+        pending = iter_pending(
+            iter_records(iter_paths(args.inputs)),
+            ledger,
+            envelope_args,
+            start,
+            end,
+        )
+        for batch in iter_batches(pending, args.batch_size):
+            if args.dry_run:
+                records_sent += len(batch)
+                metrics_sent += sum(len(envelopes) for _, envelopes in batch)
+                continue
+            accepted, failed = send_batch(
+                url, batch, spool_config["timeout_seconds"], DEFAULT_RETRIES
+            )
+            for key in accepted:
+                ledger[key] = b""
+            records_sent += len(accepted)
+            metrics_sent += sum(
+                len(envelopes) for key, envelopes in batch if key in accepted
+            )
+            logger.info("%d records sent", records_sent)
+            if failed:
+                logger.error("ingestion endpoint failing, run again to resume")
+                return 1
+    logger.info(
+        "%s %d records, %d metrics",
+        "would send" if args.dry_run else "sent",
+        records_sent,
+        metrics_sent,
+    )
+    return 0
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Degradation triggered up/down tests for NetCheck.py --daemon.
+#
+# The scheduled up/down test runs every few hours whatever the link is
+# doing. DegradationTrigger watches the ping and DNS times the frequent
+# jobs already measure and asks for an up/down test right away when they
+# move away from their recent baseline.
+#
+# A sample breaches when it is above the absolute threshold for its
+# series, or when it is above the baseline median by all of
+#   ratio times the median
+#   min_increase_ms
+#   mad_factor robust standard deviations, from the median absolute
+#     deviation
+# confirm_samples breaching samples in a row, or failed measurements,
+# are a degradation. Triggered tests are limited by a cooldown and a
+# maximum per rolling day. Every sample goes into the baseline so a
+# lasting change becomes the new normal instead of triggering forever.
+# Every uplink tested with [interfaces] sources has its own baselines.
+from __future__ import annotations
+
+import configparser
+import logging
+import statistics
+import sys
+import time
+from collections import deque
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py --daemon")
+    sys.exit(-1)
+
+SERIES_PING = "ping"
+SERIES_DNS = "dns"
+
+DEFAULT_BASELINE_SAMPLES = 20
+DEFAULT_CONFIRM_SAMPLES = 2
+DEFAULT_RATIO = 1.5
+DEFAULT_MIN_INCREASE_MS = 10.0
+DEFAULT_MAD_FACTOR = 4.0
+DEFAULT_COOLDOWN_SECONDS = 30 * 60
+DEFAULT_MAX_PER_DAY = 6
+# scales the median absolute deviation to a normal standard deviation
+MAD_TO_SIGMA = 1.4826
+DAY_SECONDS = 24 * 60 * 60
+
+
+# Read the optional [trigger] section of config.ini
+#   <series>_threshold_ms - absolute limit for ping or dns, 0 is none
+def load_trigger_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    trigger_config = {
+        "enabled": config.getboolean("trigger", "enabled", fallback=False),
+        "baseline_samples": config.getint(
+            "trigger", "baseline_samples", fallback=DEFAULT_BASELINE_SAMPLES
+        ),
+        "confirm_samples": config.getint(
+            "trigger", "confirm_samples", fallback=DEFAULT_CONFIRM_SAMPLES
+        ),
+        "ratio": config.getfloat("trigger", "ratio", fallback=DEFAULT_RATIO),
+        "min_increase_ms": config.getfloat(
+            "trigger", "min_increase_ms", fallback=DEFAULT_MIN_INCREASE_MS
+        ),
+        "mad_factor": config.getfloat(
+            "trigger", "mad_factor", fallback=DEFAULT_MAD_FACTOR
+        ),
+        "thresholds_ms": {
+            series: config.getfloat(
+                "trigger", f"{series}_threshold_ms", fallback=0.0
+            )
+            for series in (SERIES_PING, SERIES_DNS)
+        },
+        "cooldown_seconds": config.getfloat(
+            "trigger", "cooldown_seconds", fallback=DEFAULT_COOLDOWN_SECONDS
+        ),
+        "max_per_day": config.getint(
+            "trigger", "max_per_day", fallback=DEFAULT_MAX_PER_DAY
+        ),
+    }
+    logger.debug("trigger config: %s", trigger_config)
+    return trigger_config
+
+
+class DegradationTrigger:
+    def __init__(self, trigger_config: dict, clock=time.monotonic) -> None:
+        self._config = trigger_config
+        self._clock = clock
+        self._baselines = {}
+        self._breaches = {}
+        # times of the tests triggered in the last day
+        self._triggered = deque()
+
+    # Why a sample breaches its series baseline, None when it doesn't
+    def _breach(self, series: str, value, baseline) -> str | None:
+        if value is None:
+            return f"{series} failed"
+        threshold = self._config["thresholds_ms"].get(series, 0)
+        if threshold and value > threshold:
+            return f"{series} {value:.1f}ms over {threshold:.1f}ms"
+        # half a window is enough to start comparing
+        if len(baseline) < max(self._config["baseline_samples"] // 2, 2):
+            return None
+        median = statistics.median(baseline)
+        deviation = statistics.median(abs(x - median) for x in baseline)
+        limit = max(
+            median * self._config["ratio"],
+            median + self._config["min_increase_ms"],
+            median + self._config["mad_factor"] * MAD_TO_SIGMA * deviation,
+        )
+        if value > limit:
+            return f"{series} {value:.1f}ms over baseline {median:.1f}ms"
+        return None
+
+    # Cooldown and daily budget. Returns why a test can't run now
+    def _held_back(self, now: float) -> str | None:
+        while self._triggered and now - self._triggered[0] >= DAY_SECONDS:
+            self._triggered.popleft()
+        if len(self._triggered) >= self._config["max_per_day"]:
+            return "daily limit reached"
+        if (
+            self._triggered
+            and now - self._triggered[-1] < self._config["cooldown_seconds"]
+        ):
+            return "cooling down"
+        return None
+
+    # Record a ping or dns time in ms, None for a failed measurement.
+    # interface names the uplink the time was measured over, if any.
+    # Returns the reason when an up/down test should run now
+    def observe(self, series: str, value, interface=None) -> str | None:
+        key = (series, interface)
+        baseline = self._baselines.setdefault(
+            key, deque(maxlen=self._config["baseline_samples"])
+        )
+        reason = self._breach(series, value, baseline)
+        if reason is not None and interface:
+            reason = f"{interface} {reason}"
+        if value is not None:
+            baseline.append(value)
+        if reason is None:
+            self._breaches[key] = 0
+            return None
+        self._breaches[key] = self._breaches.get(key, 0) + 1
+        if self._breaches[key] < self._config["confirm_samples"]:
+            logger.info("possible degradation: %s", reason)
+            return None
+        now = self._clock()
+        held_back = self._held_back(now)
+        if held_back:
+            logger.info("degradation %s, no test: %s", reason, held_back)
+            return None
+        self._breaches[key] = 0
+        self._triggered.append(now)
+        return reason
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# How much each resolver's cache saves. Run with DnsCheck.py --cache-compare
+#
+# Every resolver gets two query series at the same time. The cached series
+# asks for the query host, which the resolver has cached after the first
+# answer. The miss series asks for a random name under the query host so
+# every answer has to come from the authoritative servers. Both series run
+# side by side so the comparison takes about as long as the regular check.
+import logging
+import statistics
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from AppInsights import push_azure_dns_cache_metrics, push_azure_dns_metrics
+from DnsCheck import DEFAULT_MAX_WORKERS, DEFAULT_QUERY_COUNT, resolve_server
+from DnsMatrix import percentile, query_once, summarize_times
+from SourceInterfaces import source_attributes
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run DnsCheck.py --cache-compare")
+    sys.exit(-1)
+
+
+# count single queries so the raw times are kept for the percentiles
+def _query_series(resolver, query_host_name, count, force_miss, src_ip):
+    times = []
+    for _ in range(count):
+        elapsed = query_once(resolver, query_host_name, force_miss, src_ip)
+        if elapsed is not None:
+            times.append(elapsed)
+    return times
+
+
+# Cached and miss statistics of one resolver plus
+#   cache_speedup - median miss time over median cached time
+#   miss_penalty_p50, miss_penalty_p95 - how much slower the miss
+#     percentile is than the cached one in ms
+# None when no cached query was answered
+def compare_times(hit_times: list, miss_times: list, count: int):
+    hit = summarize_times(hit_times, count)
+    if hit is None:
+        return None
+    comparison = {"hit": hit, "miss": summarize_times(miss_times, count)}
+    if comparison["miss"] is None:
+        return comparison
+    hit_sorted = sorted(hit_times)
+    miss_sorted = sorted(miss_times)
+    hit_median = statistics.median(hit_sorted)
+    miss_median = statistics.median(miss_sorted)
+    comparison.update(
+        {
+            "cache_speedup": (
+                miss_median / hit_median if hit_median > 0 else None
+            ),
+            "miss_penalty_p50": miss_median - hit_median,
+            "miss_penalty_p95": percentile(miss_sorted, 95)
+            - percentile(hit_sorted, 95),
+        }
+    )
+    return comparison
+
+
+# Returns {resolver: compare_times()} in configured order.
+# Resolvers that answered no cached query are left out
+def measure_dns_cache(
+    dns_server_list,
+    query_host_name,
+    count=DEFAULT_QUERY_COUNT,
+    max_concurrency=DEFAULT_MAX_WORKERS,
+    src_ip=None,
+) -> dict:
+    resolvers = []
+    for server in dns_server_list:
+        resolver = resolve_server(server)
+        if resolver and resolver not in resolvers:
+            resolvers.append(resolver)
+    if not resolvers:
+        return {}
+
+    # two series per resolver
+    with ThreadPoolExecutor(
+        max_workers=2 * min(max_concurrency, len(resolvers)),
+        thread_name_prefix="DnsCache",
+    ) as executor:
+        futures = {
+            (resolver, force_miss): executor.submit(
+                _query_series,
+                resolver,
+                query_host_name,
+                count,
+                force_miss,
+                src_ip,
+            )
+            for resolver in resolvers
+            for force_miss in (False, True)
+        }
+    results = {}
+    for resolver in resolvers:
+        comparison = compare_times(
+            futures[(resolver, False)].result(),
+            futures[(resolver, True)].result(),
+            count,
+        )
+        if comparison is not None:
+            results[resolver] = comparison
+    return results
+
+
+def log_dns_cache(results: dict) -> None:
+    for resolver, comparison in results.items():
+        hit = comparison["hit"]
+        miss = comparison["miss"]
+        if miss is None:
+            logger.info(
+                "server:%-15s hit avg=%-8.3f p95=%-8.3f no miss answered"
+                % (resolver, hit["avg"], hit["p95"])
+            )
+            continue
+        logger.info(
+            "server:%-15s hit avg=%-8.3f p95=%-8.3f  miss avg=%-8.3f "
+            "p95=%-8.3f  speedup=%.1fx  penalty p50=%-8.3f p95=%-8.3f"
+            % (
+                resolver,
+                hit["avg"],
+                hit["p95"],
+                miss["avg"],
+                miss["p95"],
+                comparison["cache_speedup"] or 0.0,
+                comparison["miss_penalty_p50"],
+                comparison["miss_penalty_p95"],
+            )
+        )
+
+
+# The cached series goes out as the regular ST DNS metrics and the
+# comparison as the cache gauges, all tagged with dns_server.
+# Assumes register_azure_monitor() has already been called.
+def push_dns_cache(results: dict, source=None) -> None:
+    for resolver, comparison in results.items():
+        hit = comparison["hit"]
+        push_azure_dns_metrics(
+            ping_min=hit["min"],
+            ping_average=hit["avg"],
+            ping_max=hit["max"],
+            ping_stddev=hit["stddev"],
+            dns_server=resolver,
+            ping_p95=hit["p95"],
+            **source_attributes(source),
+        )
+        if comparison["miss"] is not None:
+            push_azure_dns_cache_metrics(
+                cache_speedup=comparison["cache_speedup"],
+                miss_penalty_p50=comparison["miss_penalty_p50"],
+                miss_penalty_p95=comparison["miss_penalty_p95"],
+                dns_server=resolver,
+                **source_attributes(source),
+            )
@@ -4,19 +4,28 @@
 # SPDX-License-Identifier: MIT
 #
 
+import argparse
+import configparser
 import ipaddress
 import logging
 import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # these come from dnsdiag - we're making use of their internal modules
 import util.dns
 from util.dns import PROTO_UDP
 
 from AppInsights import (
+    EXPORTER_AZURE,
+    EXPORTER_PROMETHEUS,
+    create_ot_tracer,
+    flush_azure_monitor,
+    load_exporter_config,
     load_insights_key,
     push_azure_dns_metrics,
     register_azure_monitor,
 )
+from SourceInterfaces import source_attributes
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("DnsUtil")
@@ -24,102 +33,381 @@ logger = logging.getLogger("DnsUtil")
 # code based on https://github.com/farrokhi/dnsdiag/blob/master/dnseval.py
 
 
-# NOTE: future work - send this to application insights
-# TODO: This accepts a list of dns servers but returns after the first one
-# does a dns lookup and returns the times
-def ping_me(dns_server_list, query_host_name, should_force_miss):
+# Servers and host used when config.ini has no [dns] section
+DEFAULT_DNS_SERVERS = ["8.8.4.4", "8.8.8.8"]
+DEFAULT_QUERY_HOST = "wikipedia.org"
+# queries per resolver per run
+DEFAULT_QUERY_COUNT = 10
+# upper bound on resolvers tested at the same time
+DEFAULT_MAX_WORKERS = 8
+# matrix mode pacing of queries sent to any single resolver
+DEFAULT_QUERIES_PER_SECOND = 10.0
 
+
+# comma separated config value to list
+def _config_list(config, option, fallback):
+    value = config.get("dns", option, fallback=None)
+    if value is None:
+        return list(fallback)
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+# Read the optional [dns] section of config.ini
+def load_dns_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    dns_config = {
+        "servers": _config_list(config, "servers", DEFAULT_DNS_SERVERS),
+        "query_hosts": _config_list(
+            config, "query_hosts", [DEFAULT_QUERY_HOST]
+        ),
+        "count": config.getint("dns", "count", fallback=DEFAULT_QUERY_COUNT),
+        "max_concurrency": config.getint(
+            "dns", "max_concurrency", fallback=DEFAULT_MAX_WORKERS
+        ),
+        "queries_per_second": config.getfloat(
+            "dns", "queries_per_second", fallback=DEFAULT_QUERIES_PER_SECOND
+        ),
+        "cache_compare": config.getboolean(
+            "dns", "cache_compare", fallback=False
+        ),
+    }
+    logger.debug("dns config: %s", dns_config)
+    return dns_config
+
+
+# Returns the resolver ip address for a server entry or None
+def resolve_server(server):
+    # check if we have a valid dns server address
+    if server.lstrip() == "":  # deal with empty lines
+        return None
+    server = server.replace(" ", "")
+    try:
+        ipaddress.ip_address(server)
+    except (
+        ValueError
+    ):  # not a valid IPv4 or IPv6 address, so try to resolve host name
+        try:
+            return socket.getaddrinfo(server, port=None)[1][4][0]
+        except OSError:
+            logger.warning("Error: cannot resolve hostname: %s", server)
+        except Exception:
+            pass
+        return None
+    return server
+
+
+# does a series of dns lookups against one resolver and returns the times
+# (rcode, min, avg, max, stddev) or None if the resolver could not be tested
+def _ping_resolver(
+    resolver,
+    query_host_name,
+    should_force_miss,
+    count=DEFAULT_QUERY_COUNT,
+    src_ip=None,
+):
     # defaults
     rdatatype = "A"
     proto = PROTO_UDP
-    src_ip = None
     dst_port = 53  # default for UDP and TCP
-    count = 10
     waittime = 2
     use_edns = True
     want_dnssec = False
 
-    # dns_server_list = dns.resolver.get_default_resolver().nameservers
-    # logger.info("%s",f)
+    try:
+        retval = util.dns.ping(
+            query_host_name,
+            resolver,
+            dst_port,
+            rdatatype,
+            waittime,
+            count,
+            proto,
+            src_ip,
+            use_edns=use_edns,
+            force_miss=should_force_miss,
+            want_dnssec=want_dnssec,
+        )
+    # dnsdiag calls sys.exit() for unsupported features
+    except SystemExit:
+        logger.error("%s: unsupported query", resolver)
+        return None
+    except Exception as e:
+        logger.error("%s: %s" % (resolver, e))
+        return None
+    return (
+        retval.rcode,
+        retval.r_min,
+        retval.r_avg,
+        retval.r_max,
+        retval.r_stddev,
+    )
 
-    for server in dns_server_list:
-        # check if we have a valid dns server address
-        if server.lstrip() == "":  # deal with empty lines
-            continue
-        server = server.replace(" ", "")
-        try:
-            ipaddress.ip_address(server)
-        except (
-            ValueError
-        ):  # not a valid IPv4 or IPv6 address, so try to resolve host name
-            try:
-                resolver = socket.getaddrinfo(server, port=None)[1][4][0]
-            except OSError:
-                logger.warn("Error: cannot resolve hostname: %s", server)
-                resolver = None
-            except Exception:
-                pass
-        else:
-            resolver = server
 
-        if not resolver:
-            continue
+# Tests every resolver in the list concurrently.
+# Wall time is close to the slowest resolver rather than the sum of them.
+# Returns a dict of resolver address ->  (rcode, min, avg, max, stddev)
+# Resolvers that could not be tested are left out.
+# src_ip sends the queries from one local address, None lets the kernel pick
+def ping_me(
+    dns_server_list,
+    query_host_name,
+    should_force_miss,
+    max_workers=DEFAULT_MAX_WORKERS,
+    count=DEFAULT_QUERY_COUNT,
+    src_ip=None,
+):
+    # dns_server_list = dns.resolver.get_default_resolver().nameservers
+    resolvers = []
+    for server in dns_server_list:
+        resolver = resolve_server(server)
+        if resolver and resolver not in resolvers:
+            resolvers.append(resolver)
+    if not resolvers:
+        return {}
 
-        try:
-            retval = util.dns.ping(
-                query_host_name,
+    results = {}
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(resolvers)),
+        thread_name_prefix="DnsCheck",
+    ) as executor:
+        futures = {
+            executor.submit(
+                _ping_resolver,
                 resolver,
-                dst_port,
-                rdatatype,
-                waittime,
+                query_host_name,
+                should_force_miss,
                 count,
-                proto,
                 src_ip,
-                use_edns=use_edns,
-                force_miss=should_force_miss,
-                want_dnssec=want_dnssec,
-            )
-            # TODO this is broken. It returns after the fist server is tested
-            return (
-                retval.rcode,
-                retval.r_min,
-                retval.r_avg,
-                retval.r_max,
-                retval.r_stddev,
-            )
+            ): resolver
+            for resolver in resolvers
+        }
+        for future in as_completed(futures):
+            result = future.result()
+            if result is not None:
+                results[futures[future]] = result
+    # report in configured order rather than completion order
+    return {
+        resolver: results[resolver]
+        for resolver in resolvers
+        if resolver in results
+    }
 
-        except SystemExit:
-            break
-        except Exception as e:
-            logger.error("%s: %s" % (server, e))
-            continue
 
-
-if __name__ == "__main__":
-    return_code, ping_min, ping_average, ping_max, ping_stddev = ping_me(
-        ["8.8.4.4", "8.8.8.8"], "wikipedia.org", False
+# Run one DNS check against every server and log the times.
+# The servers and host default to the [dns] section of config.ini
+# Returns a dict of resolver address -> ping_me() tuple
+# containing only the resolvers that answered cleanly
+def measure_dns(
+    dns_server_list=None,
+    query_host_name=None,
+    should_force_miss=False,
+    src_ip=None,
+):
+    dns_config = load_dns_config()
+    dns_server_list = dns_server_list or dns_config["servers"]
+    query_host_name = query_host_name or dns_config["query_hosts"][0]
+    results = ping_me(
+        dns_server_list,
+        query_host_name,
+        should_force_miss,
+        max_workers=dns_config["max_concurrency"],
+        count=dns_config["count"],
+        src_ip=src_ip,
     )
+    if not results:
+        logger.warning("no dns server in %s responded", dns_server_list)
 
     # sample times on FIOS DC and Medicom DE are
     #  FIOS:     return_code:0  min=0.408  avg=0.500  max=0.730  std-dev=0.090
     #  MediaCom: return_code:0  min=35.032 avg=37.418 max=39.587 std-dev=1.654
     #  MediaCom: return_code:0  min=35.013 avg=42.450 max=59.062 std-dev=7.504
-    logger.info(
-        "return_code:%d   min=%-8.3f  avg=%-8.3f  max=%-8.3f  std-dev=%-8.3f"
-        % (return_code, ping_min, ping_average, ping_max, ping_stddev)
-    )
-
-    if return_code == 0:
-        azure_instrumentation_key = load_insights_key()
-        # Enable open tracing
-        register_azure_monitor(
-            azure_connection_string=azure_instrumentation_key,
-            cloud_role_name="DnsCheck.py",
+    clean_results = {}
+    for dns_server, result in results.items():
+        return_code, ping_min, ping_average, ping_max, ping_stddev = result
+        logger.info(
+            "%sserver:%-15s return_code:%d   min=%-8.3f  avg=%-8.3f  "
+            "max=%-8.3f  std-dev=%-8.3f"
+            % (
+                f"from:{src_ip} " if src_ip else "",
+                dns_server,
+                return_code,
+                ping_min,
+                ping_average,
+                ping_max,
+                ping_stddev,
+            )
         )
+        if return_code == 0:
+            clean_results[dns_server] = result
+    return clean_results
+
+
+# Push measure_dns() results to Application Insights.
+# Assumes register_azure_monitor() has already been called.
+# source is the SourceInterfaces.Source the results were measured from
+def push_dns_result(results, source=None) -> None:
+    for dns_server, result in results.items():
+        return_code, ping_min, ping_average, ping_max, ping_stddev = result
         # use the functions inside AppInsights.py
         push_azure_dns_metrics(
             ping_min=ping_min,
             ping_average=ping_average,
             ping_max=ping_max,
             ping_stddev=ping_stddev,
+            dns_server=dns_server,
+            **source_attributes(source),
         )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="DnsCheck",
+        description="DNS resolver latency checks using dnsdiag.",
+    )
+    parser.add_argument(
+        "-m",
+        "--matrix",
+        default=False,
+        help="measure every [dns] query_hosts entry against every "
+        "[dns] servers entry in config.ini",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache-compare",
+        default=False,
+        help="compare cached and forced cache miss query times per "
+        "resolver, also enabled by [dns] cache_compare in config.ini",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-t",
+        "--transports",
+        default=False,
+        help="compare the [dns] transports, udp, tcp, dot and doh, "
+        "against every resolver",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-n",
+        "--no-export",
+        default=False,
+        help="local only, never load the Azure exporter",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        help="record CPU time, context switches and memory per phase and "
+        "write pstats files to the [profile] directory",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    exporter_type = load_exporter_config()["type"]
+    # The profile attributes only reach Application Insights on recording
+    # spans, so with --profile the exporter is registered before the first
+    profile_export = (
+        args.profile and not args.no_export and exporter_type == EXPORTER_AZURE
+    )
+    if profile_export:
+        register_azure_monitor(
+            azure_connection_string=load_insights_key(),
+            cloud_role_name="DnsCheck.py",
+        )
+
+    # spans only measure anything with --profile
+    tracer = create_ot_tracer()
+    if args.profile:
+        from ResourceUsage import PhaseTracer, load_profile_config
+
+        tracer = PhaseTracer(
+            tracer, profile_directory=load_profile_config()["directory"]
+        )
+
+    cache_results = None
+    transport_results = None
+    with tracer.start_as_current_span(name="measure_dns"):
+        if args.matrix:
+            from DnsMatrix import (
+                log_dns_matrix,
+                measure_dns_matrix,
+                push_dns_matrix,
+            )
+
+            dns_config = load_dns_config()
+            matrix = measure_dns_matrix(
+                dns_config["servers"],
+                dns_config["query_hosts"],
+                count=dns_config["count"],
+                max_concurrency=dns_config["max_concurrency"],
+                queries_per_second=dns_config["queries_per_second"],
+            )
+            log_dns_matrix(matrix)
+            should_push = bool(matrix)
+        elif args.transports:
+            from DnsTransport import (
+                load_dns_transport_config,
+                log_dns_transports,
+                measure_dns_transports,
+                push_dns_transports,
+            )
+
+            dns_config = load_dns_config()
+            transport_results = measure_dns_transports(
+                dns_config["servers"],
+                dns_config["query_hosts"][0],
+                load_dns_transport_config(),
+                count=dns_config["count"],
+                max_concurrency=dns_config["max_concurrency"],
+            )
+            log_dns_transports(transport_results)
+            should_push = bool(transport_results)
+        elif args.cache_compare or load_dns_config()["cache_compare"]:
+            from DnsCacheCompare import (
+                log_dns_cache,
+                measure_dns_cache,
+                push_dns_cache,
+            )
+
+            dns_config = load_dns_config()
+            cache_results = measure_dns_cache(
+                dns_config["servers"],
+                dns_config["query_hosts"][0],
+                count=dns_config["count"],
+                max_concurrency=dns_config["max_concurrency"],
+            )
+            log_dns_cache(cache_results)
+            should_push = bool(cache_results)
+        else:
+            results = measure_dns()
+            should_push = bool(results)
+
+    # a one shot run exits before it could be scraped
+    if should_push and exporter_type == EXPORTER_PROMETHEUS:
+        logger.warning("prometheus metrics are served by NetCheck.py --daemon")
+        should_push = False
+    # The Azure exporter is only imported if there is something to send
+    if should_push and not args.no_export:
+        with tracer.start_as_current_span(name="export"):
+            if not profile_export:
+                azure_instrumentation_key = load_insights_key()
+                # Enable open tracing
+                register_azure_monitor(
+                    azure_connection_string=azure_instrumentation_key,
+                    cloud_role_name="DnsCheck.py",
+                )
+            if args.matrix:
+                push_dns_matrix(matrix)
+            elif transport_results is not None:
+                push_dns_transports(transport_results)
+            elif cache_results is not None:
+                push_dns_cache(cache_results)
+            else:
+                push_dns_result(results)
+            # metrics are otherwise sent on exit, outside the export span
+            if args.profile:
+                flush_azure_monitor()
+    if args.profile:
+        tracer.log_phases()
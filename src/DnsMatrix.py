@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Resolver x hostname DNS latency matrix. Run with DnsCheck.py --matrix
+#
+# Every (resolver, host) cell is a series of single queries so we keep the
+# raw times for percentiles. The cells share one worker pool and every
+# resolver has its own pacing so we don't look like a flood to it.
+import logging
+import math
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# these come from dnsdiag - we're making use of their internal modules
+import util.dns
+from util.dns import PROTO_UDP
+
+from AppInsights import push_azure_dns_metrics
+from DnsCheck import (
+    DEFAULT_MAX_WORKERS,
+    DEFAULT_QUERIES_PER_SECOND,
+    DEFAULT_QUERY_COUNT,
+    resolve_server,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run DnsCheck.py --matrix")
+    sys.exit(-1)
+
+# dns.rcode values
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+
+# Spaces out calls so a resolver sees at most queries_per_second
+# Shared by every worker querying the same resolver
+class _RateLimiter:
+    def __init__(self, queries_per_second: float) -> None:
+        self._interval = 1.0 / queries_per_second
+        self._next_slot = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# nearest rank percentile of an already sorted list
+def percentile(sorted_times: list, percent: float) -> float:
+    rank = math.ceil(percent / 100.0 * len(sorted_times))
+    return sorted_times[max(rank, 1) - 1]
+
+
+# summary statistics for one cell. None if every query failed
+def summarize_times(times: list, sent: int):
+    if not times:
+        return None
+    sorted_times = sorted(times)
+    return {
+        "min": sorted_times[0],
+        "avg": statistics.fmean(sorted_times),
+        "max": sorted_times[-1],
+        "stddev": statistics.stdev(sorted_times) if len(times) > 1 else 0.0,
+        "p95": percentile(sorted_times, 95),
+        "lost_percent": 100.0 * (sent - len(times)) / sent,
+    }
+
+
+# A single query. Returns the response time in msec or None on failure.
+# A forced miss asks for a random name under the host, the NXDOMAIN
+# answer still had to come from the authoritative servers
+def query_once(resolver, query_host_name, force_miss=False, src_ip=None):
+    try:
+        retval = util.dns.ping(
+            query_host_name,
+            resolver,
+            53,
+            "A",
+            2,
+            1,
+            PROTO_UDP,
+            src_ip,
+            use_edns=True,
+            force_miss=force_miss,
+            want_dnssec=False,
+        )
+    # dnsdiag calls sys.exit() for unsupported features
+    except SystemExit:
+        return None
+    except Exception as e:
+        logger.debug("%s %s: %s", resolver, query_host_name, e)
+        return None
+    answered = (
+        (RCODE_NOERROR, RCODE_NXDOMAIN) if force_miss else (RCODE_NOERROR,)
+    )
+    if retval.rcode not in answered or retval.r_lost_percent > 0:
+        return None
+    return retval.r_avg
+
+
+# One cell of the matrix, count paced queries
+# A limiter of None sends them back to back
+def _query_series(resolver, query_host_name, count, limiter: _RateLimiter):
+    times = []
+    for _ in range(count):
+        if limiter is not None:
+            limiter.wait()
+        elapsed = query_once(resolver, query_host_name)
+        if elapsed is not None:
+            times.append(elapsed)
+    return summarize_times(times, count)
+
+
+# Returns {resolver: {query_host: cell stats}}
+# Cells where every query failed are left out
+def measure_dns_matrix(
+    dns_server_list,
+    query_host_names,
+    count=DEFAULT_QUERY_COUNT,
+    max_concurrency=DEFAULT_MAX_WORKERS,
+    queries_per_second=DEFAULT_QUERIES_PER_SECOND,
+) -> dict:
+    resolvers = []
+    for server in dns_server_list:
+        resolver = resolve_server(server)
+        if resolver and resolver not in resolvers:
+            resolvers.append(resolver)
+    if not resolvers or not query_host_names:
+        return {}
+
+    # queries_per_second of 0 or less is no pacing
+    limiters = {
+        resolver: (
+            _RateLimiter(queries_per_second)
+            if queries_per_second > 0
+            else None
+        )
+        for resolver in resolvers
+    }
+    with ThreadPoolExecutor(
+        max_workers=max_concurrency, thread_name_prefix="DnsMatrix"
+    ) as executor:
+        # interleave resolvers so the pool doesn't sit on one rate limiter
+        futures = {
+            (resolver, host): executor.submit(
+                _query_series, resolver, host, count, limiters[resolver]
+            )
+            for host in query_host_names
+            for resolver in resolvers
+        }
+    matrix: dict = {}
+    for (resolver, host), future in futures.items():
+        cell = future.result()
+        if cell is not None:
+            matrix.setdefault(resolver, {})[host] = cell
+    return matrix
+
+
+# Resolvers fastest first, ranked by the mean of their per host averages.
+# A resolver that missed a host ranks after every resolver that answered all
+def rank_resolvers(matrix: dict) -> list:
+    host_count = max((len(cells) for cells in matrix.values()), default=0)
+    ranking = []
+    for resolver, cells in matrix.items():
+        ranking.append(
+            {
+                "dns_server": resolver,
+                "hosts_answered": len(cells),
+                "avg": statistics.fmean(c["avg"] for c in cells.values()),
+                "p95": max(c["p95"] for c in cells.values()),
+            }
+        )
+    ranking.sort(
+        key=lambda r: (r["hosts_answered"] < host_count, r["avg"], r["p95"])
+    )
+    return ranking
+
+
+def log_dns_matrix(matrix: dict) -> None:
+    for resolver, cells in matrix.items():
+        for host, cell in cells.items():
+            logger.info(
+                "server:%-15s host:%-25s min=%-8.3f avg=%-8.3f max=%-8.3f "
+                "std-dev=%-8.3f p95=%-8.3f lost=%.0f%%"
+                % (
+                    resolver,
+                    host,
+                    cell["min"],
+                    cell["avg"],
+                    cell["max"],
+                    cell["stddev"],
+                    cell["p95"],
+                    cell["lost_percent"],
+                )
+            )
+    for position, entry in enumerate(rank_resolvers(matrix), start=1):
+        logger.info(
+            "rank %d: %-15s avg=%-8.3f worst-p95=%-8.3f hosts=%d"
+            % (
+                position,
+                entry["dns_server"],
+                entry["avg"],
+                entry["p95"],
+                entry["hosts_answered"],
+            )
+        )
+
+
+# Push every cell as gauges tagged with dns_server and query_host.
+# Assumes register_azure_monitor() has already been called.
+def push_dns_matrix(matrix: dict) -> None:
+    for resolver, cells in matrix.items():
+        for host, cell in cells.items():
+            push_azure_dns_metrics(
+                ping_min=cell["min"],
+                ping_average=cell["avg"],
+                ping_max=cell["max"],
+                ping_stddev=cell["stddev"],
+                dns_server=resolver,
+                query_host=host,
+                ping_p95=cell["p95"],
+            )
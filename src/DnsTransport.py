@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Latency cost of the DNS transports. Run with DnsCheck.py --transports
+#
+# The same query series goes to every resolver over UDP, TCP, DNS over TLS
+# and DNS over HTTPS at the same time so they are compared on the same
+# path. dnsdiag opens a new connection for every stream query, here each
+# series keeps its connection so the time of a query and the time to set
+# up the connection, the TCP and TLS handshakes, are reported separately.
+#
+# Only the standard library is used. The query is a plain A lookup with
+# recursion desired and only the id and rcode of the answer are read.
+import configparser
+import http.client
+import logging
+import random
+import socket
+import ssl
+import statistics
+import struct
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from AppInsights import push_azure_dns_metrics, push_azure_dns_setup_metrics
+from DnsCheck import DEFAULT_MAX_WORKERS, DEFAULT_QUERY_COUNT, resolve_server
+from DnsMatrix import RCODE_NOERROR, summarize_times
+from SourceInterfaces import source_attributes
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run DnsCheck.py --transports")
+    sys.exit(-1)
+
+# dns_proto attribute values
+PROTO_UDP = "udp"
+PROTO_TCP = "tcp"
+PROTO_DOT = "dot"
+PROTO_DOH = "doh"
+PROTOS = (PROTO_UDP, PROTO_TCP, PROTO_DOT, PROTO_DOH)
+DEFAULT_PORTS = {PROTO_UDP: 53, PROTO_TCP: 53, PROTO_DOT: 853, PROTO_DOH: 443}
+DEFAULT_DOH_PATH = "/dns-query"
+DEFAULT_TIMEOUT_SECONDS = 2.0
+DNS_MESSAGE = "application/dns-message"
+# recursion desired
+FLAGS_RD = 0x0100
+TYPE_A = 1
+CLASS_IN = 1
+MAX_UDP_SIZE = 4096
+
+
+# Read the transport options of the [dns] section of config.ini
+#   transports - the ones to compare
+#   <proto>_port - resolver port per transport
+#   doh_path - DNS over HTTPS url path
+#   tls_verify - check the DoT and DoH certificates, off for a stand-in
+def load_dns_transport_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    transports = config.get("dns", "transports", fallback=",".join(PROTOS))
+    transport_config = {
+        "transports": [
+            proto.strip().lower()
+            for proto in transports.split(",")
+            if proto.strip()
+        ],
+        "ports": {
+            proto: config.getint("dns", f"{proto}_port", fallback=port)
+            for proto, port in DEFAULT_PORTS.items()
+        },
+        "doh_path": config.get("dns", "doh_path", fallback=DEFAULT_DOH_PATH),
+        "tls_verify": config.getboolean("dns", "tls_verify", fallback=True),
+    }
+    unknown = set(transport_config["transports"]) - set(PROTOS)
+    if unknown:
+        raise ValueError(f"unknown dns transports {sorted(unknown)}")
+    logger.debug("dns transport config: %s", transport_config)
+    return transport_config
+
+
+def build_query(query_id: int, host_name: str) -> bytes:
+    question = b"".join(
+        struct.pack("!B", len(label)) + label
+        for label in host_name.rstrip(".").encode("idna").split(b".")
+    )
+    return (
+        struct.pack("!HHHHHH", query_id, FLAGS_RD, 1, 0, 0, 0)
+        + question
+        + b"\0"
+        + struct.pack("!HH", TYPE_A, CLASS_IN)
+    )
+
+
+# Returns the rcode of an answer to query_id, None for anything else
+def response_rcode(data: bytes, query_id: int):
+    if len(data) < 12:
+        return None
+    answer_id, flags = struct.unpack_from("!HH", data)
+    if answer_id != query_id:
+        return None
+    return flags & 0x000F
+
+
+def _recv_exact(sock, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by the resolver")
+        data += chunk
+    return bytes(data)
+
+
+# One transport to one resolver. exchange() sends a query and returns the
+# answer. Stream transports connect on first use and keep the connection
+class _Transport:
+    def __init__(self, resolver, port, timeout, source_address) -> None:
+        self._resolver = resolver
+        self._port = port
+        self._timeout = timeout
+        self._source_address = source_address
+        self._connection = None
+        # ms per connection opened
+        self.setup_ms = []
+
+    def connected(self) -> bool:
+        return self._connection is not None
+
+    def connect(self) -> None:
+        tic = time.perf_counter()
+        self._connection = self._open()
+        self.setup_ms.append((time.perf_counter() - tic) * 1000.0)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _stream(self):
+        return socket.create_connection(
+            (self._resolver, self._port),
+            timeout=self._timeout,
+            source_address=self._source_address,
+        )
+
+
+# No connection, the socket is only bound so it isn't timed as setup
+class _UdpTransport(_Transport):
+    def connect(self) -> None:
+        self._connection = self._open()
+
+    def _open(self):
+        family = socket.AF_INET6 if ":" in self._resolver else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        sock.settimeout(self._timeout)
+        if self._source_address:
+            sock.bind(self._source_address)
+        sock.connect((self._resolver, self._port))
+        return sock
+
+    def exchange(self, query: bytes) -> bytes:
+        self._connection.send(query)
+        # a late answer to an earlier query is skipped by the id check
+        while True:
+            data = self._connection.recv(MAX_UDP_SIZE)
+            if data[:2] == query[:2]:
+                return data
+
+
+class _TcpTransport(_Transport):
+    def _open(self):
+        return self._stream()
+
+    def exchange(self, query: bytes) -> bytes:
+        self._connection.sendall(struct.pack("!H", len(query)) + query)
+        (size,) = struct.unpack("!H", _recv_exact(self._connection, 2))
+        return _recv_exact(self._connection, size)
+
+
+class _TlsTransport(_TcpTransport):
+    def __init__(self, *args, context: ssl.SSLContext) -> None:
+        super().__init__(*args)
+        self._context = context
+
+    def _open(self):
+        sock = self._stream()
+        try:
+            return self._context.wrap_socket(
+                sock, server_hostname=self._resolver
+            )
+        except BaseException:
+            sock.close()
+            raise
+
+
+class _HttpsTransport(_Transport):
+    def __init__(self, *args, context: ssl.SSLContext, path: str) -> None:
+        super().__init__(*args)
+        self._context = context
+        self._path = path
+
+    def _open(self):
+        connection = http.client.HTTPSConnection(
+            self._resolver,
+            self._port,
+            timeout=self._timeout,
+            source_address=self._source_address,
+            context=self._context,
+        )
+        connection.connect()
+        return connection
+
+    def exchange(self, query: bytes) -> bytes:
+        self._connection.request(
+            "POST",
+            self._path,
+            body=query,
+            headers={"Content-Type": DNS_MESSAGE, "Accept": DNS_MESSAGE},
+        )
+        response = self._connection.getresponse()
+        data = response.read()
+        if response.will_close:
+            self.close()
+        if response.status != 200:
+            raise http.client.HTTPException(f"status {response.status}")
+        return data
+
+
+def _tls_context(verify: bool) -> ssl.SSLContext:
+    context = ssl.create_default_context()
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def _create_transport(
+    proto, resolver, transport_config, timeout, source_address
+):
+    args = (
+        resolver,
+        transport_config["ports"][proto],
+        timeout,
+        source_address,
+    )
+    if proto == PROTO_UDP:
+        return _UdpTransport(*args)
+    if proto == PROTO_TCP:
+        return _TcpTransport(*args)
+    context = _tls_context(transport_config["tls_verify"])
+    if proto == PROTO_DOT:
+        return _TlsTransport(*args, context=context)
+    # DoH, the application/dns-message path also takes an alpn of http/1.1
+    context.set_alpn_protocols(["http/1.1"])
+    return _HttpsTransport(
+        *args, context=context, path=transport_config["doh_path"]
+    )
+
+
+# count queries over one transport. Returns the query times, excluding
+# the connection setup, and the setup time of every connection opened
+def query_series(
+    resolver,
+    query_host_name,
+    proto,
+    transport_config,
+    count=DEFAULT_QUERY_COUNT,
+    timeout=DEFAULT_TIMEOUT_SECONDS,
+    src_ip=None,
+):
+    transport = _create_transport(
+        proto,
+        resolver,
+        transport_config,
+        timeout,
+        (src_ip, 0) if src_ip else None,
+    )
+    times = []
+    try:
+        for _ in range(count):
+            # DoH answers are cacheable by id 0, RFC 8484
+            query_id = 0 if proto == PROTO_DOH else random.getrandbits(16)
+            query = build_query(query_id, query_host_name)
+            try:
+                if not transport.connected():
+                    transport.connect()
+                tic = time.perf_counter()
+                answer = transport.exchange(query)
+                elapsed = (time.perf_counter() - tic) * 1000.0
+            except (OSError, http.client.HTTPException) as e:
+                logger.debug("%s %s: %s", resolver, proto, e)
+                transport.close()
+                continue
+            if response_rcode(answer, query_id) == RCODE_NOERROR:
+                times.append(elapsed)
+    finally:
+        transport.close()
+    return times, transport.setup_ms
+
+
+# Per query statistics of one series plus
+#   setup_ms - average connection setup time, stream transports only
+#   connections - connections opened, more than one means reconnects
+# None when nothing was answered
+def summarize_series(times: list, setup_ms: list, count: int):
+    summary = summarize_times(times, count)
+    if summary is None:
+        return None
+    summary["connections"] = len(setup_ms)
+    summary["setup_ms"] = statistics.fmean(setup_ms) if setup_ms else None
+    return summary
+
+
+# Returns {resolver: {proto: summarize_series()}} in configured order.
+# Transports that got no answer are left out
+def measure_dns_transports(
+    dns_server_list,
+    query_host_name,
+    transport_config,
+    count=DEFAULT_QUERY_COUNT,
+    max_concurrency=DEFAULT_MAX_WORKERS,
+    src_ip=None,
+) -> dict:
+    resolvers = []
+    for server in dns_server_list:
+        resolver = resolve_server(server)
+        if resolver and resolver not in resolvers:
+            resolvers.append(resolver)
+    protos = transport_config["transports"]
+    if not resolvers or not protos:
+        return {}
+
+    # one series per resolver and transport
+    with ThreadPoolExecutor(
+        max_workers=len(protos) * min(max_concurrency, len(resolvers)),
+        thread_name_prefix="DnsTransport",
+    ) as executor:
+        futures = {
+            (resolver, proto): executor.submit(
+                query_series,
+                resolver,
+                query_host_name,
+                proto,
+                transport_config,
+                count,
+                src_ip=src_ip,
+            )
+            for resolver in resolvers
+            for proto in protos
+        }
+    results: dict = {}
+    for (resolver, proto), future in futures.items():
+        summary = summarize_series(*future.result(), count)
+        if summary is None:
+            logger.warning("%s: no %s answers", resolver, proto)
+            continue
+        results.setdefault(resolver, {})[proto] = summary
+    return results
+
+
+def log_dns_transports(results: dict) -> None:
+    for resolver, protos in results.items():
+        for proto, summary in protos.items():
+            setup = summary["setup_ms"]
+            logger.info(
+                "server:%-15s proto:%-3s min=%-8.3f avg=%-8.3f p95=%-8.3f "
+                "lost=%.0f%%  setup=%s connections=%d"
+                % (
+                    resolver,
+                    proto,
+                    summary["min"],
+                    summary["avg"],
+                    summary["p95"],
+                    summary["lost_percent"],
+                    "-" if setup is None else f"{setup:.3f}",
+                    summary["connections"],
+                )
+            )
+
+
+# The per query times go out as the ST DNS metrics and the connection
+# setup as ST DNS Setup Time, all tagged with dns_server and dns_proto.
+# Assumes register_azure_monitor() has already been called.
+def push_dns_transports(results: dict, source=None) -> None:
+    for resolver, protos in results.items():
+        for proto, summary in protos.items():
+            push_azure_dns_metrics(
+                ping_min=summary["min"],
+                ping_average=summary["avg"],
+                ping_max=summary["max"],
+                ping_stddev=summary["stddev"],
+                dns_server=resolver,
+                ping_p95=summary["p95"],
+                dns_proto=proto,
+                **source_attributes(source),
+            )
+            if summary["setup_ms"] is not None:
+                push_azure_dns_setup_metrics(
+                    setup_ms=summary["setup_ms"],
+                    dns_server=resolver,
+                    dns_proto=proto,
+                    **source_attributes(source),
+                )
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Trends over the local results history without Azure.
+#
+#   python3 NetCheck.py history --bucket 1d
+#   python3 NetCheck.py history --input results.json --group-by server_host
+#
+# Reads the results store, or -o json lines files, into one numpy record
+# array and computes the count, min, avg, p50, p95 and max of each metric
+# per time bucket and group in a handful of vectorized passes. A year of
+# runs every 3 minutes, about 175k records, takes a fraction of a second
+# from the store. json lines are parsed one object at a time and are
+# much slower to load.
+import argparse
+import json
+import logging
+import math
+import sys
+from datetime import datetime, timezone
+
+from ResultsStore import (
+    RECORD,
+    flatten_results,
+    load_results_store_path,
+    pack_record,
+    parse_timestamp,
+    read_range_array,
+    record_dtype,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py history")
+    sys.exit(-1)
+
+METRICS = ["ping", "download", "upload", "get_servers", "get_best_servers"]
+# speedtest reports bits per second
+RATE_METRICS = ("download", "upload")
+BITS_PER_MEGABIT = 1_000_000
+GROUP_FIELDS = ("server_host", "client_isp")
+STATISTICS = ("count", "min", "avg", "p50", "p95", "max")
+BUCKET_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60}
+
+
+# 90, 15m, 1h or 1d in seconds
+def parse_bucket(value: str) -> int:
+    unit = BUCKET_UNITS.get(value[-1:].lower())
+    seconds = int(value[:-1]) * unit if unit else int(value)
+    if seconds <= 0:
+        raise argparse.ArgumentTypeError(f"bucket must be positive: {value}")
+    return seconds
+
+
+# NetCheck.py -o files are json lines. Pretty printed objects, like the
+# samples in speedtest-results, are read as well
+def read_json_records(paths: list):
+    import numpy as np
+
+    decoder = json.JSONDecoder()
+    packed = bytearray()
+    for path in paths:
+        with open(path) as json_file:
+            text = json_file.read()
+        position = 0
+        while True:
+            while position < len(text) and text[position].isspace():
+                position += 1
+            if position == len(text):
+                break
+            results, position = decoder.raw_decode(text, position)
+            # the same flattening and encoding as the results store
+            packed += pack_record(flatten_results(results))
+    return np.frombuffer(bytes(packed), dtype=record_dtype())
+
+
+def _decode(value) -> str:
+    return value.rstrip(b"\0").decode("utf-8", errors="replace")
+
+
+# The fraction percentile of every group of sorted values, linearly
+# interpolated like numpy.percentile. starts and counts locate the groups
+def _percentile(values, starts, counts, fraction: float):
+    import numpy as np
+
+    position = starts + fraction * (counts - 1)
+    low = np.floor(position).astype(np.int64)
+    high = np.ceil(position).astype(np.int64)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+# Returns the distinct values in sorted order and the index of each value
+# in them. Same as numpy.unique(return_inverse=True) but the stable sort is
+# much faster on the long runs of repeated fixed width strings we have
+def _factorize(values):
+    import numpy as np
+
+    order = np.argsort(values, kind="stable")
+    ordered = values[order]
+    starts = np.empty(ordered.size, dtype=bool)
+    starts[:1] = True
+    starts[1:] = ordered[1:] != ordered[:-1]
+    codes = np.empty(ordered.size, dtype=np.int64)
+    codes[order] = np.cumsum(starts) - 1
+    return ordered[starts], codes
+
+
+# Statistics of one metric for every group id. Values of zero or less are
+# tests that were skipped, a ping only run has no download or upload
+def _summarize_metric(values, group_ids, group_count: int) -> dict:
+    import numpy as np
+
+    valid = values > 0
+    ids = group_ids[valid]
+    values = values[valid]
+    # ordered by group and by value within each group
+    order = np.argsort(values)
+    order = order[np.argsort(ids[order], kind="stable")]
+    ids = ids[order]
+    values = values[order]
+    counts = np.bincount(ids, minlength=group_count)
+    starts = np.cumsum(counts) - counts
+    present = counts > 0
+    summary = {name: np.full(group_count, np.nan) for name in STATISTICS}
+    summary["count"] = counts
+    if not values.size:
+        return summary
+    starts = starts[present]
+    present_counts = counts[present]
+    summary["min"][present] = values[starts]
+    summary["max"][present] = values[starts + present_counts - 1]
+    summary["avg"][present] = (
+        np.bincount(ids, weights=values, minlength=group_count)[present]
+        / present_counts
+    )
+    summary["p50"][present] = _percentile(values, starts, present_counts, 0.5)
+    summary["p95"][present] = _percentile(values, starts, present_counts, 0.95)
+    return summary
+
+
+# Per bucket and group statistics of the metrics.
+# Returns one dict per bucket and group in time order.
+# Rates are converted to Mbps
+def summarize(
+    records, bucket_seconds: int, group_by=(), metrics=METRICS
+) -> list:
+    import numpy as np
+
+    if not records.size:
+        return []
+    # every bucket and group combination as one integer, bucket first so
+    # the groups come out in time order
+    buckets, combined = _factorize(
+        np.floor(records["timestamp"] / bucket_seconds).astype(np.int64)
+    )
+    key_values = [buckets]
+    for field in group_by:
+        uniques, codes = _factorize(records[field])
+        combined = combined * uniques.size + codes
+        key_values.append([_decode(value) for value in uniques.tolist()])
+    keys, group_ids = np.unique(combined, return_inverse=True)
+    group_ids = group_ids.reshape(-1)
+    group_count = keys.size
+    # split the combined keys back into the bucket and group values
+    key_codes = []
+    for values in reversed(key_values[1:]):
+        keys, codes = np.divmod(keys, len(values))
+        key_codes.insert(0, codes.tolist())
+    key_codes.insert(0, keys.tolist())
+
+    columns = {}
+    for metric in metrics:
+        summary = _summarize_metric(
+            records[metric].astype(np.float64), group_ids, group_count
+        )
+        scale = BITS_PER_MEGABIT if metric in RATE_METRICS else 1
+        columns[metric] = {
+            name: (
+                summary[name].tolist()
+                if name == "count"
+                else np.round(summary[name] / scale, 3).tolist()
+            )
+            for name in STATISTICS
+        }
+
+    rows = []
+    for index, bucket_code in enumerate(key_codes[0]):
+        row = {
+            "bucket": datetime.fromtimestamp(
+                int(buckets[bucket_code]) * bucket_seconds, tz=timezone.utc
+            ).isoformat(),
+        }
+        for field, values, codes in zip(
+            group_by, key_values[1:], key_codes[1:]
+        ):
+            row[field] = values[codes[index]]
+        for metric in metrics:
+            row[metric] = {
+                name: values[index]
+                for name, values in columns[metric].items()
+                # nan when every test in the bucket was skipped
+                if values[index] == values[index]
+            }
+        rows.append(row)
+    return rows
+
+
+def print_table(rows: list, group_by, metrics) -> None:
+    labels = [f"{metric} {name}" for metric in metrics for name in STATISTICS]
+    widths = [max(len(label), 10) for label in labels]
+    header = [f"{'bucket':<25}"] + [f"{field:<24}" for field in group_by]
+    header += [f"{label:>{width}}" for label, width in zip(labels, widths)]
+    print(" ".join(header))
+    for row in rows:
+        line = [f"{row['bucket']:<25}"]
+        line += [f"{row[field][:24]:<24}" for field in group_by]
+        values = [
+            row[metric].get(name, "")
+            for metric in metrics
+            for name in STATISTICS
+        ]
+        line += [f"{value:>{width}}" for value, width in zip(values, widths)]
+        print(" ".join(line))
+
+
+def history_main(argv: list) -> int:
+    parser = argparse.ArgumentParser(
+        prog="NetCheck history",
+        description="Time bucketed statistics over the local results. "
+        "Rates are in Mbps and times in ms.",
+    )
+    parser.add_argument(
+        "--store",
+        default=None,
+        help="results store to read, "
+        "defaults to [results_store] path in config.ini",
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        nargs="+",
+        default=None,
+        help="read these NetCheck.py -o json lines files instead of the store",
+    )
+    parser.add_argument(
+        "-b",
+        "--bucket",
+        type=parse_bucket,
+        default=parse_bucket("1h"),
+        help="bucket width like 90, 15m, 1h or 1d, defaults to 1h",
+    )
+    parser.add_argument(
+        "--since", default=None, help="iso timestamp, inclusive"
+    )
+    parser.add_argument(
+        "--until", default=None, help="iso timestamp, exclusive"
+    )
+    parser.add_argument(
+        "-g",
+        "--group-by",
+        nargs="+",
+        choices=GROUP_FIELDS,
+        default=[],
+        help="also split the buckets by these fields",
+    )
+    parser.add_argument(
+        "-m",
+        "--metric",
+        nargs="+",
+        choices=METRICS,
+        default=METRICS,
+        help="metrics to summarize, defaults to all of them",
+    )
+    parser.add_argument(
+        "--json",
+        default=False,
+        help="print json lines instead of a table",
+        action="store_true",
+    )
+    args = parser.parse_args(argv)
+
+    if args.input:
+        records = read_json_records(args.input)
+        timestamps = records["timestamp"]
+        start = parse_timestamp(args.since) if args.since else -math.inf
+        end = parse_timestamp(args.until) if args.until else math.inf
+        records = records[(timestamps >= start) & (timestamps < end)]
+    else:
+        store_path = args.store or load_results_store_path()
+        if not store_path:
+            parser.error("no --input or --store and no [results_store] path")
+        records = read_range_array(store_path, args.since, args.until)
+    logger.debug("%d records of %d bytes", records.size, RECORD.size)
+
+    rows = summarize(records, args.bucket, args.group_by, args.metric)
+    if args.json:
+        for row in rows:
+            print(json.dumps(row))
+    else:
+        print_table(rows, args.group_by, args.metric)
+    return 0
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# High resolution latency and jitter probe.
+#
+# speedtest-cli's ping is the best of a handful of HTTP fetches.
+# This sends a paced burst of TCP connects or HTTP HEAD requests to the
+# selected server and keeps every round trip time so we can report the
+# distribution, jitter and loss instead of a single number.
+import configparser
+import http.client
+import logging
+import math
+import socket
+import sys
+import time
+from array import array
+from urllib.parse import urlparse
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py --latency-probe")
+    sys.exit(-1)
+
+METHOD_TCP = "tcp"
+METHOD_HTTP = "http"
+
+DEFAULT_COUNT = 100
+DEFAULT_INTERVAL_MS = 20
+DEFAULT_TIMEOUT_MS = 1000
+
+
+# Read the optional [latency_probe] section of config.ini
+def load_latency_probe_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    probe_config = {
+        "enabled": config.getboolean(
+            "latency_probe", "enabled", fallback=False
+        ),
+        "method": config.get("latency_probe", "method", fallback=METHOD_TCP),
+        "count": config.getint(
+            "latency_probe", "count", fallback=DEFAULT_COUNT
+        ),
+        "interval_ms": config.getfloat(
+            "latency_probe", "interval_ms", fallback=DEFAULT_INTERVAL_MS
+        ),
+        "timeout_ms": config.getfloat(
+            "latency_probe", "timeout_ms", fallback=DEFAULT_TIMEOUT_MS
+        ),
+    }
+    logger.debug("latency probe config: %s", probe_config)
+    return probe_config
+
+
+# One TCP handshake. Returns the rtt in ms or NaN on failure
+def _tcp_connect_rtt(
+    host: str, port: int, timeout: float, source_address=None
+) -> float:
+    tic = time.perf_counter()
+    try:
+        with socket.create_connection(
+            (host, port), timeout=timeout, source_address=source_address
+        ):
+            toc = time.perf_counter()
+    except OSError:
+        return math.nan
+    return (toc - tic) * 1000.0
+
+
+class _HttpHeadProber:
+    # Reuses one keep-alive connection so each probe is one request rtt
+    def __init__(self, url: str, timeout: float, source_address=None):
+        parts = urlparse(url)
+        self._secure = parts.scheme == "https"
+        self._netloc = parts.netloc
+        self._path = parts.path or "/"
+        self._timeout = timeout
+        self._source_address = source_address
+        self._connection = None
+
+    def _connect(self):
+        connection_class = (
+            http.client.HTTPSConnection
+            if self._secure
+            else http.client.HTTPConnection
+        )
+        connection = connection_class(
+            self._netloc,
+            timeout=self._timeout,
+            source_address=self._source_address,
+        )
+        connection.connect()
+        return connection
+
+    def rtt(self) -> float:
+        try:
+            if self._connection is None:
+                self._connection = self._connect()
+            tic = time.perf_counter()
+            self._connection.request("HEAD", self._path)
+            response = self._connection.getresponse()
+            response.read()
+            toc = time.perf_counter()
+        except (OSError, http.client.HTTPException):
+            self.close()
+            return math.nan
+        if response.will_close:
+            self.close()
+        return (toc - tic) * 1000.0
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+# Sends count probes spaced interval_ms apart on a fixed schedule so a slow
+# probe doesn't push the rest back. target is host:port for tcp or a url.
+# source_ip binds the probes to one local address.
+# Returns the rtt of every probe in ms, NaN for the ones that were lost
+def probe_latency(
+    target: str,
+    method: str = METHOD_TCP,
+    count: int = DEFAULT_COUNT,
+    interval_ms: float = DEFAULT_INTERVAL_MS,
+    timeout_ms: float = DEFAULT_TIMEOUT_MS,
+    source_ip: str = None,
+) -> array:
+    timeout = timeout_ms / 1000.0
+    source_address = (source_ip, 0) if source_ip else None
+    if method == METHOD_HTTP:
+        prober = _HttpHeadProber(target, timeout, source_address)
+        send = prober.rtt
+    elif method == METHOD_TCP:
+        host, _, port = target.rpartition(":")
+        host = host.strip("[]")  # ipv6 literal
+        prober = None
+
+        def send():
+            return _tcp_connect_rtt(host, int(port), timeout, source_address)
+
+    else:
+        raise ValueError(f"unknown latency probe method {method}")
+
+    rtts = array("d")
+    start = time.perf_counter()
+    try:
+        for sequence in range(count):
+            delay = start + sequence * interval_ms / 1000.0
+            delay -= time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            rtts.append(send())
+    finally:
+        if prober is not None:
+            prober.close()
+    return rtts
+
+
+# Summary of a probe_latency() burst. Jitter is the mean absolute difference
+# between consecutive answered probes as in RFC 3550
+def summarize_latency(rtts: array) -> dict:
+    # numpy is deferred so runs without the probe don't pay for the import
+    import numpy as np
+
+    samples = np.frombuffer(rtts, dtype=np.float64)
+    answered = samples[~np.isnan(samples)]
+    summary = {
+        "probe_count": int(samples.size),
+        "probe_loss": (
+            100.0 * (samples.size - answered.size) / samples.size
+            if samples.size
+            else 0.0
+        ),
+    }
+    if answered.size == 0:
+        return summary
+    percentiles = np.percentile(answered, [50, 95, 99])
+    summary.update(
+        {
+            "probe_min": float(answered.min()),
+            "probe_median": float(percentiles[0]),
+            "probe_p95": float(percentiles[1]),
+            "probe_p99": float(percentiles[2]),
+            "probe_jitter": (
+                float(np.abs(np.diff(answered)).mean())
+                if answered.size > 1
+                else 0.0
+            ),
+        }
+    )
+    return summary
+
+
+# The probe target for a speedtest server dict picked by get_best_server()
+def probe_target(server: dict, method: str) -> str:
+    if method == METHOD_HTTP:
+        # the same file speedtest-cli fetches for its own ping
+        return server["url"].rsplit("/", 1)[0] + "/latency.txt"
+    host = server["host"]
+    if ":" not in host:
+        port = 443 if server["url"].startswith("https") else 80
+        host = f"{host}:{port}"
+    return host
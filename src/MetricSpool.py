@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Durable on-disk spool for metrics bound for Application Insights.
+#
+# configure_azure_monitor() runs with disable_offline_storage=True so a run
+# made while the uplink is down loses its metrics, exactly when we want
+# them most. With the spool enabled every metric is written to disk first
+# as an Application Insights envelope and removed only after the
+# ingestion endpoint accepted it.
+#
+# * One file per metric, named so a directory listing is oldest first
+# * Bounded, the oldest files are evicted when max_records is exceeded
+# * At-least-once. Every envelope carries a spool_key property derived from
+#   its content so a batch that is retried after an ambiguous failure
+#   can be de-duplicated in queries
+# * Batches are posted gzip compressed to <IngestionEndpoint>/v2.1/track
+import configparser
+import gzip
+import hashlib
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py")
+    sys.exit(-1)
+
+DEFAULT_SPOOL_DIRECTORY = "spool"
+DEFAULT_MAX_RECORDS = 10000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL_SECONDS = 60
+DEFAULT_TIMEOUT_SECONDS = 10
+DEFAULT_INGESTION_ENDPOINT = "https://dc.services.visualstudio.com"
+
+# Breeze statuses that mean try again later
+RETRYABLE_STATUS_CODES = (408, 429, 439, 500, 502, 503, 504)
+SPOOL_KEY_PROPERTY = "spool_key"
+SPOOL_SUFFIX = ".json"
+
+
+# Read the optional [spool] section of config.ini
+def load_spool_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    spool_config = {
+        "enabled": config.getboolean("spool", "enabled", fallback=False),
+        "directory": config.get(
+            "spool", "directory", fallback=DEFAULT_SPOOL_DIRECTORY
+        ),
+        "max_records": config.getint(
+            "spool", "max_records", fallback=DEFAULT_MAX_RECORDS
+        ),
+        "batch_size": config.getint(
+            "spool", "batch_size", fallback=DEFAULT_BATCH_SIZE
+        ),
+        "flush_interval_seconds": config.getint(
+            "spool",
+            "flush_interval_seconds",
+            fallback=DEFAULT_FLUSH_INTERVAL_SECONDS,
+        ),
+        "timeout_seconds": config.getint(
+            "spool", "timeout_seconds", fallback=DEFAULT_TIMEOUT_SECONDS
+        ),
+        # overrides the connection string endpoint, a local stand-in for tests
+        "ingestion_endpoint": config.get(
+            "spool", "ingestion_endpoint", fallback=""
+        ),
+    }
+    logger.debug("spool config: %s", spool_config)
+    return spool_config
+
+
+# InstrumentationKey=...;IngestionEndpoint=https://... -> dict
+def parse_connection_string(connection_string: str) -> dict:
+    parts = {}
+    for part in connection_string.split(";"):
+        if "=" in part:
+            key, value = part.split("=", 1)
+            parts[key.strip().lower()] = value.strip()
+    return parts
+
+
+# <IngestionEndpoint>/v2.1/track of a connection string.
+# ingestion_endpoint overrides it
+def track_url(connection_string: str, ingestion_endpoint: str = "") -> str:
+    endpoint = (
+        ingestion_endpoint
+        or parse_connection_string(connection_string).get("ingestionendpoint")
+        or DEFAULT_INGESTION_ENDPOINT
+    )
+    return endpoint.rstrip("/") + "/v2.1/track"
+
+
+# Application Insights MetricData envelope for one value.
+# timestamp is an iso timestamp, now when not given
+def create_envelope(
+    name: str,
+    value: float,
+    properties: dict,
+    instrumentation_key: str,
+    cloud_role_name: str,
+    role_instance: str = None,
+    timestamp: str = None,
+) -> dict:
+    return {
+        "name": "Microsoft.ApplicationInsights.Metric",
+        "time": timestamp or datetime.now(timezone.utc).isoformat(),
+        "iKey": instrumentation_key,
+        "tags": {
+            "ai.cloud.role": cloud_role_name,
+            "ai.cloud.roleInstance": role_instance or platform.node(),
+        },
+        "data": {
+            "baseType": "MetricData",
+            "baseData": {
+                "ver": 2,
+                "metrics": [{"name": name, "value": value, "count": 1}],
+                "properties": dict(properties),
+            },
+        },
+    }
+
+
+# POST one batch. Returns the set of batch positions that must be kept
+def post_envelopes(url: str, envelopes: list, timeout_seconds) -> set:
+    body = gzip.compress(
+        json.dumps(envelopes, separators=(",", ":")).encode("utf-8")
+    )
+    request = urllib.request.Request(
+        url,
+        data=body,
+        method="POST",
+        headers={
+            "Content-Type": "application/json",
+            "Content-Encoding": "gzip",
+        },
+    )
+    try:
+        with urllib.request.urlopen(
+            request, timeout=timeout_seconds
+        ) as response:
+            status = response.status
+            payload = response.read()
+    except urllib.error.HTTPError as e:
+        status = e.code
+        payload = e.read()
+    except (urllib.error.URLError, OSError) as e:
+        logger.info("ingestion endpoint unreachable: %s", e)
+        return set(range(len(envelopes)))
+
+    if status == 200:
+        return set()
+    if status == 206:
+        # partial success, keep only the retryable failures
+        try:
+            errors = json.loads(payload).get("errors", [])
+        except ValueError:
+            return set(range(len(envelopes)))
+        return {
+            error["index"]
+            for error in errors
+            if error.get("statusCode") in RETRYABLE_STATUS_CODES
+        }
+    if status in RETRYABLE_STATUS_CODES:
+        logger.info("ingestion endpoint busy: %s", status)
+        return set(range(len(envelopes)))
+    # anything else will never succeed so don't block the sender on it
+    logger.error("ingestion endpoint rejected batch: %s", status)
+    return set()
+
+
+class MetricSpool:
+    def __init__(
+        self,
+        directory: str,
+        connection_string: str,
+        cloud_role_name: str,
+        max_records: int = DEFAULT_MAX_RECORDS,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        timeout_seconds: int = DEFAULT_TIMEOUT_SECONDS,
+        ingestion_endpoint: str = "",
+    ) -> None:
+        connection = parse_connection_string(connection_string)
+        self.directory = directory
+        self.instrumentation_key = connection.get("instrumentationkey", "")
+        self.track_url = track_url(connection_string, ingestion_endpoint)
+        self.cloud_role_name = cloud_role_name
+        self.max_records = max_records
+        self.batch_size = batch_size
+        self.timeout_seconds = timeout_seconds
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _envelope(self, name: str, value: float, properties: dict) -> dict:
+        return create_envelope(
+            name,
+            value,
+            properties,
+            self.instrumentation_key,
+            self.cloud_role_name,
+        )
+
+    # Write one metric value to disk. Returns the dedup key
+    def add(self, name: str, value: float, properties: dict) -> str:
+        envelope = self._envelope(name, value, properties)
+        spool_key = hashlib.sha256(
+            json.dumps(envelope, sort_keys=True).encode("utf-8")
+        ).hexdigest()[:24]
+        envelope["data"]["baseData"]["properties"][
+            SPOOL_KEY_PROPERTY
+        ] = spool_key
+        # nanosecond prefix keeps the directory listing in arrival order
+        file_name = f"{time.time_ns():020d}-{spool_key}{SPOOL_SUFFIX}"
+        path = os.path.join(self.directory, file_name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as spool_file:
+            json.dump(envelope, spool_file, separators=(",", ":"))
+        os.replace(tmp_path, path)
+        self._evict()
+        return spool_key
+
+    def _spooled_files(self) -> list:
+        return sorted(
+            name
+            for name in os.listdir(self.directory)
+            if name.endswith(SPOOL_SUFFIX)
+        )
+
+    def __len__(self) -> int:
+        return len(self._spooled_files())
+
+    # oldest first eviction down to max_records
+    def _evict(self) -> None:
+        files = self._spooled_files()
+        overflow = len(files) - self.max_records
+        if overflow <= 0:
+            return
+        logger.warning("spool full, dropping %d oldest metrics", overflow)
+        for name in files[:overflow]:
+            self._remove(name)
+
+    def _remove(self, name: str) -> None:
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            # another process flushed it first
+            pass
+
+    # POST one batch. Returns the set of batch positions that must be kept
+    def _send(self, envelopes: list) -> set:
+        return post_envelopes(self.track_url, envelopes, self.timeout_seconds)
+
+    # Drain the spool in batches until it is empty or the endpoint fails.
+    # Returns the number of metrics delivered
+    def flush(self) -> int:
+        delivered = 0
+        while True:
+            names = self._spooled_files()[: self.batch_size]
+            if not names:
+                return delivered
+            envelopes = []
+            batch_names = []
+            for name in names:
+                try:
+                    with open(
+                        os.path.join(self.directory, name), encoding="utf-8"
+                    ) as spool_file:
+                        envelopes.append(json.load(spool_file))
+                    batch_names.append(name)
+                except FileNotFoundError:
+                    continue
+                except ValueError:
+                    logger.warning("dropping corrupt spool file %s", name)
+                    self._remove(name)
+            if not envelopes:
+                continue
+            keep = self._send(envelopes)
+            for position, name in enumerate(batch_names):
+                if position not in keep:
+                    self._remove(name)
+            delivered += len(batch_names) - len(keep)
+            if keep:
+                logger.info(
+                    "spool flush stopped, %d metrics waiting", len(self)
+                )
+                return delivered
@@ -6,16 +6,9 @@
 import argparse
 import json
 import logging
-
-from opentelemetry.trace import Tracer
-
-from AppInsights import (
-    create_ot_tracer,
-    load_insights_key,
-    push_azure_speedtest_metrics,
-    register_azure_monitor,
-)
-from SpeedTest import Merge, run_test, write_json
+import statistics
+import sys
+import threading
 
 # ---------------------------
 # TODO add DNS lookup timing
@@ -27,6 +20,67 @@ from SpeedTest import Merge, run_test, write_json
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("NetCheck")
 
+# NetCheck.py history summarizes the local results instead of running a test
+if sys.argv[1:2] == ["history"]:
+    from History import history_main
+
+    sys.exit(history_main(sys.argv[2:]))
+
+# NetCheck.py backfill sends old json results with their original timestamps
+if sys.argv[1:2] == ["backfill"]:
+    from Backfill import backfill_main
+
+    sys.exit(backfill_main(sys.argv[2:]))
+
+# the subcommands above don't load speedtest or the OpenTelemetry sdk
+from opentelemetry.trace import Tracer  # noqa: E402
+
+from AdaptiveThroughput import load_adaptive_config  # noqa: E402
+from AppInsights import (  # noqa: E402
+    EXPORTER_AZURE,
+    create_ot_tracer,
+    flush_azure_monitor,
+    flush_metric_spool,
+    load_exporter_config,
+    load_insights_key,
+    push_azure_speedtest_metrics,
+    register_azure_monitor,
+    shutdown_azure_monitor,
+)
+from Backfill import load_backfill_config, record_exported  # noqa: E402
+from DegradationTrigger import (  # noqa: E402
+    SERIES_DNS,
+    SERIES_PING,
+    DegradationTrigger,
+    load_trigger_config,
+)
+from LatencyProbe import load_latency_probe_config  # noqa: E402
+from MetricSpool import load_spool_config  # noqa: E402
+from ParallelThroughput import (  # noqa: E402
+    load_parallel_config,
+    start_worker_pool,
+)
+from ResourceUsage import PhaseTracer, load_profile_config  # noqa: E402
+from ResultsStore import append_result, load_results_store_path  # noqa: E402
+from Scheduler import Scheduler, load_daemon_intervals  # noqa: E402
+from SourceInterfaces import (  # noqa: E402
+    SourceTracer,
+    ThroughputGate,
+    for_each_source,
+    load_interfaces_config,
+    resolve_sources,
+    source_attributes,
+    sources_argument,
+)
+from SpeedTest import (  # noqa: E402
+    Merge,
+    run_test,
+    throughput_series,
+    write_json,
+)
+from TailSampling import sampled_run  # noqa: E402
+from ThroughputSampler import load_throughput_series_config  # noqa: E402
+
 # --------------------------------------------------
 # determine options
 # sharing may require upload and download
@@ -53,8 +107,14 @@ parser.add_argument(
 parser.add_argument(
     "-o",
     "--outfile",
-    type=argparse.FileType("wt"),
-    help="write output to file as json",
+    type=argparse.FileType("at"),
+    help="append output to file as json lines",
+)
+parser.add_argument(
+    "--store",
+    default=None,
+    help="append results to this local results store, "
+    "defaults to [results_store] path in config.ini",
 )
 parser.add_argument(
     "-s",
@@ -70,6 +130,63 @@ parser.add_argument(
     help="log speedtest results as json to console and Azure",
     action="store_true",
 )
+parser.add_argument(
+    "--refresh-servers",
+    default=False,
+    help="ignore the cached speedtest.net server list and download a new one",
+    action="store_true",
+)
+parser.add_argument(
+    "-n",
+    "--no-export",
+    default=False,
+    help="local only, never load the Azure exporter",
+    action="store_true",
+)
+parser.add_argument(
+    "-l",
+    "--latency-probe",
+    default=False,
+    help="send a burst of latency probes to the selected server, "
+    "also enabled by [latency_probe] in config.ini",
+    action="store_true",
+)
+parser.add_argument(
+    "-a",
+    "--adaptive",
+    default=False,
+    help="stop the throughput tests once the rate has settled, "
+    "also enabled by [adaptive] in config.ini",
+    action="store_true",
+)
+parser.add_argument(
+    "--parallel-servers",
+    type=int,
+    default=None,
+    help="run the throughput tests against this many servers at once, "
+    "defaults to [parallel] servers in config.ini",
+)
+parser.add_argument(
+    "--sources",
+    type=sources_argument,
+    default=None,
+    help="comma separated interfaces or local addresses to test from, "
+    "defaults to [interfaces] sources in config.ini",
+)
+parser.add_argument(
+    "--profile",
+    default=False,
+    help="record CPU time, context switches and memory per phase as span "
+    "attributes and pstats files in the [profile] directory",
+    action="store_true",
+)
+parser.add_argument(
+    "--daemon",
+    default=False,
+    help="stay running and schedule ping, up/down and dns checks "
+    "using the [daemon] intervals in config.ini instead of crontab",
+    action="store_true",
+)
 args = parser.parse_args()
 if args.upload:
     logger.info("upload enabled")
@@ -78,50 +195,307 @@ if args.download:
 if args.share:
     logger.info("result sharing enabled")
 
-azure_instrumentation_key = load_insights_key()
-# Enable tracing
-register_azure_monitor(
-    azure_connection_string=azure_instrumentation_key,
-    cloud_role_name="NetCheck.py",
-    capture_logs=args.verbose,
-)
+parallel_config = load_parallel_config()
+if args.parallel_servers is not None:
+    parallel_config["servers"] = args.parallel_servers
+# forked while this process has no other threads, before the exporters
+start_worker_pool(parallel_config["servers"])
+
+if args.no_export:
+    # spans go to the OpenTelemetry API no-op tracer
+    logger.info("export disabled")
+    azure_instrumentation_key = None
+    ledger_path = None
+else:
+    exporter = load_exporter_config()["type"]
+    azure_instrumentation_key = None
+    if exporter == EXPORTER_AZURE:
+        azure_instrumentation_key = load_insights_key()
+    elif not args.daemon:
+        logger.warning("%s metrics are only served with --daemon", exporter)
+    # Enable tracing
+    register_azure_monitor(
+        azure_connection_string=azure_instrumentation_key,
+        cloud_role_name="NetCheck.py",
+        capture_logs=args.verbose,
+        exporter=exporter,
+    )
+    # the spool delivers a run even when the uplink is down, so backfill
+    # can skip it
+    ledger_path = None
+    if exporter == EXPORTER_AZURE and load_spool_config()["enabled"]:
+        ledger_path = load_backfill_config()["ledger"]
+store_path = args.store or load_results_store_path()
+latency_probe_config = load_latency_probe_config()
+if not (args.latency_probe or latency_probe_config["enabled"]):
+    latency_probe_config = None
+adaptive_config = load_adaptive_config()
+if not (args.adaptive or adaptive_config["enabled"]):
+    adaptive_config = None
+series_config = load_throughput_series_config()
+if not series_config["enabled"]:
+    series_config = None
+# interfaces are looked up on every run, addresses come and go with dhcp
+source_entries = args.sources or load_interfaces_config()["sources"]
+# runs from several sources share the outfile
+output_lock = threading.Lock()
 # Need the actual tracer to do spans
 tracer: Tracer = create_ot_tracer()
+if args.profile:
+    tracer = PhaseTracer(
+        tracer, profile_directory=load_profile_config()["directory"]
+    )
+
+
 # ---------------------------------------------------
 # Run the test
+# The spans and logs of a run are tail sampled together
+# when [sampling] is enabled
 # ---------------------------------------------------
-results_speed, results_setup = run_test(
-    should_download=args.download,
-    should_upload=args.upload,
-    should_share=args.share,
-    tracer=tracer,
-)
-# write out just the standard speedtest results
-write_json(results_speed, args.outfile)
-# augment the results with the setup times
-results_combined = Merge(results_speed.dict(), results_setup)
-logger.debug("results combined: %s", results_combined)
-# use the functions inside AppInsights.py
-push_azure_speedtest_metrics(results_combined, azure_instrumentation_key)
+def run_netcheck(
+    should_download, should_upload, outfile, source=None, throughput_gate=None
+):
+    with sampled_run() as run:
+        results_combined = _run_netcheck(
+            should_download, should_upload, outfile, source, throughput_gate
+        )
+        run.observe(results_combined)
+    return results_combined
+
+
+def _run_netcheck(
+    should_download, should_upload, outfile, source, throughput_gate
+):
+    results_speed, results_setup = run_test(
+        should_download=should_download,
+        should_upload=should_upload,
+        should_share=args.share,
+        tracer=tracer,
+        refresh_servers=args.refresh_servers,
+        latency_probe_config=latency_probe_config,
+        parallel_config=parallel_config,
+        adaptive_config=adaptive_config,
+        series_config=series_config,
+        source=source,
+        throughput_gate=throughput_gate,
+    )
+    # write out the standard speedtest results and any throughput series
+    with output_lock:
+        write_json(
+            results_speed,
+            outfile,
+            extra={
+                **throughput_series(results_setup),
+                **source_attributes(source),
+            },
+        )
+    # augment the results with the setup times
+    results_combined = Merge(results_speed.dict(), results_setup)
+    logger.debug("results combined: %s", results_combined)
+    if store_path:
+        append_result(store_path, results_combined)
+    if args.no_export:
+        logger.info(
+            "%sping=%.3f download=%.0f upload=%.0f",
+            f"{source.interface} " if source else "",
+            results_combined["ping"],
+            results_combined["download"],
+            results_combined["upload"],
+        )
+    else:
+        export_tracer = SourceTracer(tracer, source) if source else tracer
+        with export_tracer.start_as_current_span(name="export"):
+            # use the functions inside AppInsights.py
+            push_azure_speedtest_metrics(
+                results_combined, azure_instrumentation_key
+            )
+            if ledger_path:
+                with output_lock:
+                    record_exported(results_combined, ledger_path)
+            # metrics are otherwise sent on exit, outside the export span
+            if args.profile:
+                flush_azure_monitor()
+    if args.profile:
+        tracer.log_phases()
+
+    # ---------------------------------------------------
+    # We route the verbose log output to the ApplicationInsights logs.
+    # ---------------------------------------------------
+    if args.verbose:
+        # Only these log statements end up in Application insights.
+        logger.info(
+            '{ "combined_data": %s }',
+            json.dumps(results_combined, sort_keys=True, indent=4),
+        )
+        logger.debug(
+            "as json: %s",
+            json.dumps(results_speed.dict(), indent=2, sort_keys=True),
+        )
+        logger.debug(
+            "as encoded string: %s", json.dumps(results_speed.json())
+        )  # logs the entire object a singl json string
+        logger.debug("as dictionary: %s", results_speed.dict())
+        logger.debug(
+            "as csv: %s\n%s", results_speed.csv_header(), results_speed.csv()
+        )
+    return results_combined
+
 
 # ---------------------------------------------------
-# We route the verbose log output to the ApplicationInsights logs.
+# The same run from every configured source.
+# The runs start on every uplink at once. Once all of them have their
+# ping the throughput tests, which would compete for the links, are
+# run one source at a time.
+# Returns (source, results) pairs, results is None when a source failed
 # ---------------------------------------------------
-if args.verbose:
-    # Program exits after one execution
-    # so only these log statements end up in Application insights.
-    logger.info(
-        '{ "combined_data": %s }',
-        json.dumps(results_combined, sort_keys=True, indent=4),
-    )
-    logger.debug(
-        "as json: %s",
-        json.dumps(results_speed.dict(), indent=2, sort_keys=True),
-    )
-    logger.debug(
-        "as encoded string: %s", json.dumps(results_speed.json())
-    )  # logs the entire object a singl json string
-    logger.debug("as dictionary: %s", results_speed.dict())
-    logger.debug(
-        "as csv: %s\n%s", results_speed.csv_header(), results_speed.csv()
-    )
+def run_from_sources(should_download, should_upload, outfile):
+    sources = resolve_sources(source_entries)
+    throughput_gate = None
+    if should_download or should_upload:
+        throughput_gate = ThroughputGate(len(sources))
+
+    def run_source(source):
+        try:
+            return run_netcheck(
+                should_download,
+                should_upload,
+                outfile,
+                source,
+                throughput_gate,
+            )
+        finally:
+            # a failed source must not hold the others at the gate
+            if throughput_gate is not None:
+                throughput_gate.leave()
+
+    results = for_each_source(sources, run_source, concurrent=True)
+    return list(zip(sources, results))
+
+
+# ---------------------------------------------------
+# Long running mode. The exporter was configured once above
+# and the meter provider lives until we get SIGTERM.
+# ---------------------------------------------------
+def run_daemon():
+    if args.outfile:
+        logger.warning("--outfile is ignored in daemon mode")
+    intervals = load_daemon_intervals()
+    scheduler = Scheduler()
+    scheduler.install_signal_handlers()
+
+    # ping and dns times can trigger an up/down test between the
+    # scheduled ones, see DegradationTrigger.py
+    trigger_config = load_trigger_config()
+    trigger = None
+    if trigger_config["enabled"]:
+        trigger = DegradationTrigger(trigger_config)
+
+    def check_degradation(series, value, source=None):
+        if trigger is None:
+            return
+        reason = trigger.observe(
+            series, value, source.interface if source else None
+        )
+        if reason:
+            logger.warning("degradation %s, running up/down test", reason)
+            run_netcheck(True, True, None, source)
+
+    def ping_job():
+        if source_entries:
+            for source, results_combined in run_from_sources(
+                False, False, None
+            ):
+                check_degradation(
+                    SERIES_PING,
+                    results_combined["ping"] if results_combined else None,
+                    source,
+                )
+            return
+        try:
+            results_combined = run_netcheck(False, False, None)
+        except Exception:
+            check_degradation(SERIES_PING, None)
+            raise
+        check_degradation(SERIES_PING, results_combined["ping"])
+
+    def up_down_job():
+        if source_entries:
+            run_from_sources(True, True, None)
+        else:
+            run_netcheck(True, True, None)
+
+    scheduler.add_job("ping", intervals["ping"], ping_job)
+    scheduler.add_job("up_down", intervals["up_down"], up_down_job)
+    # dnsdiag is an optional install - see 1-setup-host.sh
+    try:
+        from DnsCacheCompare import (
+            log_dns_cache,
+            measure_dns_cache,
+            push_dns_cache,
+        )
+        from DnsCheck import load_dns_config, measure_dns, push_dns_result
+    except ImportError as e:
+        logger.warning("dns job disabled, DnsCheck unavailable: %s", e)
+    else:
+
+        # Returns the average time of every resolver that answered
+        def dns_check(source=None):
+            src_ip = source.source_ip if source else None
+            dns_config = load_dns_config()
+            if dns_config["cache_compare"]:
+                cache_results = measure_dns_cache(
+                    dns_config["servers"],
+                    dns_config["query_hosts"][0],
+                    count=dns_config["count"],
+                    max_concurrency=dns_config["max_concurrency"],
+                    src_ip=src_ip,
+                )
+                log_dns_cache(cache_results)
+                if cache_results and not args.no_export:
+                    push_dns_cache(cache_results, source)
+                return [c["hit"]["avg"] for c in cache_results.values()]
+            results = measure_dns(src_ip=src_ip)
+            if results and not args.no_export:
+                push_dns_result(results, source)
+            return [result[2] for result in results.values()]
+
+        def dns_job():
+            if source_entries:
+                # every uplink at once
+                sources = resolve_sources(source_entries)
+                checks = zip(
+                    sources, for_each_source(sources, dns_check, True)
+                )
+            else:
+                checks = [(None, dns_check())]
+            for source, averages in checks:
+                # the typical resolver, a single slow one is not the link
+                check_degradation(
+                    SERIES_DNS,
+                    statistics.median(averages) if averages else None,
+                    source,
+                )
+
+        scheduler.add_job("dns", intervals["dns"], dns_job)
+    spool_config = load_spool_config()
+    if spool_config["enabled"] and not args.no_export:
+        scheduler.add_job(
+            "spool_flush",
+            spool_config["flush_interval_seconds"],
+            flush_metric_spool,
+        )
+    try:
+        scheduler.run()
+    finally:
+        # final flush so the last run is not lost
+        shutdown_azure_monitor()
+
+
+if args.daemon:
+    run_daemon()
+elif source_entries:
+    run_from_sources(args.download, args.upload, args.outfile)
+else:
+    run_netcheck(args.download, args.upload, args.outfile)
+if args.outfile:
+    args.outfile.close()
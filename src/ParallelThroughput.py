@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Parallel multi-server throughput.
+#
+# On multi-gig links a single sponsor server often runs out before our
+# line does. This runs the download, and optionally the upload, against
+# the best K servers at the same time, one worker process per server so
+# the GIL doesn't become the bottleneck instead.
+#
+# Workers are released at a common wall clock time. Each one samples its
+# running byte count and the combined rate is the bytes every server moved
+# within the window where all of them were transferring, instead of over
+# the span from the first start to the last stop which would understate
+# it.
+#
+# The worker processes are forked by start_worker_pool() before the
+# exporters start their threads. Forking a process with threads running
+# can deadlock on a lock one of them held.
+import configparser
+import contextlib
+import logging
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import speedtest
+
+from StreamingUpload import streaming_upload
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py --parallel-servers")
+    sys.exit(-1)
+
+DIRECTION_DOWNLOAD = "download"
+DIRECTION_UPLOAD = "upload"
+
+DEFAULT_SERVERS = 1
+# time for every worker to start before the transfers are released
+DEFAULT_START_DELAY_SECONDS = 0.5
+# byte count sampling in the workers, the overlap window is interpolated
+SAMPLE_INTERVAL_MS = 100
+
+# set by start_worker_pool()
+_pool = None
+
+
+# Read the optional [parallel] section of config.ini
+#   servers - servers tested at the same time, 1 is the normal single test
+#   upload - also run the upload against all of them
+def load_parallel_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    parallel_config = {
+        "servers": config.getint(
+            "parallel", "servers", fallback=DEFAULT_SERVERS
+        ),
+        "upload": config.getboolean("parallel", "upload", fallback=False),
+        "start_delay_seconds": config.getfloat(
+            "parallel",
+            "start_delay_seconds",
+            fallback=DEFAULT_START_DELAY_SECONDS,
+        ),
+    }
+    logger.debug("parallel config: %s", parallel_config)
+    return parallel_config
+
+
+# The best server followed by the next closest ones, count in total
+def pick_servers(s: speedtest.Speedtest, best: dict, count: int) -> list:
+    # the cached best server path never built the closest list
+    if len(s.closest) < count:
+        s.closest = []
+        s.get_closest_servers(limit=count)
+    picked = [best]
+    for server in s.closest:
+        if len(picked) == count:
+            break
+        if server["id"] != best["id"]:
+            picked.append(server)
+    return picked
+
+
+# Reuses the parent's speedtest.net config instead of fetching it again
+class _WorkerSpeedtest(speedtest.Speedtest):
+    def get_config(self):
+        return self.config
+
+
+# Runs in a worker process. Returns the transfer window, the measured rate
+# and samples of [wall clock time, total bytes]
+def _transfer(
+    config,
+    secure,
+    source_address,
+    server,
+    direction,
+    threads,
+    start_at,
+    upload_buffer_kb,
+):
+    worker = _WorkerSpeedtest(
+        config=config, source_address=source_address, secure=secure
+    )
+    worker._best.update(server)
+    # ThroughputSampler imports the directions from here
+    from ThroughputSampler import sampled_transfer
+
+    delay = start_at - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    start = time.time()
+    with sampled_transfer(worker, direction, SAMPLE_INTERVAL_MS) as sampler:
+        if direction == DIRECTION_DOWNLOAD:
+            rate = worker.download(threads=threads)
+            transferred = worker.results.bytes_received
+        elif upload_buffer_kb:
+            rate = streaming_upload(worker, threads, upload_buffer_kb)
+            transferred = worker.results.bytes_sent
+        else:
+            rate = worker.upload(threads=threads)
+            transferred = worker.results.bytes_sent
+    stop = time.time()
+    return {
+        "server_host": server["host"],
+        "server_id": server["id"],
+        "start": start,
+        "stop": stop,
+        "bytes": transferred,
+        "rate": rate,
+        "samples": [
+            [start + elapsed_ms / 1000.0, total]
+            for elapsed_ms, total in sampler.samples
+        ],
+    }
+
+
+# Total bytes of a transfer at a wall clock time, interpolated between
+# the samples around it
+def bytes_at(samples: list, at: float) -> float:
+    if at <= samples[0][0]:
+        return samples[0][1]
+    for (start, start_bytes), (stop, stop_bytes) in zip(samples, samples[1:]):
+        if at <= stop:
+            if stop <= start:
+                return stop_bytes
+            fraction = (at - start) / (stop - start)
+            return start_bytes + fraction * (stop_bytes - start_bytes)
+    return samples[-1][1]
+
+
+# Combined rate in bits per second of transfers that ran at the same time.
+# Returns the rate and the overlapping window in seconds
+def combine_transfers(transfers: list) -> tuple:
+    overlap = min(t["stop"] for t in transfers) - max(
+        t["start"] for t in transfers
+    )
+    if overlap > 0:
+        # only what was moved while every server was busy
+        window_start = max(t["start"] for t in transfers)
+        window_stop = window_start + overlap
+        moved = sum(
+            bytes_at(t["samples"], window_stop)
+            - bytes_at(t["samples"], window_start)
+            for t in transfers
+        )
+        return moved * 8.0 / overlap, overlap
+    # the transfers never all ran together, fall back to the full span
+    span = max(t["stop"] for t in transfers) - min(
+        t["start"] for t in transfers
+    )
+    return sum(t["bytes"] for t in transfers) * 8.0 / span, 0.0
+
+
+# Forks the parallel worker processes now, call it before the exporters
+# are registered. fork keeps NetCheck.py from being re-run in every
+# worker. Without it, or without this call, the workers are threads and
+# share the GIL
+def start_worker_pool(workers: int) -> None:
+    global _pool
+    if workers < 2 or _pool is not None:
+        return
+    if "fork" not in multiprocessing.get_all_start_methods():
+        logger.warning(
+            "no fork on this platform, parallel workers are threads"
+        )
+        return
+    _pool = ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("fork")
+    )
+    # with fork every worker process is started on the first submit
+    _pool.submit(int).result()
+
+
+# The worker pool, threads when start_worker_pool() didn't fork one
+@contextlib.contextmanager
+def _executor(workers: int):
+    if _pool is not None:
+        yield _pool
+        return
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield executor
+
+
+# Transfer to or from every server at the same time.
+# upload_buffer_kb streams the upload bodies, 0 leaves them to speedtest-cli.
+# Returns a summary with the combined rate and one entry per server
+def run_parallel(
+    s: speedtest.Speedtest,
+    servers: list,
+    direction: str,
+    threads=None,
+    start_delay_seconds: float = DEFAULT_START_DELAY_SECONDS,
+    upload_buffer_kb: int = 0,
+) -> dict:
+    start_at = time.time() + start_delay_seconds
+    with _executor(len(servers)) as executor:
+        futures = [
+            executor.submit(
+                _transfer,
+                s.config,
+                s._secure,
+                s._source_address,
+                server,
+                direction,
+                threads,
+                start_at,
+                upload_buffer_kb,
+            )
+            for server in servers
+        ]
+        transfers = [future.result() for future in futures]
+    rate, overlap = combine_transfers(transfers)
+    logger.info(
+        "parallel %s %.0f bps over %.3fs from %d servers",
+        direction,
+        rate,
+        overlap,
+        len(servers),
+    )
+    return {
+        "rate": rate,
+        "bytes": sum(t["bytes"] for t in transfers),
+        "overlap_ms": overlap * 1000.0,
+        "servers": [
+            {
+                "server_host": t["server_host"],
+                "server_id": t["server_id"],
+                direction: t["rate"],
+            }
+            for t in transfers
+        ],
+    }
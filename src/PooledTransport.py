@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Keep-alive connection pool for speedtest-cli.
+#
+# speedtest-cli's urllib opener sends Connection: close and opens a new
+# connection, with a new TLS handshake when secure, for the config, the
+# server list and every download and upload request. On a high latency
+# link that setup is a large share of the measured time.
+# use_pooled_transport() swaps in an opener whose connections go back
+# to a pool when a response has been read to the end, and warm_up()
+# opens and exercises the transfer connections before measurement starts.
+# The time spent connecting is tracked so it can be reported on its own.
+#
+# The get_best_server() ping uses its own connections and is not pooled.
+import configparser
+import contextlib
+import http.client
+import logging
+import os
+import ssl
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import speedtest
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py")
+    sys.exit(-1)
+
+# smallest speedtest-cli download, about 245 KB on speedtest.net servers
+WARM_UP_SIZE = 350
+# unread response bytes worth reading to keep a connection
+DRAIN_LIMIT = 64 * 1024
+
+
+# Read the optional [transport] section of config.ini
+#   pooled - reuse keep-alive connections for the speedtest phases
+#   warm_up - open and use the transfer connections before measuring
+def load_transport_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    transport_config = {
+        "pooled": config.getboolean("transport", "pooled", fallback=False),
+        "warm_up": config.getboolean("transport", "warm_up", fallback=False),
+    }
+    logger.debug("transport config: %s", transport_config)
+    return transport_config
+
+
+# Idle keep-alive connections per scheme and host
+class ConnectionPool:
+    def __init__(self, source_address=None) -> None:
+        self._source_address = source_address
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._pid = os.getpid()
+        self._ssl_context = ssl.create_default_context()
+        self.connections_opened = 0
+        self.connections_reused = 0
+        self.connect_ms = 0.0
+
+    def connect(self, scheme: str, host: str, timeout):
+        if scheme == "https":
+            connection = http.client.HTTPSConnection(
+                host,
+                timeout=timeout,
+                source_address=self._source_address,
+                context=self._ssl_context,
+            )
+        else:
+            connection = http.client.HTTPConnection(
+                host, timeout=timeout, source_address=self._source_address
+            )
+        tic = time.perf_counter()
+        # tcp and tls handshakes
+        connection.connect()
+        elapsed_ms = (time.perf_counter() - tic) * 1000.0
+        with self._lock:
+            self.connections_opened += 1
+            self.connect_ms += elapsed_ms
+        return connection
+
+    # Returns (connection, reused)
+    def acquire(self, scheme: str, host: str, timeout):
+        with self._lock:
+            # a forked worker must not share its parent's sockets
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = {}
+            idle = self._idle.get((scheme, host))
+            if idle:
+                self.connections_reused += 1
+                return idle.pop(), True
+        return self.connect(scheme, host, timeout), False
+
+    def release(self, scheme: str, host: str, connection) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                self._idle.setdefault((scheme, host), []).append(connection)
+                return
+        connection.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "transport_connections": self.connections_opened,
+                "transport_reused": self.connections_reused,
+                "transport_connect_ms": self.connect_ms,
+            }
+
+
+# Hands the connection back once the body has been read to the end.
+# A short remainder, the upload reply speedtest-cli reads 11 bytes of,
+# is drained on close. A response abandoned part way, a download cut off
+# at the test length, leaves unread data so that connection is closed
+class _PooledResponse:
+    def __init__(self, response, pool, scheme, host, connection) -> None:
+        self._response = response
+        self._pool = pool
+        self._scheme = scheme
+        self._host = host
+        self._connection = connection
+
+    def read(self, *args, **kwargs):
+        data = self._response.read(*args, **kwargs)
+        if self._response.isclosed():
+            self._finish()
+        return data
+
+    def _finish(self) -> None:
+        connection, self._connection = self._connection, None
+        if connection is None:
+            return
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.release(self._scheme, self._host, connection)
+        else:
+            connection.close()
+
+    def close(self) -> None:
+        response = self._response
+        if (
+            self._connection is not None
+            and not response.isclosed()
+            and response.length is not None
+            and response.length <= DRAIN_LIMIT
+        ):
+            try:
+                response.read()
+            except (OSError, http.client.HTTPException):
+                pass
+        self._finish()
+        response.close()
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+class _PooledHandlerMixin:
+    def _send(self, connection, req, headers):
+        connection.request(req.get_method(), req.selector, req.data, headers)
+        return connection.getresponse()
+
+    def _pooled_open(self, scheme: str, req):
+        host = req.host
+        if not host:
+            raise urllib.error.URLError("no host given")
+        # same header merge as urllib without its Connection: close
+        headers = dict(req.unredirected_hdrs)
+        headers.update(
+            {k: v for k, v in req.headers.items() if k not in headers}
+        )
+        headers = {name.title(): value for name, value in headers.items()}
+        connection, reused = self.pool.acquire(scheme, host, self.timeout)
+        try:
+            try:
+                response = self._send(connection, req, headers)
+            except (OSError, http.client.HTTPException):
+                # an upload body has been partly read and can't be resent
+                if not reused or hasattr(req.data, "read"):
+                    raise
+                # the server dropped the idle connection, try a fresh one
+                connection.close()
+                connection = self.pool.connect(scheme, host, self.timeout)
+                response = self._send(connection, req, headers)
+        except OSError as e:
+            connection.close()
+            raise urllib.error.URLError(e)
+        except BaseException:
+            # includes speedtest-cli's upload timeout
+            connection.close()
+            raise
+        response.url = req.get_full_url()
+        response.msg = response.reason
+        return _PooledResponse(response, self.pool, scheme, host, connection)
+
+
+class PooledHTTPHandler(_PooledHandlerMixin, urllib.request.HTTPHandler):
+    def __init__(self, pool: ConnectionPool, timeout=10) -> None:
+        super().__init__()
+        self.pool = pool
+        self.timeout = timeout
+
+    def http_open(self, req):
+        return self._pooled_open("http", req)
+
+
+class PooledHTTPSHandler(_PooledHandlerMixin, urllib.request.HTTPSHandler):
+    def __init__(self, pool: ConnectionPool, timeout=10) -> None:
+        super().__init__()
+        self.pool = pool
+        self.timeout = timeout
+
+    def https_open(self, req):
+        return self._pooled_open("https", req)
+
+
+# Same handlers as speedtest.build_opener() with pooled connections
+def build_pooled_opener(pool: ConnectionPool, timeout=10):
+    opener = urllib.request.OpenerDirector()
+    opener.addheaders = [("User-agent", speedtest.build_user_agent())]
+    for handler in (
+        urllib.request.ProxyHandler(),
+        PooledHTTPHandler(pool, timeout),
+        PooledHTTPSHandler(pool, timeout),
+        urllib.request.HTTPDefaultErrorHandler(),
+        urllib.request.HTTPRedirectHandler(),
+        urllib.request.HTTPErrorProcessor(),
+    ):
+        opener.add_handler(handler)
+    return opener
+
+
+# Pools in use by source address, None is the default route.
+# Runs from different sources can be in progress at the same time
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+# speedtest.Speedtest() builds its opener with the module level
+# build_opener() so replace that. Sources without a pool get the original
+def _install_build_opener() -> None:
+    original = speedtest.build_opener
+
+    def build_opener(source_address=None, timeout=10):
+        pool = _pools.get(source_address)
+        if pool is None:
+            return original(source_address, timeout)
+        return build_pooled_opener(pool, timeout)
+
+    build_opener._original = original
+    speedtest.build_opener = build_opener
+
+
+# Route the speedtest connections from source_address through the pool.
+# None as the pool puts that source back on the original opener
+def use_pooled_transport(pool, source_address=None) -> None:
+    with _pools_lock:
+        if pool is None:
+            _pools.pop(source_address, None)
+        else:
+            _pools[source_address] = pool
+        original = getattr(speedtest.build_opener, "_original", None)
+        if _pools and original is None:
+            _install_build_opener()
+        elif not _pools and original is not None:
+            speedtest.build_opener = original
+
+
+# Pooled transport for the length of a run, yields the pool or None
+@contextlib.contextmanager
+def pooled_transport(pooled: bool, source_address=None):
+    if not pooled:
+        yield None
+        return
+    pool = ConnectionPool((source_address, 0) if source_address else None)
+    use_pooled_transport(pool, source_address)
+    try:
+        yield pool
+    finally:
+        use_pooled_transport(None, source_address)
+        pool.close()
+
+
+def _warm_up_request(s, url: str) -> int:
+    request = speedtest.build_request(url, secure=s._secure)
+    response = s._opener.open(request)
+    try:
+        return len(response.read())
+    finally:
+        response.close()
+
+
+# Opens one connection per download thread to the best server and pulls
+# a small file over each so the measured transfers start on connections
+# that are established and past the first round trips of slow start.
+# Returns the bytes moved
+def warm_up(s, threads=None) -> int:
+    connections = threads or s.config["threads"]["download"]
+    url = "%s/random%sx%s.jpg" % (
+        os.path.dirname(s.best["url"]),
+        WARM_UP_SIZE,
+        WARM_UP_SIZE,
+    )
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        sizes = list(
+            executor.map(
+                lambda _: _warm_up_request(s, url), range(connections)
+            )
+        )
+    return sum(sizes)
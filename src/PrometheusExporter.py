@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Local Prometheus / OpenMetrics scrape endpoint for the NetCheck metrics.
+#
+# Used by register_azure_monitor() when the [exporter] type is prometheus.
+# The same instruments and views as the Azure exporter are collected by an
+# OpenTelemetry SDK meter provider and rendered on every GET of /metrics.
+# Nothing from the Azure packages is imported.
+#
+# Metric names are the view names with anything Prometheus doesn't allow
+# replaced by _, "ST Ping Time" becomes ST_Ping_Time. The metric
+# attributes, client_isp, server_host, dns_server, query_host, dns_proto,
+# interface and source_ip, become labels. Only useful from a long running
+# process like NetCheck.py --daemon
+import logging
+import math
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from opentelemetry.sdk.metrics.export import (
+    Histogram,
+    MetricReader,
+    MetricsData,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py --daemon")
+    sys.exit(-1)
+
+METRICS_PATH = "/metrics"
+OPENMETRICS_CONTENT_TYPE = (
+    "application/openmetrics-text; version=1.0.0; charset=utf-8"
+)
+TEXT_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+_INVALID_NAME = re.compile(r"[^a-zA-Z0-9_:]")
+_INVALID_LABEL = re.compile(r"[^a-zA-Z0-9_]")
+
+
+# Pull reader, the meter provider is only collected when scraped
+class ScrapeReader(MetricReader):
+    def __init__(self) -> None:
+        super().__init__()
+        self._lock = threading.Lock()
+        self._metrics_data = None
+
+    def _receive_metrics(
+        self, metrics_data: MetricsData, timeout_millis=10_000, **kwargs
+    ) -> None:
+        self._metrics_data = metrics_data
+
+    def scrape(self):
+        with self._lock:
+            # collect() skips the callback when nothing was ever recorded
+            self._metrics_data = None
+            self.collect()
+            return self._metrics_data
+
+    def shutdown(self, timeout_millis=30_000, **kwargs) -> None:
+        pass
+
+
+def _metric_name(name: str) -> str:
+    name = _INVALID_NAME.sub("_", name)
+    return "_" + name if name[:1].isdigit() else name
+
+
+def _escape(value) -> str:
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace('"', '\\"')
+        .replace("\n", "\\n")
+    )
+
+
+def _labels(attributes, extra=()) -> str:
+    pairs = [
+        (_INVALID_LABEL.sub("_", str(key)), value)
+        for key, value in attributes.items()
+    ]
+    pairs.extend(extra)
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs)
+        + "}"
+    )
+
+
+def _number(value) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+# Text exposition of one collection. The OpenMetrics flavor ends in # EOF
+def render_metrics(metrics_data, openmetrics: bool = True) -> str:
+    lines = []
+    resource_metrics = metrics_data.resource_metrics if metrics_data else []
+    for resource in resource_metrics:
+        for scope in resource.scope_metrics:
+            for metric in scope.metrics:
+                name = _metric_name(metric.name)
+                histogram = isinstance(metric.data, Histogram)
+                if metric.description:
+                    lines.append(
+                        f"# HELP {name} {_escape(metric.description)}"
+                    )
+                lines.append(
+                    f"# TYPE {name} {'histogram' if histogram else 'gauge'}"
+                )
+                for point in metric.data.data_points:
+                    if not histogram:
+                        lines.append(
+                            f"{name}{_labels(point.attributes)} "
+                            f"{_number(point.value)}"
+                        )
+                        continue
+                    cumulative = 0
+                    bounds = list(point.explicit_bounds) + [math.inf]
+                    for bound, count in zip(bounds, point.bucket_counts):
+                        cumulative += count
+                        le = (("le", _number(bound)),)
+                        lines.append(
+                            f"{name}_bucket{_labels(point.attributes, le)} "
+                            f"{cumulative}"
+                        )
+                    labels = _labels(point.attributes)
+                    lines.append(f"{name}_count{labels} {point.count}")
+                    lines.append(f"{name}_sum{labels} {_number(point.sum)}")
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+class _ScrapeHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        logger.debug(format, *args)
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+        openmetrics = "application/openmetrics-text" in self.headers.get(
+            "Accept", ""
+        )
+        body = render_metrics(self.server.reader.scrape(), openmetrics).encode(
+            "utf-8"
+        )
+        self.send_response(200)
+        self.send_header(
+            "Content-Type",
+            OPENMETRICS_CONTENT_TYPE if openmetrics else TEXT_CONTENT_TYPE,
+        )
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PrometheusServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, reader: ScrapeReader) -> None:
+        super().__init__(address, _ScrapeHandler)
+        self.reader = reader
+
+
+# Registers a meter provider with the views and serves it on host:port.
+# Returns the server, shutdown() stops it
+def start_prometheus_exporter(
+    host: str, port: int, views: list, cloud_role_name: str
+) -> PrometheusServer:
+    from opentelemetry import metrics
+    from opentelemetry.sdk.metrics import MeterProvider
+    from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+
+    reader = ScrapeReader()
+    metrics.set_meter_provider(
+        MeterProvider(
+            metric_readers=[reader],
+            views=views,
+            resource=Resource.create({SERVICE_NAME: cloud_role_name}),
+        )
+    )
+    server = PrometheusServer((host, port), reader)
+    threading.Thread(
+        target=server.serve_forever, name="PrometheusServer", daemon=True
+    ).start()
+    logger.info(
+        "serving metrics on http://%s:%d%s",
+        host,
+        server.server_address[1],
+        METRICS_PATH,
+    )
+    return server
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Per phase resource usage. Wall time alone can't tell us if a slow run
+# was CPU, the network or the exporter.
+#
+# PhaseTracer wraps an OpenTelemetry tracer so every span that run_test()
+# opens (get_servers, get_best_servers, measure_download, ...) is also
+# measured for wall time, CPU time, context switches and memory.
+# The measurements become profile_* span attributes. With a profile
+# directory the phases are also run under cProfile and each one is dumped
+# as a pstats file for offline analysis, snakeviz or flameprof for example.
+# cProfile only sees the thread that opened the span. The speedtest-cli
+# transfer threads show up in profile_cpu_ms but not in the pstats.
+import configparser
+import contextlib
+import cProfile
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py")
+    sys.exit(-1)
+
+# how often the peak RSS sampler looks at /proc
+DEFAULT_SAMPLE_INTERVAL_SECONDS = 0.005
+# spans run under cProfile. Only one profiler can run at a time so the
+# enclosing main span is left out
+DEFAULT_PROFILED_SPANS = (
+    "get_servers",
+    "get_best_servers",
+    "measure_latency",
+    "warm_up",
+    "measure_download",
+    "measure_upload",
+    "sharing_is_caring",
+    "measure_dns",
+    "export",
+)
+SPAN_ATTRIBUTE_PREFIX = "profile_"
+_PAGE_SIZE_KB = (
+    os.sysconf("SC_PAGE_SIZE") // 1024 if hasattr(os, "sysconf") else 4
+)
+
+
+# Read the optional [profile] section of config.ini
+#   directory - where --profile writes a pstats file per phase.
+#     Empty only records the span attributes
+def load_profile_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    profile_config = {
+        "directory": config.get("profile", "directory", fallback=""),
+    }
+    logger.debug("profile config: %s", profile_config)
+    return profile_config
+
+
+# Current resident set size in KB. Linux only, None elsewhere
+def current_rss_kb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * _PAGE_SIZE_KB
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _context_switches():
+    if resource is None:
+        return 0, 0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_nvcsw, usage.ru_nivcsw
+
+
+# Samples RSS on a background thread so short spikes inside a phase
+# are caught. ru_maxrss can't be used because it never resets
+class _PeakRssSampler(threading.Thread):
+    def __init__(self, interval_seconds: float) -> None:
+        super().__init__(name="PeakRssSampler", daemon=True)
+        self._interval = interval_seconds
+        self._stop_event = threading.Event()
+        self.peak_kb = current_rss_kb() or 0
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self._interval):
+            rss = current_rss_kb()
+            if rss and rss > self.peak_kb:
+                self.peak_kb = rss
+
+    def stop(self) -> int:
+        self._stop_event.set()
+        self.join()
+        rss = current_rss_kb()
+        if rss and rss > self.peak_kb:
+            self.peak_kb = rss
+        return self.peak_kb
+
+
+# Measures the enclosed block. The usage dict is filled in on exit
+# usage keys: wall_ms, cpu_ms, voluntary_ctx_switches,
+#   involuntary_ctx_switches, rss_delta_kb and, if sampled, rss_peak_kb
+@contextlib.contextmanager
+def measure_usage(
+    sample_peak_rss: bool = True,
+    interval_seconds: float = DEFAULT_SAMPLE_INTERVAL_SECONDS,
+):
+    usage: dict = {}
+    sampler = None
+    if sample_peak_rss and current_rss_kb() is not None:
+        sampler = _PeakRssSampler(interval_seconds)
+        sampler.start()
+    rss_before = current_rss_kb()
+    voluntary_before, involuntary_before = _context_switches()
+    cpu_before = time.process_time()
+    wall_before = time.perf_counter()
+    try:
+        yield usage
+    finally:
+        usage["wall_ms"] = (time.perf_counter() - wall_before) * 1000.0
+        usage["cpu_ms"] = (time.process_time() - cpu_before) * 1000.0
+        voluntary_after, involuntary_after = _context_switches()
+        usage["voluntary_ctx_switches"] = voluntary_after - voluntary_before
+        usage["involuntary_ctx_switches"] = (
+            involuntary_after - involuntary_before
+        )
+        rss_after = current_rss_kb()
+        if rss_before is not None and rss_after is not None:
+            usage["rss_delta_kb"] = rss_after - rss_before
+        if sampler is not None:
+            usage["rss_peak_kb"] = sampler.stop()
+
+
+# Tracer wrapper that measures every span it opens.
+# phases holds a list of usage dicts per span name in the order they ran.
+# With a profile_directory the profiled_spans are also run under cProfile
+class PhaseTracer:
+    def __init__(
+        self,
+        tracer=None,
+        sample_peak_rss: bool = True,
+        profile_directory: str = "",
+        profiled_spans=DEFAULT_PROFILED_SPANS,
+    ) -> None:
+        if tracer is None:
+            from opentelemetry import trace
+
+            tracer = trace.get_tracer(__name__)
+        self._tracer = tracer
+        self._sample_peak_rss = sample_peak_rss
+        self._profile_directory = profile_directory
+        self._profiled_spans = set(profiled_spans)
+        self.phases: dict[str, list[dict]] = {}
+        if profile_directory:
+            os.makedirs(profile_directory, exist_ok=True)
+
+    def _profile_path(self, name: str) -> str:
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S")
+        return os.path.join(
+            self._profile_directory, f"{stamp}-{os.getpid()}-{name}.pstats"
+        )
+
+    @contextlib.contextmanager
+    def start_as_current_span(self, name: str, *args, **kwargs):
+        profiler = None
+        if self._profile_directory and name in self._profiled_spans:
+            profiler = cProfile.Profile()
+        with self._tracer.start_as_current_span(name, *args, **kwargs) as span:
+            with measure_usage(self._sample_peak_rss) as usage:
+                if profiler is not None:
+                    profiler.enable()
+                try:
+                    yield span
+                finally:
+                    if profiler is not None:
+                        profiler.disable()
+            self.phases.setdefault(name, []).append(usage)
+            span.set_attributes(
+                {
+                    SPAN_ATTRIBUTE_PREFIX + key: value
+                    for key, value in usage.items()
+                }
+            )
+            if profiler is not None:
+                path = self._profile_path(name)
+                profiler.dump_stats(path)
+                logger.info("profile of %s written to %s", name, path)
+
+    # anything else goes straight to the real tracer
+    def __getattr__(self, name):
+        return getattr(self._tracer, name)
+
+    # one log line per phase, spans don't reach Azure before the exporter
+    # is registered and not at all with --no-export
+    def log_phases(self) -> None:
+        for name, runs in self.phases.items():
+            usage = runs[-1]
+            logger.info(
+                "profile %s wall=%.1fms cpu=%.1fms ctx=%d/%d rss=%+dKB "
+                "peak=%dKB",
+                name,
+                usage["wall_ms"],
+                usage["cpu_ms"],
+                usage["voluntary_ctx_switches"],
+                usage["involuntary_ctx_switches"],
+                usage.get("rss_delta_kb", 0),
+                usage.get("rss_peak_kb", 0),
+            )
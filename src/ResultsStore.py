@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Append-only local history of NetCheck.py results.
+#
+# The data file is a small header followed by fixed-width little-endian
+# records, one per run, so record N is always at a known offset.
+# A sparse index file next to it holds the running maximum timestamp
+# at every INDEX_STRIDE records which lets a time range lookup
+# binary search to the right block instead of reading the whole file.
+#
+# Overlapping cron runs are serialized with an exclusive lock on the data
+# file. Records are written in completion order so timestamps are only
+# nearly sorted. A range scan keeps reading MAX_SKEW_SECONDS past
+# the end of the range to pick up runs that finished out of order.
+import bisect
+import configparser
+import logging
+import os
+import struct
+import sys
+from datetime import datetime, timezone
+
+try:
+    import fcntl
+except ImportError:  # Windows - single writer only
+    fcntl = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py")
+    sys.exit(-1)
+
+MAGIC = b"NCRS"
+FORMAT_VERSION = 1
+INDEX_STRIDE = 64
+# longest time a run can finish after a later starting run
+MAX_SKEW_SECONDS = 60 * 60
+
+# (field name, struct code, key path in the NetCheck combined results)
+# Strings are fixed width, utf-8, truncated and NUL padded
+FIELDS = [
+    ("timestamp", "d", ("timestamp",)),
+    ("ping", "d", ("ping",)),
+    ("download", "d", ("download",)),
+    ("upload", "d", ("upload",)),
+    ("get_servers", "d", ("get_servers",)),
+    ("get_best_servers", "d", ("get_best_servers",)),
+    ("bytes_sent", "q", ("bytes_sent",)),
+    ("bytes_received", "q", ("bytes_received",)),
+    ("server_latency", "d", ("server", "latency")),
+    ("server_d", "d", ("server", "d")),
+    ("server_id", "i", ("server", "id")),
+    ("server_host", "64s", ("server", "host")),
+    ("server_sponsor", "48s", ("server", "sponsor")),
+    ("client_isp", "48s", ("client", "isp")),
+    ("client_ip", "40s", ("client", "ip")),
+]
+FIELD_NAMES = [name for name, _, _ in FIELDS]
+RECORD = struct.Struct("<" + "".join(code for _, code, _ in FIELDS))
+RECORD_SIZE = RECORD.size
+# magic, format version, record size
+HEADER = struct.Struct("<4sHH")
+HEADER_SIZE = HEADER.size
+INDEX_ENTRY = struct.Struct("<d")
+
+
+# Read the optional [results_store] section of config.ini
+# An empty path disables the store
+def load_results_store_path() -> str:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    return config.get("results_store", "path", fallback="")
+
+
+# speedtest timestamps look like 2021-03-01T13:18:16.460145Z
+def parse_timestamp(value) -> float:
+    if isinstance(value, (int, float)):
+        return float(value)
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def _lookup(results: dict, path: tuple):
+    value = results
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+# Flatten the NetCheck combined results into a dict of FIELD_NAMES
+def flatten_results(results: dict) -> dict:
+    flat = {}
+    for name, code, path in FIELDS:
+        value = _lookup(results, path)
+        if name == "timestamp":
+            flat[name] = parse_timestamp(value)
+        elif code.endswith("s"):
+            flat[name] = "" if value is None else str(value)
+        elif code in ("q", "i"):
+            flat[name] = int(value or 0)
+        else:
+            flat[name] = float(value or 0.0)
+    return flat
+
+
+def pack_record(flat: dict) -> bytes:
+    values = []
+    for name, code, _ in FIELDS:
+        value = flat[name]
+        if code.endswith("s"):
+            value = value.encode("utf-8")[: int(code[:-1])]
+        values.append(value)
+    return RECORD.pack(*values)
+
+
+def unpack_record(buffer, offset: int = 0) -> dict:
+    record = dict(zip(FIELD_NAMES, RECORD.unpack_from(buffer, offset)))
+    for name, code, _ in FIELDS:
+        if code.endswith("s"):
+            record[name] = (
+                record[name].rstrip(b"\0").decode("utf-8", errors="replace")
+            )
+    return record
+
+
+def _lock(file, exclusive: bool) -> None:
+    if fcntl is not None:
+        fcntl.flock(file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+def _unlock(file) -> None:
+    if fcntl is not None:
+        fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _index_path(path: str) -> str:
+    return path + ".idx"
+
+
+def _check_header(data_file) -> None:
+    data_file.seek(0)
+    header = data_file.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE:
+        raise ValueError(f"{data_file.name} is not a results store")
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != MAGIC or record_size != RECORD_SIZE:
+        raise ValueError(
+            f"{data_file.name} is not a v{FORMAT_VERSION} results store"
+        )
+
+
+# whole records only. A crashed writer can leave a partial record at the end
+def _record_count(data_file) -> int:
+    size = os.fstat(data_file.fileno()).st_size
+    return max(size - HEADER_SIZE, 0) // RECORD_SIZE
+
+
+def _read_records(data_file, first: int, count: int) -> list:
+    data_file.seek(HEADER_SIZE + first * RECORD_SIZE)
+    buffer = data_file.read(count * RECORD_SIZE)
+    return [
+        unpack_record(buffer, offset)
+        for offset in range(0, len(buffer) - RECORD_SIZE + 1, RECORD_SIZE)
+    ]
+
+
+def _read_index(path: str) -> list:
+    try:
+        with open(_index_path(path), "rb") as index_file:
+            buffer = index_file.read()
+    except FileNotFoundError:
+        return []
+    return [
+        entry[0]
+        for entry in INDEX_ENTRY.iter_unpack(
+            buffer[: len(buffer) - len(buffer) % INDEX_ENTRY.size]
+        )
+    ]
+
+
+# Rebuilds the index from the data file. Caller holds the exclusive lock
+def _rebuild_index(path: str, data_file) -> list:
+    count = _record_count(data_file)
+    index = []
+    running_max = float("-inf")
+    for block in range(count // INDEX_STRIDE):
+        records = _read_records(data_file, block * INDEX_STRIDE, INDEX_STRIDE)
+        running_max = max(
+            running_max, max(record["timestamp"] for record in records)
+        )
+        index.append(running_max)
+    with open(_index_path(path), "wb") as index_file:
+        for entry in index:
+            index_file.write(INDEX_ENTRY.pack(entry))
+    logger.info("rebuilt results index %s", _index_path(path))
+    return index
+
+
+# Append one NetCheck combined results dict to the store
+def append_result(path: str, results: dict) -> None:
+    record = pack_record(flatten_results(results))
+    with open(path, "a+b") as data_file:
+        _lock(data_file, exclusive=True)
+        try:
+            if os.fstat(data_file.fileno()).st_size == 0:
+                data_file.write(
+                    HEADER.pack(MAGIC, FORMAT_VERSION, RECORD_SIZE)
+                )
+            _check_header(data_file)
+            count = _record_count(data_file)
+            # drop a partial record left by a crashed writer
+            data_file.truncate(HEADER_SIZE + count * RECORD_SIZE)
+            data_file.write(record)
+            data_file.flush()
+            count += 1
+
+            index = _read_index(path)
+            if len(index) != (count - 1) // INDEX_STRIDE:
+                index = _rebuild_index(path, data_file)
+            elif count % INDEX_STRIDE == 0:
+                block_start = count - INDEX_STRIDE
+                records = _read_records(data_file, block_start, INDEX_STRIDE)
+                running_max = max(record["timestamp"] for record in records)
+                if index:
+                    running_max = max(running_max, index[-1])
+                with open(_index_path(path), "ab") as index_file:
+                    index_file.write(INDEX_ENTRY.pack(running_max))
+            os.fsync(data_file.fileno())
+        finally:
+            _unlock(data_file)
+
+
+# Returns records with start <= timestamp < end in stored order.
+# Either bound can be None. Timestamps are epoch seconds or iso strings
+def read_range(path: str, start=None, end=None) -> list:
+    start = float("-inf") if start is None else parse_timestamp(start)
+    end = float("inf") if end is None else parse_timestamp(end)
+    matches = []
+    with open(path, "rb") as data_file:
+        _lock(data_file, exclusive=False)
+        try:
+            # a writer may have created the file but not yet the header
+            if os.fstat(data_file.fileno()).st_size == 0:
+                return matches
+            _check_header(data_file)
+            count = _record_count(data_file)
+            index = _read_index(path)
+            # every record before this block is older than start
+            block = bisect.bisect_left(index, start)
+            position = min(block * INDEX_STRIDE, count)
+            stop_after = end + MAX_SKEW_SECONDS
+            while position < count:
+                records = _read_records(data_file, position, INDEX_STRIDE)
+                position += len(records)
+                for record in records:
+                    if start <= record["timestamp"] < end:
+                        matches.append(record)
+                if records[-1]["timestamp"] >= stop_after:
+                    break
+        finally:
+            _unlock(data_file)
+    return matches
+
+
+# numpy dtype laid out exactly like RECORD
+def record_dtype():
+    import numpy as np
+
+    codes = {"d": "<f8", "q": "<i8", "i": "<i4"}
+    return np.dtype(
+        [(name, codes.get(code, "S" + code[:-1])) for name, code, _ in FIELDS]
+    )
+
+
+# read_range() as a numpy structured array of record_dtype(). The records
+# are mapped straight from the file instead of unpacked one at a time.
+# Strings stay as NUL padded utf-8 bytes
+def read_range_array(path: str, start=None, end=None):
+    # numpy is deferred so cron runs that only append don't pay for it
+    import numpy as np
+
+    start = float("-inf") if start is None else parse_timestamp(start)
+    end = float("inf") if end is None else parse_timestamp(end)
+    with open(path, "rb") as data_file:
+        _lock(data_file, exclusive=False)
+        try:
+            if os.fstat(data_file.fileno()).st_size == 0:
+                return np.empty(0, dtype=record_dtype())
+            _check_header(data_file)
+            count = _record_count(data_file)
+            first = min(
+                bisect.bisect_left(_read_index(path), start) * INDEX_STRIDE,
+                count,
+            )
+            data_file.seek(HEADER_SIZE + first * RECORD_SIZE)
+            buffer = data_file.read((count - first) * RECORD_SIZE)
+        finally:
+            _unlock(data_file)
+    records = np.frombuffer(buffer, dtype=record_dtype())
+    timestamps = records["timestamp"]
+    return records[(timestamps >= start) & (timestamps < end)]
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# A minimal in-process scheduler used by the NetCheck.py --daemon mode.
+# Replaces the crontab entries so the exporter is configured once
+# and the meter provider stays alive between runs.
+#
+# Jobs run one at a time on the calling thread so a ping never
+# overlaps an upload/download test and skews its numbers.
+import configparser
+import heapq
+import logging
+import signal
+import sys
+import threading
+import time
+from typing import Callable
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py --daemon")
+    sys.exit(-1)
+
+
+# Cadences match the defaults in Linux-Install/2-install-crontab.sh
+DEFAULT_PING_INTERVAL_SECONDS = 3 * 60
+DEFAULT_UP_DOWN_INTERVAL_SECONDS = 4 * 60 * 60
+DEFAULT_DNS_INTERVAL_SECONDS = 6 * 60
+
+
+# Read the job cadences from the optional [daemon] section of config.ini
+# An interval of 0 disables that job
+def load_daemon_intervals() -> dict[str, int]:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    intervals = {
+        "ping": config.getint(
+            "daemon",
+            "ping_interval_seconds",
+            fallback=DEFAULT_PING_INTERVAL_SECONDS,
+        ),
+        "up_down": config.getint(
+            "daemon",
+            "up_down_interval_seconds",
+            fallback=DEFAULT_UP_DOWN_INTERVAL_SECONDS,
+        ),
+        "dns": config.getint(
+            "daemon",
+            "dns_interval_seconds",
+            fallback=DEFAULT_DNS_INTERVAL_SECONDS,
+        ),
+    }
+    logger.debug("daemon intervals: %s", intervals)
+    return intervals
+
+
+class Scheduler:
+    def __init__(self) -> None:
+        # heap of (next_run, sequence, name, interval, job)
+        # sequence breaks ties so jobs are never compared
+        self._queue: list = []
+        self._sequence = 0
+        self._stop_event = threading.Event()
+
+    # interval_seconds <= 0 means the job is disabled
+    # initial_delay_seconds lets the caller stagger jobs that share a cadence
+    def add_job(
+        self,
+        name: str,
+        interval_seconds: float,
+        job: Callable[[], None],
+        initial_delay_seconds: float = 0,
+    ) -> None:
+        if interval_seconds <= 0:
+            logger.info("job %s disabled", name)
+            return
+        next_run = time.monotonic() + initial_delay_seconds
+        heapq.heappush(
+            self._queue,
+            (next_run, self._sequence, name, interval_seconds, job),
+        )
+        self._sequence += 1
+        logger.info("job %s scheduled every %ss", name, interval_seconds)
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def is_stopped(self) -> bool:
+        return self._stop_event.is_set()
+
+    # Stop the scheduler on SIGTERM (systemd, docker) and SIGINT (ctrl-c)
+    def install_signal_handlers(self) -> None:
+        def _handler(signum, frame):
+            logger.info("received signal %s, stopping scheduler", signum)
+            self.stop()
+
+        signal.signal(signal.SIGTERM, _handler)
+        signal.signal(signal.SIGINT, _handler)
+
+    # Runs until stop() is called. Failing jobs are logged and rescheduled
+    def run(self) -> None:
+        while self._queue and not self._stop_event.is_set():
+            next_run, sequence, name, interval, job = self._queue[0]
+            delay = next_run - time.monotonic()
+            # Event.wait() returns early when stop() is called
+            if delay > 0 and self._stop_event.wait(timeout=delay):
+                break
+            heapq.heappop(self._queue)
+            logger.info("running job %s", name)
+            try:
+                job()
+            except Exception:
+                logger.exception("job %s failed", name)
+            # skip any runs we missed while a long job was running
+            now = time.monotonic()
+            while next_run <= now:
+                next_run += interval
+            heapq.heappush(
+                self._queue, (next_run, sequence, name, interval, job)
+            )
+        logger.info("scheduler stopped")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# On-disk cache of the parsed speedtest.net server list.
+# The server list barely changes within a day but get_servers()
+# downloads and parses the full XML on every run.
+#
+# The cache is a gzipped json file keyed by the client ip and isp
+# reported in the speedtest.net config. A new ip or isp means the
+# distances in the list are stale so the cache is thrown away.
+import configparser
+import gzip
+import json
+import logging
+import os
+import sys
+import time
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py")
+    sys.exit(-1)
+
+CACHE_FORMAT_VERSION = 1
+
+DEFAULT_CACHE_PATH = ".speedtest-servers.json.gz"
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+
+# span attribute values
+CACHE_HIT = "hit"
+CACHE_MISS = "miss"
+CACHE_REFRESH = "refresh"
+CACHE_DISABLED = "disabled"
+
+
+# Read the optional [server_cache] section of config.ini
+# A ttl of 0 disables the cache
+def load_server_cache_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    cache_config = {
+        "path": config.get(
+            "server_cache", "path", fallback=DEFAULT_CACHE_PATH
+        ),
+        "ttl_seconds": config.getint(
+            "server_cache", "ttl_seconds", fallback=DEFAULT_TTL_SECONDS
+        ),
+        "cache_best_server": config.getboolean(
+            "server_cache", "cache_best_server", fallback=False
+        ),
+    }
+    logger.debug("server cache config: %s", cache_config)
+    return cache_config
+
+
+# identifies the network location the cached distances were computed from
+def _client_key(client: dict) -> dict:
+    return {"ip": client.get("ip"), "isp": client.get("isp")}
+
+
+# Returns the cache contents if it exists, is fresh
+# and was built for this client. Otherwise None
+def read_cache(path: str, ttl_seconds: int, client: dict):
+    try:
+        with gzip.open(path, "rt", encoding="utf-8") as cache_file:
+            cache = json.load(cache_file)
+    except FileNotFoundError:
+        logger.debug("no server cache at %s", path)
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning("ignoring unreadable server cache %s: %s", path, e)
+        return None
+
+    if cache.get("version") != CACHE_FORMAT_VERSION:
+        logger.info("server cache format changed")
+        return None
+    age = time.time() - cache.get("created", 0)
+    if age > ttl_seconds:
+        logger.info("server cache expired %.0fs ago", age - ttl_seconds)
+        return None
+    if cache.get("client") != _client_key(client):
+        logger.info("client ip or isp changed, server cache invalidated")
+        return None
+    return cache
+
+
+# Write the cache atomically so a crashed run never leaves a partial file
+def write_cache(path: str, client: dict, servers: dict, best=None) -> None:
+    # speedtest keys the server dict by distance which json can't round trip
+    # so store a flat list. Each server carries its distance in "d"
+    server_list = [server for group in servers.values() for server in group]
+    cache = {
+        "version": CACHE_FORMAT_VERSION,
+        "created": time.time(),
+        "client": _client_key(client),
+        "servers": server_list,
+        "best": best,
+    }
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as cache_file:
+            json.dump(cache, cache_file, separators=(",", ":"))
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("unable to write server cache %s: %s", path, e)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# rebuild the distance keyed dict that speedtest.Speedtest.servers expects
+def servers_from_cache(cache: dict) -> dict:
+    servers: dict = {}
+    for server in cache["servers"]:
+        servers.setdefault(server["d"], []).append(server)
+    return servers
+
+
+# Each uplink has its own client ip and nearby servers so it gets its own
+# cache file, .speedtest-servers.json.gz becomes
+# .speedtest-servers-10.0.0.2.json.gz
+def source_cache_path(path: str, source_ip=None) -> str:
+    if not source_ip:
+        return path
+    stem, extension = path, ""
+    for suffix in (".gz", ".json"):
+        if stem.endswith(suffix):
+            stem = stem[: -len(suffix)]
+            extension = suffix + extension
+    return f"{stem}-{source_ip.replace(':', '_')}{extension}"
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Tests over more than one uplink from a single NetCheck.py process.
+#
+# Without a source address the kernel picks the route for every test so
+# only one uplink is ever measured. Each [interfaces] sources entry is an
+# interface name like eth1 or a local address. Every ping, latency probe,
+# DNS check and throughput test of a run is bound to that address and
+# its metrics and spans carry interface and source_ip attributes.
+#
+# Binding only picks the source address. The host needs source based
+# routing, one routing table per uplink selected by "ip rule from", for
+# the packets to leave through the matching interface.
+import argparse
+import configparser
+import contextlib
+import ipaddress
+import logging
+import socket
+import struct
+import sys
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py --sources")
+    sys.exit(-1)
+
+# linux/sockios.h
+SIOCGIFADDR = 0x8915
+# struct ifreq name length
+IFNAMSIZ = 16
+
+# interface is the configured name, or the address when one was given
+Source = namedtuple("Source", ["interface", "source_ip"])
+
+
+# comma separated list of interfaces or addresses
+def parse_sources(value: str) -> list:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+# Read the optional [interfaces] section of config.ini
+#   sources - interfaces or local addresses to test from, empty is the
+#     default route only
+def load_interfaces_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    interfaces_config = {
+        "sources": parse_sources(
+            config.get("interfaces", "sources", fallback="")
+        ),
+    }
+    logger.debug("interfaces config: %s", interfaces_config)
+    return interfaces_config
+
+
+# The IPv4 address of a network interface. Linux only
+def _interface_address(name: str) -> str:
+    # not on Windows, where sources have to be addresses
+    import fcntl
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        ifreq = struct.pack("256s", name.encode("utf-8")[: IFNAMSIZ - 1])
+        response = fcntl.ioctl(probe.fileno(), SIOCGIFADDR, ifreq)
+    return socket.inet_ntoa(response[20:24])
+
+
+# Source for an [interfaces] entry.
+# Raises ValueError when the interface has no address
+def resolve_source(entry: str) -> Source:
+    try:
+        return Source(entry, str(ipaddress.ip_address(entry)))
+    except ValueError:
+        pass
+    try:
+        return Source(entry, _interface_address(entry))
+    except (ImportError, OSError) as e:
+        raise ValueError(f"no address for interface {entry}: {e}") from e
+
+
+# Resolves every entry, the ones without an address are logged and skipped
+# so one uplink that is down doesn't stop the tests of the others
+def resolve_sources(entries: list) -> list:
+    sources = []
+    for entry in entries:
+        try:
+            source = resolve_source(entry)
+        except ValueError as e:
+            logger.warning("skipping source: %s", e)
+            continue
+        if source not in sources:
+            sources.append(source)
+    return sources
+
+
+# The span and metric attributes of a source
+def source_attributes(source) -> dict:
+    if source is None:
+        return {}
+    return {"interface": source.interface, "source_ip": source.source_ip}
+
+
+# Adds the source attributes to every span started through it
+class SourceTracer:
+    def __init__(self, tracer, source: Source) -> None:
+        self._tracer = tracer
+        self._attributes = source_attributes(source)
+
+    def start_as_current_span(self, name: str, *args, **kwargs):
+        kwargs["attributes"] = {
+            **self._attributes,
+            **(kwargs.get("attributes") or {}),
+        }
+        return self._tracer.start_as_current_span(name, *args, **kwargs)
+
+    # anything else goes straight to the real tracer
+    def __getattr__(self, name):
+        return getattr(self._tracer, name)
+
+
+# Lets the runs from every source measure latency at the same time and
+# then take turns for the throughput tests, which would compete for the
+# links and load the latency measurements of the others
+class ThroughputGate:
+    def __init__(self, parties: int) -> None:
+        self._latency_done = threading.Barrier(parties)
+        self._turn = threading.Lock()
+
+    # Waits until every source has its latency, then holds the turn
+    @contextlib.contextmanager
+    def turn(self):
+        try:
+            self._latency_done.wait()
+        except threading.BrokenBarrierError:
+            # a source failed or left, the others don't wait for it
+            pass
+        with self._turn:
+            yield
+
+    # Called when a source's run is over, passed or failed
+    def leave(self) -> None:
+        self._latency_done.abort()
+
+
+# Runs job(source) for every source and returns the results in source
+# order, at the same time when concurrent.
+# A failed source is logged and its result is None
+def for_each_source(sources: list, job, concurrent: bool) -> list:
+    def run(source):
+        try:
+            return job(source)
+        except Exception:
+            logger.exception("%s test failed", source.interface)
+            return None
+
+    if not concurrent or len(sources) < 2:
+        return [run(source) for source in sources]
+    with ThreadPoolExecutor(
+        max_workers=len(sources), thread_name_prefix="Source"
+    ) as executor:
+        return list(executor.map(run, sources))
+
+
+# argparse type for --sources
+def sources_argument(value: str) -> list:
+    sources = parse_sources(value)
+    if not sources:
+        raise argparse.ArgumentTypeError("no sources given")
+    return sources
@@ -3,14 +3,51 @@
 #
 # SPDX-License-Identifier: MIT
 #
+import configparser
+import contextlib
+import functools
 import json
 import logging
 import sys
 import time
 
 import speedtest
+from opentelemetry import trace
 from opentelemetry.trace import Tracer
 
+from AdaptiveThroughput import ConvergenceCheck, adaptive_summary
+from LatencyProbe import probe_latency, probe_target, summarize_latency
+from ParallelThroughput import (
+    DIRECTION_DOWNLOAD,
+    DIRECTION_UPLOAD,
+    pick_servers,
+    run_parallel,
+)
+from PooledTransport import (
+    load_transport_config,
+    pooled_transport,
+    warm_up,
+)
+from ResourceUsage import measure_usage
+from ServerCache import (
+    CACHE_DISABLED,
+    CACHE_HIT,
+    CACHE_MISS,
+    CACHE_REFRESH,
+    load_server_cache_config,
+    read_cache,
+    servers_from_cache,
+    source_cache_path,
+    write_cache,
+)
+from SourceInterfaces import SourceTracer, source_attributes
+from StreamingUpload import load_upload_config, streaming_upload
+from ThroughputSampler import (
+    compact_series,
+    sampled_transfer,
+    summarize_series,
+)
+
 # ---------------------------
 # TODO add DNS lookup timing
 # ---------------------------
@@ -26,10 +63,210 @@ if __name__ == "__main__":
     sys.exit(-1)
 
 
+# speedtest-cli hardcodes these hosts for the config and server list
+SPEEDTEST_NET_URL_PREFIXES = ("://www.speedtest.net", "http://c.speedtest.net")
+
+
+# Read the optional [speedtest] section of config.ini
+#   secure - https to speedtest.net. Some Macs need this off, see README.md
+#   base_url - send the config and server list requests somewhere other
+#     than speedtest.net, like the stand-in in benchmarks/StandInServer.py
+def load_speedtest_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    speedtest_config = {
+        "secure": config.getboolean("speedtest", "secure", fallback=True),
+        "base_url": config.get("speedtest", "base_url", fallback=""),
+    }
+    logger.debug("speedtest config: %s", speedtest_config)
+    return speedtest_config
+
+
+# speedtest-cli has no setting for its config and server list hosts
+# so wrap its build_request() and rewrite them. Idempotent
+def use_speedtest_base_url(base_url: str) -> None:
+    original = getattr(
+        speedtest.build_request, "_original", speedtest.build_request
+    )
+    if not base_url:
+        speedtest.build_request = original
+        return
+
+    def build_request(url, *args, **kwargs):
+        for prefix in SPEEDTEST_NET_URL_PREFIXES:
+            if url.startswith(prefix):
+                url = base_url.rstrip("/") + url.removeprefix(prefix)
+                break
+        return original(url, *args, **kwargs)
+
+    build_request._original = original
+    speedtest.build_request = build_request
+
+
+# ---------------------------------------------------
+# Server list, from the on-disk cache when possible
+# ---------------------------------------------------
+# returns the cache status for the span attribute and the cache if it was used
+def _get_servers_cached(s, servers, refresh_servers, cache_config):
+    # a filtered server list is not cached
+    if servers or cache_config["ttl_seconds"] <= 0:
+        s.get_servers(servers=servers)
+        return CACHE_DISABLED, None
+    if refresh_servers:
+        s.get_servers(servers=servers)
+        return CACHE_REFRESH, None
+    cache = read_cache(
+        cache_config["path"],
+        cache_config["ttl_seconds"],
+        s.config["client"],
+    )
+    if cache is None:
+        s.get_servers(servers=servers)
+        return CACHE_MISS, None
+    s.servers = servers_from_cache(cache)
+    return CACHE_HIT, cache
+
+
+# ---------------------------------------------------
+# Burst of latency probes against the selected server
+# ---------------------------------------------------
+def _measure_latency(server, latency_probe_config, source_ip=None):
+    method = latency_probe_config["method"]
+    target = probe_target(server, method)
+    logger.info(
+        "probing %s with %d %s probes",
+        target,
+        latency_probe_config["count"],
+        method,
+    )
+    rtts = probe_latency(
+        target,
+        method=method,
+        count=latency_probe_config["count"],
+        interval_ms=latency_probe_config["interval_ms"],
+        timeout_ms=latency_probe_config["timeout_ms"],
+        source_ip=source_ip,
+    )
+    summary = summarize_latency(rtts)
+    logger.info("latency probe %s", summary)
+    return summary
+
+
+# ---------------------------------------------------
+# Throughput against the best server, sampled and stopped early
+# when asked for. Returns the series for the results record
+# ---------------------------------------------------
+def _measure_transfer(
+    s, direction, threads, adaptive_config, series_config, span, upload_config
+):
+    if direction == DIRECTION_DOWNLOAD:
+        transfer = s.download
+    elif upload_config["streaming"]:
+        transfer = functools.partial(
+            streaming_upload, s, buffer_kb=upload_config["buffer_kb"]
+        )
+    else:
+        transfer = s.upload
+    if not (adaptive_config or series_config):
+        transfer(threads=threads)
+        return {}
+    # adaptive mode needs its own sample rate for the convergence check
+    if adaptive_config:
+        interval_ms = adaptive_config["sample_interval_ms"]
+        stop_check = ConvergenceCheck(adaptive_config)
+        max_bytes = stop_check.max_bytes
+    else:
+        interval_ms = series_config["interval_ms"]
+        stop_check = None
+        max_bytes = 0
+    with sampled_transfer(
+        s, direction, interval_ms, stop_check, max_bytes
+    ) as sampler:
+        transfer(threads=threads)
+
+    if adaptive_config:
+        summary = adaptive_summary(sampler, s.config["length"][direction])
+        logger.info("adaptive %s %s", direction, summary)
+        span.set_attributes(summary)
+    if not series_config:
+        return {}
+    for elapsed_ms, total_bytes in sampler.samples:
+        span.add_event(
+            "throughput_sample",
+            {"elapsed_ms": elapsed_ms, "bytes": total_bytes},
+        )
+    series_summary = summarize_series(sampler.samples, direction)
+    span.set_attributes(series_summary)
+    return {
+        f"{direction}_series": compact_series(sampler.samples),
+        **series_summary,
+    }
+
+
+# The throughput series and their summaries from the run_test() setup
+# dict, they go into the json results record next to the speedtest results
+def throughput_series(results_setup: dict) -> dict:
+    return {
+        key: value
+        for key, value in results_setup.items()
+        if key.startswith((DIRECTION_DOWNLOAD, DIRECTION_UPLOAD))
+    }
+
+
+# ---------------------------------------------------
+# Throughput against several servers at the same time
+# ---------------------------------------------------
+# The combined rate replaces the single server result so the
+# speedtest results, the outfile and the exported rate all agree
+def _measure_parallel(
+    s, servers, direction, threads, parallel_config, span, upload_config
+):
+    summary = run_parallel(
+        s,
+        servers,
+        direction,
+        threads=threads,
+        start_delay_seconds=parallel_config["start_delay_seconds"],
+        upload_buffer_kb=(
+            upload_config["buffer_kb"] if upload_config["streaming"] else 0
+        ),
+    )
+    if direction == DIRECTION_DOWNLOAD:
+        s.results.download = summary["rate"]
+        s.results.bytes_received = summary["bytes"]
+    else:
+        s.results.upload = summary["rate"]
+        s.results.bytes_sent = summary["bytes"]
+    span.set_attribute("parallel_servers", len(servers))
+    span.set_attribute("parallel_overlap_ms", summary["overlap_ms"])
+    return summary["servers"]
+
+
+# one entry per server with its download and upload rates
+def _merge_parallel_servers(*per_direction):
+    merged = {}
+    for entries in per_direction:
+        for entry in entries:
+            merged.setdefault(entry["server_id"], {}).update(entry)
+    return list(merged.values())
+
+
 # ---------------------------------------------------
 # Actual speed test
 # ---------------------------------------------------
-def run_test(should_download, should_upload, should_share, tracer: Tracer):
+def run_test(
+    should_download,
+    should_upload,
+    should_share,
+    tracer: Tracer,
+    refresh_servers=False,
+    latency_probe_config=None,
+    parallel_config=None,
+    adaptive_config=None,
+    series_config=None,
+    source=None,
+    throughput_gate=None,
+):
     servers = None
     # If you want to test against a specific server
     # servers = [1234]
@@ -38,32 +275,173 @@ def run_test(should_download, should_upload, should_share, tracer: Tracer):
     # If you want to use a single threaded test
     # threads = 1
 
+    # source is a SourceInterfaces.Source, None leaves the route to the kernel
+    source_ip = None
+    if source is not None:
+        source_ip = source.source_ip
+        tracer = SourceTracer(tracer, source)
+        logger.info("testing from %s %s", source.interface, source_ip)
+
+    cache_config = load_server_cache_config()
+    cache_config["path"] = source_cache_path(cache_config["path"], source_ip)
+    speedtest_config = load_speedtest_config()
+    use_speedtest_base_url(speedtest_config["base_url"])
+    transport_config = load_transport_config()
+    upload_config = load_upload_config()
+
     # Other Tracing spans will be children to this one
-    with tracer.start_as_current_span(name="main"):
+    with tracer.start_as_current_span(name="main"), pooled_transport(
+        transport_config["pooled"], source_ip
+    ) as pool, contextlib.ExitStack() as throughput_turn:
         # getting the servers does a ping
-        s = speedtest.Speedtest(secure=1)
+        s = speedtest.Speedtest(
+            source_address=source_ip, secure=speedtest_config["secure"]
+        )
         logger.info("getting servers")
         tic = time.perf_counter()
-        with tracer.start_as_current_span(name="get_servers"):
-            retrieved_servers = s.get_servers(servers=servers)
-            logger.debug(f"retrieved servers {retrieved_servers}")
+        with tracer.start_as_current_span(name="get_servers") as span:
+            cache_status, cache = _get_servers_cached(
+                s, servers, refresh_servers, cache_config
+            )
+            span.set_attribute("server_cache", cache_status)
+            logger.info("server list cache %s", cache_status)
+            logger.debug(f"retrieved servers {s.servers}")
         tac = time.perf_counter()
-        with tracer.start_as_current_span(name="get_best_servers"):
-            retrieved_best_server = s.get_best_server(servers=servers)
+        with tracer.start_as_current_span(name="get_best_servers") as span:
+            retrieved_best_server = None
+            if (
+                cache is not None
+                and cache_config["cache_best_server"]
+                and cache.get("best")
+            ):
+                # re-ping only the previous best server.
+                # The ping time is still measured on every run
+                try:
+                    retrieved_best_server = s.get_best_server(
+                        servers=[cache["best"]]
+                    )
+                    span.set_attribute("best_server_cache", CACHE_HIT)
+                except speedtest.SpeedtestBestServerFailure:
+                    logger.info("cached best server unreachable")
+            if retrieved_best_server is None:
+                retrieved_best_server = s.get_best_server(servers=servers)
             logger.debug(f"retrieved best server is {retrieved_best_server}")
         toc = time.perf_counter()
+        latency_summary = {}
+        if latency_probe_config:
+            with tracer.start_as_current_span(name="measure_latency") as span:
+                latency_summary = _measure_latency(
+                    retrieved_best_server, latency_probe_config, source_ip
+                )
+                span.set_attributes(latency_summary)
+        if cache_status in (CACHE_MISS, CACHE_REFRESH):
+            write_cache(
+                cache_config["path"],
+                s.config["client"],
+                s.servers,
+                best=retrieved_best_server,
+            )
+
+        parallel_servers = []
+        if parallel_config and parallel_config["servers"] > 1:
+            parallel_servers = pick_servers(
+                s, retrieved_best_server, parallel_config["servers"]
+            )
+        parallel_download = []
+        parallel_upload = []
+        series = {}
+
+        # with several sources, every latency is measured before the
+        # first throughput test and the sources take turns for them
+        if throughput_gate is not None and (should_download or should_upload):
+            throughput_turn.enter_context(throughput_gate.turn())
+
+        warm_up_summary = {}
+        upload_memory = {}
+        if (
+            pool is not None
+            and transport_config["warm_up"]
+            and (should_download or should_upload)
+        ):
+            with tracer.start_as_current_span(name="warm_up") as span:
+                logger.info("warming up connections")
+                tic_warm_up = time.perf_counter()
+                warm_up_summary["warm_up_bytes"] = warm_up(s, threads)
+                warm_up_summary["warm_up_ms"] = (
+                    time.perf_counter() - tic_warm_up
+                ) * 1000.0
+                span.set_attributes(warm_up_summary)
 
         if should_download:
-            with tracer.start_as_current_span(name="measure_download"):
-                logger.info("running download test")
-                s.download(threads=threads)
+            with tracer.start_as_current_span(name="measure_download") as span:
+                if parallel_servers:
+                    logger.info(
+                        "running download test on %d servers",
+                        len(parallel_servers),
+                    )
+                    parallel_download = _measure_parallel(
+                        s,
+                        parallel_servers,
+                        DIRECTION_DOWNLOAD,
+                        threads,
+                        parallel_config,
+                        span,
+                        upload_config,
+                    )
+                else:
+                    logger.info("running download test")
+                    series.update(
+                        _measure_transfer(
+                            s,
+                            DIRECTION_DOWNLOAD,
+                            threads,
+                            adaptive_config,
+                            series_config,
+                            span,
+                            upload_config,
+                        )
+                    )
         else:
             logger.info("skipping download test")
 
         if should_upload:
-            with tracer.start_as_current_span(name="measure_upload"):
-                logger.info("running upload test")
-                s.upload(threads=threads)
+            with tracer.start_as_current_span(name="measure_upload") as span:
+                if parallel_servers and parallel_config["upload"]:
+                    logger.info(
+                        "running upload test on %d servers",
+                        len(parallel_servers),
+                    )
+                    parallel_upload = _measure_parallel(
+                        s,
+                        parallel_servers,
+                        DIRECTION_UPLOAD,
+                        threads,
+                        parallel_config,
+                        span,
+                        upload_config,
+                    )
+                else:
+                    logger.info("running upload test")
+                    # the parallel workers are other processes, only the
+                    # single server test can be measured here
+                    with measure_usage() as upload_usage:
+                        series.update(
+                            _measure_transfer(
+                                s,
+                                DIRECTION_UPLOAD,
+                                threads,
+                                adaptive_config,
+                                series_config,
+                                span,
+                                upload_config,
+                            )
+                        )
+                    if "rss_peak_kb" in upload_usage:
+                        upload_memory = {
+                            "upload_rss_peak_kb": upload_usage["rss_peak_kb"]
+                        }
+                        logger.info("upload %s", upload_memory)
+                        span.set_attributes(upload_memory)
         else:
             logger.info("skipping upload test")
 
@@ -79,7 +457,20 @@ def run_test(should_download, should_upload, should_share, tracer: Tracer):
         setup_time_dict = {
             "get_servers": (tac - tic) * 1000.0,
             "get_best_servers": (toc - tac) * 1000.0,
+            **source_attributes(source),
+            **latency_summary,
+            **warm_up_summary,
+            **upload_memory,
+            **series,
         }
+        if pool is not None:
+            # connection setup is no longer hidden inside the phases
+            setup_time_dict.update(pool.stats())
+            trace.get_current_span().set_attributes(pool.stats())
+        if parallel_download or parallel_upload:
+            setup_time_dict["parallel_servers"] = _merge_parallel_servers(
+                parallel_download, parallel_upload
+            )
         return s.results, setup_time_dict
 
 
@@ -87,12 +478,14 @@ def run_test(should_download, should_upload, should_share, tracer: Tracer):
 #
 # ---------------------------------------------------
 # filetype really is the worst.
-# It can't tell you if the file already existed so we write header every time
+# It can't tell you if the file already existed.
+# Files are opened for append so only write the header into an empty one
 def write_csv(results, outfile):
     if outfile:
         logger.info("writing to file")
-        outfile.write(results.csv_header())
-        outfile.write("\n")
+        if outfile.tell() == 0:
+            outfile.write(results.csv_header())
+            outfile.write("\n")
         outfile.write(results.csv())
         outfile.write("\n")
         outfile.close()
@@ -101,14 +494,19 @@ def write_csv(results, outfile):
 
 
 # This has the advantage of not requiring a header row and is self describing
-def write_json(results, outfile):
+# One object per line so an appended file is a json lines history
+# extra holds fields to add to the speedtest results like the throughput series
+# The file is left open for the runs from other sources, the caller closes it
+def write_json(results, outfile, extra=None):
     if outfile:
         logger.info("writing to file")
         # formatting works on dict, not a string
-        results_json = json.dumps(results.dict(), sort_keys=True)
+        results_json = json.dumps(
+            {**results.dict(), **(extra or {})}, sort_keys=True
+        )
         outfile.write(results_json)
         outfile.write("\n")
-        outfile.close()
+        outfile.flush()
         return results_json
     else:
         logger.info("no file output requested")
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Tail sampling of the spans and logs of NetCheck.py runs.
+#
+# With --verbose every run ships its spans and the large json log records,
+# so the ingestion cost grows with every probe and every run. Head
+# sampling decides before a run starts and would drop the runs we care
+# about most. With the [sampling] section enabled the spans and logs of a
+# run are held in memory until the run is over and then all sent or all
+# dropped. A run is kept when
+#   error - it raised or one of its spans has an error status
+#   slow - a top level span took longer than slow_ms
+#   threshold - the results breach max_ping_ms, min_download_mbps,
+#     min_upload_mbps or max_probe_loss
+#   random - for keep_ratio of the other runs
+# Every kept span and log gets a sampling_reason attribute. Runs kept at
+# random also carry the Application Insights sample rate so itemCount
+# scales them back up in queries. Dropped runs are counted and the
+# approximate bytes that were not sent are logged.
+#
+# Spans and logs outside a run, DnsCheck.py and the daemon DNS jobs, are
+# sent as before.
+from __future__ import annotations
+
+import configparser
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import sys
+import threading
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py")
+    sys.exit(-1)
+
+DEFAULT_KEEP_RATIO = 0.1
+REASON_ERROR = "error"
+REASON_SLOW = "slow"
+REASON_THRESHOLD = "threshold"
+REASON_RANDOM = "random"
+ATTRIBUTE_REASON = "sampling_reason"
+ATTRIBUTE_KEEP_RATIO = "sampling_keep_ratio"
+# read by the Azure trace exporter as the envelope sample rate in percent
+ATTRIBUTE_SAMPLE_RATE = "_MS.sampleRate"
+BITS_PER_MEGABIT = 1_000_000
+NANOSECONDS_PER_MS = 1_000_000
+
+
+# Read the optional [sampling] section of config.ini
+#   enabled - tail sample the spans and logs of each run
+#   keep_ratio - fraction of the normal runs that are sent
+#   slow_ms - runs with a top level span longer than this are kept
+#   max_ping_ms, min_download_mbps, min_upload_mbps, max_probe_loss -
+#     runs with results past these are kept
+# A threshold of 0 is off
+def load_sampling_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    sampling_config = {
+        "enabled": config.getboolean("sampling", "enabled", fallback=False),
+        "keep_ratio": config.getfloat(
+            "sampling", "keep_ratio", fallback=DEFAULT_KEEP_RATIO
+        ),
+        "slow_ms": config.getfloat("sampling", "slow_ms", fallback=0.0),
+        "max_ping_ms": config.getfloat(
+            "sampling", "max_ping_ms", fallback=0.0
+        ),
+        "min_download_mbps": config.getfloat(
+            "sampling", "min_download_mbps", fallback=0.0
+        ),
+        "min_upload_mbps": config.getfloat(
+            "sampling", "min_upload_mbps", fallback=0.0
+        ),
+        "max_probe_loss": config.getfloat(
+            "sampling", "max_probe_loss", fallback=0.0
+        ),
+    }
+    logger.debug("sampling config: %s", sampling_config)
+    return sampling_config
+
+
+# The thresholds a run's results breach. Skipped tests report a 0 rate
+def breached_thresholds(results: dict, sampling_config: dict) -> list:
+    breached = []
+    ping = results.get("ping")
+    if sampling_config["max_ping_ms"] and ping is not None:
+        if ping > sampling_config["max_ping_ms"]:
+            breached.append("ping")
+    for direction in ("download", "upload"):
+        minimum = sampling_config[f"min_{direction}_mbps"]
+        rate = results.get(direction)
+        if minimum and rate and rate < minimum * BITS_PER_MEGABIT:
+            breached.append(direction)
+    loss = results.get("probe_loss")
+    if sampling_config["max_probe_loss"] and loss is not None:
+        if loss > sampling_config["max_probe_loss"]:
+            breached.append("probe_loss")
+    return breached
+
+
+# What a dropped item would have cost, the json of a span or the body and
+# attributes of a log record
+def _span_size(span) -> int:
+    return len(span.to_json(indent=None))
+
+
+def _log_size(record) -> int:
+    log_record = record.log_record
+    return len(str(log_record.body)) + len(
+        json.dumps(dict(log_record.attributes or {}), default=str)
+    )
+
+
+# A copy of an ended span with extra attributes, ended spans are read only
+def _with_attributes(span, attributes: dict):
+    from opentelemetry.sdk.trace import ReadableSpan
+
+    return ReadableSpan(
+        name=span.name,
+        context=span.context,
+        parent=span.parent,
+        resource=span.resource,
+        attributes={**(span.attributes or {}), **attributes},
+        events=span.events,
+        links=span.links,
+        kind=span.kind,
+        status=span.status,
+        start_time=span.start_time,
+        end_time=span.end_time,
+        instrumentation_scope=span.instrumentation_scope,
+    )
+
+
+# The spans and logs of one run until the decision
+class _Run:
+    def __init__(self, sampler) -> None:
+        self._sampler = sampler
+        self.spans = []
+        self.logs = []
+        self.reasons = set()
+
+    # Results of the run, checked against the thresholds
+    def observe(self, results: dict) -> None:
+        if self._sampler is None or not results:
+            return
+        if breached_thresholds(results, self._sampler.config):
+            self.reasons.add(REASON_THRESHOLD)
+
+
+class TailSampler:
+    def __init__(self, sampling_config: dict, rng=None) -> None:
+        self.config = sampling_config
+        self._random = rng or random.Random()
+        self._lock = threading.Lock()
+        self.runs_kept = 0
+        self.runs_dropped = 0
+        self.bytes_dropped = 0
+
+    def buffer_span(self, run: _Run, span) -> None:
+        from opentelemetry.trace import StatusCode
+
+        run.spans.append(span)
+        if span.status.status_code == StatusCode.ERROR:
+            run.reasons.add(REASON_ERROR)
+        # top level within the run, remote parents included
+        if span.parent is None or span.parent.is_remote:
+            duration_ms = (span.end_time - span.start_time) / (
+                NANOSECONDS_PER_MS
+            )
+            if self.config["slow_ms"] and duration_ms > self.config["slow_ms"]:
+                run.reasons.add(REASON_SLOW)
+
+    # The reasons a run is kept, empty when it is dropped
+    def decide(self, run: _Run) -> list:
+        if run.reasons:
+            return sorted(run.reasons)
+        if self._random.random() < self.config["keep_ratio"]:
+            return [REASON_RANDOM]
+        return []
+
+    # Sends the run's spans and logs or drops them
+    def finish(self, run: _Run, span_processor, log_processor) -> None:
+        reasons = self.decide(run)
+        if not reasons:
+            dropped = sum(_span_size(span) for span in run.spans) + sum(
+                _log_size(record) for _, record in run.logs
+            )
+            with self._lock:
+                self.runs_dropped += 1
+                self.bytes_dropped += dropped
+                bytes_dropped = self.bytes_dropped
+            logger.info(
+                "sampling dropped %d spans, %d logs, %d bytes, "
+                "%d bytes in total",
+                len(run.spans),
+                len(run.logs),
+                dropped,
+                bytes_dropped,
+            )
+            return
+        with self._lock:
+            self.runs_kept += 1
+        attributes = {ATTRIBUTE_REASON: ",".join(reasons)}
+        if reasons == [REASON_RANDOM]:
+            attributes[ATTRIBUTE_KEEP_RATIO] = self.config["keep_ratio"]
+        span_attributes = dict(attributes)
+        if reasons == [REASON_RANDOM] and self.config["keep_ratio"] > 0:
+            span_attributes[ATTRIBUTE_SAMPLE_RATE] = (
+                100.0 * self.config["keep_ratio"]
+            )
+        for span in run.spans:
+            span_processor.send(_with_attributes(span, span_attributes))
+        for method, record in run.logs:
+            record.log_record.attributes = {
+                **(record.log_record.attributes or {}),
+                **attributes,
+            }
+            log_processor.send(method, record)
+
+
+# the run of the current thread, set by sampled_run()
+_current_run: contextvars.ContextVar = contextvars.ContextVar(
+    "tail_sampling_run", default=None
+)
+
+# set by install_tail_sampler()
+_sampler: TailSampler | None = None
+_span_processor = None
+_log_processor = None
+
+
+# Holds what a span processor is given during a run
+class TailSamplingSpanProcessor:
+    def __init__(self, sampler: TailSampler, downstream) -> None:
+        self._sampler = sampler
+        self._downstream = downstream
+
+    def on_end(self, span) -> None:
+        run = _current_run.get()
+        if run is None:
+            self._downstream.on_end(span)
+            return
+        self._sampler.buffer_span(run, span)
+
+    def send(self, span) -> None:
+        self._downstream.on_end(span)
+
+    # on_start, shutdown and force_flush go straight to the exporter
+    def __getattr__(self, name):
+        return getattr(self._downstream, name)
+
+
+# Holds what a log record processor is given during a run. Older SDKs
+# call emit(log_data), newer ones on_emit(log_record)
+class TailSamplingLogProcessor:
+    def __init__(self, sampler: TailSampler, downstream) -> None:
+        self._sampler = sampler
+        self._downstream = downstream
+
+    def _receive(self, method: str, record) -> None:
+        run = _current_run.get()
+        if run is None:
+            self.send(method, record)
+            return
+        run.logs.append((method, record))
+
+    def on_emit(self, log_record) -> None:
+        self._receive("on_emit", log_record)
+
+    def emit(self, log_data) -> None:
+        self._receive("emit", log_data)
+
+    def send(self, method: str, record) -> None:
+        getattr(self._downstream, method)(record)
+
+    def __getattr__(self, name):
+        return getattr(self._downstream, name)
+
+
+# Replaces the trace and log pipelines configure_azure_monitor() would
+# have built with ones that go through the sampler
+def install_tail_sampler(
+    connection_string: str, sampling_config: dict, capture_logs: bool
+) -> TailSampler:
+    from azure.monitor.opentelemetry.exporter import (
+        AzureMonitorLogExporter,
+        AzureMonitorTraceExporter,
+    )
+    from opentelemetry import trace
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+    global _sampler, _span_processor, _log_processor
+    _sampler = TailSampler(sampling_config)
+    # picks up service.name from OTEL_RESOURCE_ATTRIBUTES
+    resource = Resource.create()
+    _span_processor = TailSamplingSpanProcessor(
+        _sampler,
+        BatchSpanProcessor(
+            AzureMonitorTraceExporter(
+                connection_string=connection_string,
+                disable_offline_storage=True,
+            )
+        ),
+    )
+    tracer_provider = TracerProvider(resource=resource)
+    tracer_provider.add_span_processor(_span_processor)
+    trace.set_tracer_provider(tracer_provider)
+
+    if capture_logs:
+        from opentelemetry._logs import set_logger_provider
+        from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
+        from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+
+        _log_processor = TailSamplingLogProcessor(
+            _sampler,
+            BatchLogRecordProcessor(
+                AzureMonitorLogExporter(
+                    connection_string=connection_string,
+                    disable_offline_storage=True,
+                )
+            ),
+        )
+        logger_provider = LoggerProvider(resource=resource)
+        logger_provider.add_log_record_processor(_log_processor)
+        set_logger_provider(logger_provider)
+        logging.getLogger().addHandler(
+            LoggingHandler(logger_provider=logger_provider)
+        )
+    logger.info(
+        "tail sampling keeps slow, failed and threshold breaching runs "
+        "and %.0f%% of the others",
+        100.0 * sampling_config["keep_ratio"],
+    )
+    return _sampler
+
+
+# Samples the spans and logs of the run inside it
+#   with sampled_run() as run:
+#       results = ...
+#       run.observe(results)
+# Does nothing unless install_tail_sampler() was called
+@contextlib.contextmanager
+def sampled_run():
+    run = _Run(_sampler)
+    if _sampler is None:
+        yield run
+        return
+    token = _current_run.set(run)
+    try:
+        yield run
+    except BaseException:
+        run.reasons.add(REASON_ERROR)
+        raise
+    finally:
+        _current_run.reset(token)
+        _sampler.finish(run, _span_processor, _log_processor)
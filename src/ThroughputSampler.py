@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+# SPDX-FileCopyrightText: 2022 Joe Freeman joe@freemansoft.com
+#
+# SPDX-License-Identifier: MIT
+#
+#
+# Throughput time series for the speedtest download and upload tests.
+#
+# s.download() and s.upload() only return the average rate which hides
+# TCP slow start, drops in the middle of a test and bufferbloat.
+# sampled_transfer() counts the payload bytes through a wrapper around
+# the speedtest-cli opener and records the running total at a fixed
+# interval. A stop check can end the test early, that is how
+# AdaptiveThroughput.py works. A test never moves more than max_bytes.
+#
+# A download is stopped through speedtest-cli's shutdown event, its bytes
+# are counted as they are received. Upload bytes are counted as they are
+# handed to the socket and what is still queued in the socket buffers
+# when a request is cut off never reaches the server, though speedtest-cli
+# counts it. A stopped upload only refuses new requests so every byte it
+# counts was received. The byte cap is reserved when a request is opened
+# and the last request is cut down to what is left.
+import configparser
+import contextlib
+import functools
+import logging
+import statistics
+import sys
+import threading
+import time
+
+from ParallelThroughput import DIRECTION_UPLOAD
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+if __name__ == "__main__":
+    logger.error("You probably meant to run NetCheck.py")
+    sys.exit(-1)
+
+DEFAULT_INTERVAL_MS = 250
+# stop reason when the max_bytes of sampled_transfer() was reached
+STOP_BYTE_CAP = "byte_cap"
+# ramp up ends at the first interval within this fraction of steady state
+RAMP_UP_FRACTION = 0.9
+
+
+# Read the optional [throughput_series] section of config.ini
+def load_throughput_series_config() -> dict:
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    series_config = {
+        "enabled": config.getboolean(
+            "throughput_series", "enabled", fallback=False
+        ),
+        "interval_ms": config.getfloat(
+            "throughput_series", "interval_ms", fallback=DEFAULT_INTERVAL_MS
+        ),
+    }
+    logger.debug("throughput series config: %s", series_config)
+    return series_config
+
+
+# Payload bytes moved by every thread of a test. limit is a hard cap on
+# the bytes read through reserve(), 0 is no cap
+class _ByteCounter:
+    def __init__(self, limit: int = 0) -> None:
+        self._lock = threading.Lock()
+        self._limit = limit
+        self._reserved = 0
+        self.value = 0
+
+    # The read size that keeps the total under the cap, 0 once it is
+    # reached. Without a cap size is returned as is. A size of None or
+    # below 0 is the rest of the cap. Released by add()
+    def reserve(self, size):
+        if not self._limit:
+            return size
+        with self._lock:
+            allowed = max(0, self._limit - self.value - self._reserved)
+            if size is not None and 0 <= size < allowed:
+                allowed = size
+            self._reserved += allowed
+            return allowed
+
+    def add(self, size: int, reserved=0) -> None:
+        with self._lock:
+            self.value += size
+            if self._limit:
+                self._reserved -= reserved
+
+
+class _CountingResponse:
+    def __init__(self, response, counter: _ByteCounter, on_cap) -> None:
+        self._response = response
+        self._counter = counter
+        self._on_cap = on_cap
+
+    def read(self, size=None):
+        allowed = self._counter.reserve(size)
+        if allowed == 0 and size != 0:
+            # speedtest-cli ends the download on an empty read
+            self._on_cap()
+            return b""
+        chunk = self._response.read(allowed)
+        self._counter.add(len(chunk), allowed)
+        return chunk
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+# Wraps the speedtest-cli opener so every payload byte is counted.
+# Requests made after the test was stopped fail fast, speedtest-cli
+# counts them as zero bytes, instead of opening more connections.
+# on_cap() is called once the byte cap is reached
+class _CountingOpener:
+    def __init__(self, opener, counter, direction, stop_event, on_cap) -> None:
+        self._opener = opener
+        self._counter = counter
+        self._direction = direction
+        self._stop_event = stop_event
+        self._on_cap = on_cap
+
+    def open(self, request, *args, **kwargs):
+        if self._stop_event.is_set():
+            raise OSError("throughput test stopped early")
+        if self._direction == DIRECTION_UPLOAD:
+            self._count_upload(request)
+            return self._opener.open(request, *args, **kwargs)
+        return _CountingResponse(
+            self._opener.open(request, *args, **kwargs),
+            self._counter,
+            self._on_cap,
+        )
+
+    # The whole body is reserved up front so the requests still sending
+    # when the cap is reached stay within it
+    def _count_upload(self, request) -> None:
+        data = request.data
+        length = int(data.length)
+        remaining = self._counter.reserve(length)
+        if remaining == 0 and length:
+            self._on_cap()
+            raise OSError("throughput test reached its byte cap")
+        if remaining < length:
+            request.add_header("Content-length", str(remaining))
+        read = data.read
+
+        def counting_read(size=-1):
+            nonlocal remaining
+            if size is None or size < 0 or size > remaining:
+                size = remaining
+            if size == 0:
+                return b""
+            chunk = read(size)
+            remaining -= len(chunk)
+            self._counter.add(len(chunk), len(chunk))
+            return chunk
+
+        # on the instance so the request keeps its Content-length
+        data.read = counting_read
+
+    def __getattr__(self, name):
+        return getattr(self._opener, name)
+
+
+# Samples the byte counter on a fixed interval, setting stop_event
+# ends the test.
+# samples holds (elapsed ms, total bytes) starting with (0, 0).
+# stop_check(elapsed_seconds, total_bytes, interval_rate) returns a
+# reason to stop the test or None to keep going
+class ThroughputSampler(threading.Thread):
+    def __init__(
+        self, counter, stop_event, interval_ms: float, stop_check=None
+    ) -> None:
+        super().__init__(name="ThroughputSampler", daemon=True)
+        self._counter = counter
+        self._stop_event = stop_event
+        self._interval = interval_ms / 1000.0
+        self._stop_check = stop_check
+        self._finished = threading.Event()
+        self._stop_lock = threading.Lock()
+        self._start = time.perf_counter()
+        self.samples = [(0.0, 0)]
+        self.stop_reason = None
+        self.stopped_after = None
+
+    def _sample(self) -> tuple:
+        elapsed = time.perf_counter() - self._start
+        self.samples.append((elapsed * 1000.0, self._counter.value))
+        return elapsed
+
+    def run(self) -> None:
+        while not self._finished.wait(self._interval):
+            last_ms, last_bytes = self.samples[-1]
+            elapsed = self._sample()
+            if self._stop_check is None or self.stop_reason:
+                continue
+            now_ms, now_bytes = self.samples[-1]
+            rate = (now_bytes - last_bytes) / ((now_ms - last_ms) / 1000.0)
+            reason = self._stop_check(elapsed, now_bytes, rate)
+            if reason:
+                self.stop(reason, elapsed)
+
+    # Ends the test, the first reason given is kept
+    def stop(self, reason: str, elapsed=None) -> None:
+        with self._stop_lock:
+            if self.stop_reason is None:
+                self.stop_reason = reason
+                self.stopped_after = (
+                    time.perf_counter() - self._start
+                    if elapsed is None
+                    else elapsed
+                )
+        self._stop_event.set()
+
+    # the last sample is the end of the transfer, usually a partial interval
+    def finish(self) -> float:
+        self._finished.set()
+        self.join()
+        return self._sample()
+
+    @property
+    def total_bytes(self) -> int:
+        return self.samples[-1][1]
+
+
+# Wraps one s.download() or s.upload() call and yields the sampler.
+# max_bytes of 0 is no byte cap
+@contextlib.contextmanager
+def sampled_transfer(
+    s, direction: str, interval_ms: float, stop_check=None, max_bytes=0
+):
+    counter = _ByteCounter(int(max_bytes))
+    # speedtest-cli hands its shutdown event to every transfer thread
+    original_opener = s._opener
+    original_shutdown_event = s._shutdown_event
+    shutdown_event = threading.Event()
+    s._shutdown_event = shutdown_event
+    # the requests of a stopped upload that are sending are not cut off
+    stop_event = (
+        threading.Event() if direction == DIRECTION_UPLOAD else shutdown_event
+    )
+    sampler = ThroughputSampler(counter, stop_event, interval_ms, stop_check)
+    s._opener = _CountingOpener(
+        original_opener,
+        counter,
+        direction,
+        stop_event,
+        functools.partial(sampler.stop, STOP_BYTE_CAP),
+    )
+    sampler.start()
+    try:
+        yield sampler
+    finally:
+        sampler.finish()
+        s._opener = original_opener
+        s._shutdown_event = original_shutdown_event
+
+
+# Compact form for the results record, [[elapsed ms, total bytes], ...]
+def compact_series(samples) -> list:
+    return [[round(elapsed_ms, 1), total] for elapsed_ms, total in samples]
+
+
+# Summary of a sampled transfer, rates in bits per second like speedtest
+#   <prefix>_steady_rate - median interval rate of the second half
+#   <prefix>_ramp_up_ms - start of the first interval within
+#     RAMP_UP_FRACTION of the steady state rate
+#   <prefix>_min_window_rate - slowest full interval after the ramp up
+def summarize_series(samples, prefix: str) -> dict:
+    rates = []
+    for (start_ms, start_bytes), (end_ms, end_bytes) in zip(
+        samples, samples[1:]
+    ):
+        if end_ms > start_ms:
+            rates.append(
+                (end_bytes - start_bytes) * 8.0 / ((end_ms - start_ms) / 1e3)
+            )
+    # the final interval is partial and includes the test tear down
+    full_rates = rates[:-1]
+    if len(full_rates) < 2:
+        return {}
+    second_half = len(full_rates) // 2
+    steady_rate = statistics.median(full_rates[second_half:])
+    ramp_up = next(
+        (
+            index
+            for index, rate in enumerate(full_rates)
+            if rate >= RAMP_UP_FRACTION * steady_rate
+        ),
+        0,
+    )
+    return {
+        f"{prefix}_steady_rate": steady_rate,
+        f"{prefix}_ramp_up_ms": samples[ramp_up][0],
+        f"{prefix}_min_window_rate": min(full_rates[ramp_up:]),
+    }